@@ -1,14 +1,142 @@
 # Copy this file, rename it as config.py and modify it
+import os
+
 APP_ID = 'APP_ID'
 APP_SECRET = 'APP_SECRET'
 APP_TOKEN = 'APP_TOKEN'
 APP_AES_KEY = 'APP_AES_KEY'
 
 QR_CODE_EXPIRATION = 300
+# tickets of identical bodies are reused while at least this many seconds remain
+QR_CODE_MIN_REMAINING = 60
+QR_CODE_CACHE_SIZE = 10000
+# /api/generateQrCodes
+QR_CODE_BULK_CONCURRENCY = 8
+QR_CODE_BULK_MAX_SIZE = 500
+
+# Private directory of the files the worker processes on this host share, created with mode 0700
+# Files in it are refused unless it is owned by the user running the service and closed to others
+RUNTIME_DIR = os.path.expanduser('~/.wechatpy-plus')
 
 class MYSQL:
     HOST = 'localhost'
     PORT = 3306
     USER = 'root'
     PASSWORD = 'password'
-    DB = 'db'
\ No newline at end of file
+    DB = 'db'
+    # connections of each worker, MIN_SIZE of them opened and checked before serving
+    MIN_SIZE = 5
+    MAX_SIZE = 20
+    # seconds before a connection is reopened, keep it below wait_timeout of the server
+    RECYCLE = 3600
+    # seconds a query waits for a free connection before failing
+    ACQUIRE_TIMEOUT = 2
+    # seconds a statement may run, the connection is closed when it takes longer
+    STATEMENT_TIMEOUT = 10
+    # after this many acquire timeouts in a row, queries fail at once for BREAKER_COOLDOWN seconds
+    BREAKER_THRESHOLD = 5
+    BREAKER_COOLDOWN = 5
+    # share of SQL statements logged, only when DEBUG logging is on
+    LOG_SAMPLE_RATE = 0.01
+    # rows per multi-row INSERT of Model.save_many
+    INSERT_CHUNK_SIZE = 1000
+    # rows fetched per round trip by Model.iterAll
+    STREAM_BATCH_SIZE = 1000
+    # primary keys per IN (...) query of Model.find_many
+    FIND_CHUNK_SIZE = 500
+
+# Write-behind of models declaring __write_behind__ = True, see infra/write_behind.py
+class WRITE_BEHIND:
+    # seconds between flushes, a worker crashing loses at most this long of writes
+    INTERVAL = 1
+    # buffered rows that trigger a flush before the interval
+    MAX_PENDING = 1000
+    # buffered rows at most, writes of more keys are dropped while flushes fail
+    MAX_BUFFERED = 100000
+
+
+# Outbound WeChat API calls, all sharing one keep-alive connection pool
+class WECHAT_HTTP:
+    TIMEOUT = 5
+    MAX_CONNECTIONS = 100
+    MAX_KEEPALIVE_CONNECTIONS = 20
+    HTTP2 = True
+
+
+# Acknowledge /wechat at once and handle messages on a pool of async workers
+class DISPATCH:
+    ASYNC = False
+    WORKERS = 16
+    MAX_QUEUE_SIZE = 1000
+    # 'drop' acknowledges and discards messages when the queue is full,
+    # 'reject' answers 503 so that WeChat retries them later
+    SHED_POLICY = 'drop'
+
+
+# Compiled triggers cached across restarts, rebuilt whenever the registered handlers change
+# Off by default; the file is unpickled on boot, so it is refused outside a private directory
+class TRIGGER_INDEX:
+    PATH = None
+    # PATH = os.path.join(RUNTIME_DIR, 'triggers.pickle')
+
+
+# Retried messages within TTL seconds reuse the first reply instead of running handlers again
+class DEDUP:
+    TTL = 60
+    MAX_SIZE = 10000
+
+
+# access_token storage shared by every worker process on this host
+class TOKEN_STORE:
+    PATH = os.path.join(RUNTIME_DIR, 'token.sqlite3')
+
+
+# Scheduled jobs run in the one worker process holding this lock, see serve.py
+class SCHEDULER:
+    LEADER_LOCK = os.path.join(RUNTIME_DIR, 'scheduler.lock')
+    ELECTION_INTERVAL = 10
+
+
+# Delayed and recurring jobs kept in MySQL, fired by the worker running the scheduler, see service/job_service.py
+class JOBS:
+    # seconds of upcoming jobs held in memory, later ones are read from MySQL as they come closer
+    HORIZON = 3600
+    # jobs fired per batch, and handlers running at once
+    BATCH_SIZE = 500
+    CONCURRENCY = 50
+    # a failing job is retried after RETRY_DELAY * 2 ** (attempts - 1) seconds, MAX_ATTEMPTS runs at most
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = 30
+
+
+# Template message broadcasts checkpointed to MySQL, see service/broadcast_service.py
+class BROADCAST:
+    # recipients read, sent and checkpointed per batch, and template sends in flight per broadcast
+    BATCH_SIZE = 500
+    CONCURRENCY = 100
+    # seconds without a checkpoint after which the worker running the scheduler takes a broadcast over
+    STALE_AFTER = 120
+
+
+# Queued customer service and template sends, see infra/outbound.py
+class OUTBOUND:
+    # (requests per second, burst size) per WeChat API endpoint, shared by all worker processes
+    RATE_LIMITS = {
+        'message/custom/send': (50, 100),
+        'message/template/send': (50, 100),
+    }
+    CONCURRENCY = 8
+    MAX_RETRIES = 5
+    RETRY_BASE_DELAY = 1
+    MAX_QUEUE_SIZE = 10000
+
+
+# Shared secret of the admin API: stats, /metrics and broadcasts, sent as `Authorization: Bearer <TOKEN>`
+# Those routes answer 404 while it is unset
+class ADMIN:
+    TOKEN = None
+
+
+# Per-stage latency and WeChat API metrics served on /metrics in the Prometheus text format
+class METRICS:
+    ENABLED = True
@@ -0,0 +1,252 @@
+'''
+End-to-end benchmark of msg_dispatcher against the trigger kind and count
+
+For every trigger kind (prefix, suffix, keyword, rex, and all of them mixed)
+and every scale N, a fresh dispatcher tree gets N generated triggers, half of
+them written in Traditional Chinese, plus the usual event handlers. A corpus of
+text messages (Simplified and Traditional, some matching a trigger, some not)
+and subscribe/scan/unsubscribe events is then replayed through msg_dispatcher,
+from XML to the rendered reply. The WeChat client is stubbed out and handlers
+only return a reply string, so nothing leaves the process. Logging is raised to
+WARNING, otherwise the per-message INFO logs dominate.
+
+Reported per kind and scale: messages per second, p50/p99 latency, and the
+peak memory traced while handling one message (tracemalloc, separate pass;
+about 10 KiB of it is the XML parser's buffer, whatever the message) along
+with the memory still held afterwards, which grows with cache fills or leaks.
+
+Usage:
+    python -m benchmark.bench_dispatcher [--scales 10,100,1000] [--kinds prefix,rex]
+    python -m benchmark.bench_dispatcher --save baseline.json
+    python -m benchmark.bench_dispatcher --compare baseline.json [--threshold 0.1]
+
+--compare exits with status 1 if any throughput or p99 regressed by more than
+the threshold, so it can gate a CI job.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import zhconv
+
+import dispatcher as dispatcher_module
+from dispatcher.core import init_dispatcher_tree, _dispatcher_structure
+from dispatcher.dedup import MessageDeduplicator
+from utils.format import convert
+from utils.logger import logger
+
+KINDS = ('prefix', 'suffix', 'keyword', 'rex', 'mixed')
+
+_HEADER = '<ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[{user}]]></FromUserName><CreateTime>{time}</CreateTime>'
+_TEXT = '<xml>' + _HEADER + '<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[{content}]]></Content><MsgId>{id}</MsgId></xml>'
+_EVENT = '<xml>' + _HEADER + '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[{event}]]></Event>{key}</xml>'
+
+class _StubClient:
+    '''
+    Stands in for AsyncWeChatClient, any API call fails loudly
+    '''
+    def __getattr__(self, name):
+        raise RuntimeError(f'benchmark handlers must not call the WeChat API: {name}')
+
+def _convertible_chars():
+    # characters that differ between Simplified and Traditional Chinese
+    conv_dict = zhconv.zhconv.getdict('zh-hant')
+    return sorted(k for k, v in conv_dict.items() if len(k) == 1 and k != v and '一' <= k <= '鿿')
+
+def _words(rnd, chars, count, min_length=2, max_length=4):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rnd.choice(chars) for _ in range(rnd.randint(min_length, max_length))))
+    return sorted(words)
+
+def _register(tree, kind, words):
+    async def handler(client, msg):
+        return 'ok'
+    text = tree.text
+    for i, word in enumerate(words):
+        if i % 2:
+            # registered in Traditional, matched against Simplified too
+            word = convert(word, 'zh-hant')
+        handler.__name__ = f'{kind}_{i}'
+        if kind == 'prefix':
+            text.on_prefix(word)(handler)
+        elif kind == 'suffix':
+            text.on_suffix(word)(handler)
+        elif kind == 'keyword':
+            text.on_keyword(word)(handler)
+        elif kind == 'rex':
+            # every tenth pattern has no required literal and is never prefiltered
+            text.on_rex(f'[{word}]{{3}}\\d+' if i % 10 == 0 else f'{word}\\s*(\\d+)')(handler)
+
+def build_tree(kind, scale, rnd, chars):
+    tree = init_dispatcher_tree(_dispatcher_structure)
+    words = _words(rnd, chars, scale)
+    if kind == 'mixed':
+        for i, sub_kind in enumerate(KINDS[:-1]):
+            _register(tree, sub_kind, words[i::4])
+    else:
+        _register(tree, kind, words)
+
+    async def default(client, msg):
+        return 'default'
+    tree.text(default)
+    tree.event.subscribe(default)
+    tree.event.unsubscribe(default)
+    tree.event.scan(default)
+    tree.event.scan.on_etype(1)(default)
+    tree.event.subscribe_scan.on_etype(1)(default)
+    tree.freeze()
+    return tree, words
+
+def _text_content(rnd, kind, words, chars, hit):
+    filler = ''.join(rnd.choice(chars) for _ in range(rnd.randint(4, 20)))
+    if not hit:
+        return filler
+    word = rnd.choice(words)
+    if kind == 'mixed':
+        kind = KINDS[words.index(word) % 4]
+    if kind == 'prefix':
+        content = word + filler
+    elif kind == 'suffix':
+        content = filler + word
+    elif kind == 'rex':
+        content = f'{filler[:4]}{word} {rnd.randint(1, 999)}'
+    else:
+        content = filler[:len(filler) // 2] + word + filler[len(filler) // 2:]
+    return content
+
+def build_corpus(kind, words, rnd, chars, count, hit_ratio, event_ratio):
+    '''
+    Every message has its own MsgId or (FromUserName, CreateTime), so none is deduplicated
+    '''
+    corpus = []
+    scene = json.dumps({ 'etype': 1, 'module_id': 1 })
+    for i in range(count):
+        header = { 'user': f'user{i % 500}', 'time': 1617000000 + i }
+        if rnd.random() < event_ratio:
+            event, key = rnd.choice((
+                ('subscribe', ''),
+                ('subscribe', f'<EventKey><![CDATA[qrscene_{scene}]]></EventKey>'),
+                ('SCAN', f'<EventKey><![CDATA[{scene}]]></EventKey>'),
+                ('unsubscribe', ''),
+            ))
+            corpus.append(_EVENT.format(event=event, key=key, **header))
+            continue
+        content = _text_content(rnd, kind, words, chars, rnd.random() < hit_ratio)
+        if rnd.random() < 0.5:
+            content = convert(content, 'zh-hant')
+        corpus.append(_TEXT.format(content=content, id=10 ** 16 + i, **header))
+    return corpus
+
+def _use(tree):
+    dispatcher_module.dispatcher = tree
+    dispatcher_module.deduplicator = MessageDeduplicator()
+
+async def _replay(corpus):
+    latencies = []
+    perf_counter = time.perf_counter
+    msg_dispatcher = dispatcher_module.msg_dispatcher
+    for xml in corpus:
+        start = perf_counter()
+        await msg_dispatcher(xml)
+        latencies.append(perf_counter() - start)
+    return latencies
+
+async def _trace(corpus):
+    traced = []
+    msg_dispatcher = dispatcher_module.msg_dispatcher
+    for xml in corpus:
+        tracemalloc.start()
+        await msg_dispatcher(xml)
+        traced.append(tracemalloc.get_traced_memory())
+        tracemalloc.stop()
+    return traced
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def measure(loop, kind, scale, args):
+    rnd = random.Random(args.seed)
+    chars = _convertible_chars()
+    tree, words = build_tree(kind, scale, rnd, chars)
+    corpora = [build_corpus(kind, words, rnd, chars, args.messages, args.hit_ratio, args.event_ratio) for _ in range(args.rounds + 1)]
+
+    _use(tree)
+    # warm up caches and lazily built structures
+    loop.run_until_complete(_replay(corpora[0]))
+    latencies = []
+    for corpus in corpora[1:]:
+        _use(tree)
+        latencies.extend(loop.run_until_complete(_replay(corpus)))
+    _use(tree)
+    traced = loop.run_until_complete(_trace(corpora[1][:args.trace_messages]))
+
+    latencies.sort()
+    return {
+        'msgs_per_s': len(latencies) / sum(latencies),
+        'p50_us': _percentile(latencies, 0.5) * 1e6,
+        'p99_us': _percentile(latencies, 0.99) * 1e6,
+        'peak_bytes': statistics.mean(peak for _, peak in traced),
+        'retained_bytes': statistics.mean(current for current, _ in traced),
+    }
+
+def compare(results, baseline, threshold):
+    regressed = []
+    print(f'\n{"case":>16} {"msgs/s":>18} {"p99 us":>18}')
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base == None:
+            continue
+        throughput = result['msgs_per_s'] / base['msgs_per_s'] - 1
+        p99 = result['p99_us'] / base['p99_us'] - 1
+        flag = ''
+        if throughput < -threshold or p99 > threshold:
+            regressed.append(case)
+            flag = '  REGRESSED'
+        print(f'{case:>16} {throughput:>+17.1%} {p99:>+17.1%}{flag}')
+    return regressed
+
+def run(args):
+    logger.setLevel(logging.WARNING)
+    dispatcher_module.get_wx_client = _StubClient
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    results = {}
+    print(f'{"kind":>8} {"triggers":>9} {"msgs/s":>10} {"p50 us":>9} {"p99 us":>9} {"peak KiB/msg":>13} {"held B/msg":>11}')
+    for kind in args.kinds.split(','):
+        for scale in (int(x) for x in args.scales.split(',')):
+            result = results[f'{kind}/{scale}'] = measure(loop, kind, scale, args)
+            print(f'{kind:>8} {scale:>9} {result["msgs_per_s"]:>10.0f} {result["p50_us"]:>9.1f} {result["p99_us"]:>9.1f} {result["peak_bytes"] / 1024:>13.1f} {result["retained_bytes"]:>11.0f}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f'\n{len(regressed)} case(s) regressed by more than {args.threshold:.0%}')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kinds', default=','.join(KINDS))
+    parser.add_argument('--scales', default='10,100,1000')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--trace-messages', type=int, default=200)
+    parser.add_argument('--hit-ratio', type=float, default=0.5)
+    parser.add_argument('--event-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with a JSON file written by --save')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    run(parser.parse_args())
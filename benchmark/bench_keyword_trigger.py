@@ -0,0 +1,61 @@
+'''
+Benchmark of KeywordTrigger.find_handler against the keyword count
+
+Usage:
+    python -m benchmark.bench_keyword_trigger [--scales 10,100,1000,5000]
+'''
+import argparse
+import random
+import time
+
+from dispatcher.trigger import KeywordTrigger, TriggerFunction
+
+CJK_CHARS = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+
+class _TextMessage:
+    def __init__(self, content):
+        self.content = content
+
+def _random_text(rnd, length):
+    return ''.join(rnd.choice(CJK_CHARS) for _ in range(length))
+
+def _naive_find(allkw, raw_msg):
+    # the linear scan KeywordTrigger used before the automaton
+    for kw in allkw:
+        if kw in raw_msg:
+            return allkw[kw]
+    return None
+
+def _time_per_call(func, messages, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for m in messages:
+            func(m)
+    return (time.perf_counter() - start) / (rounds * len(messages))
+
+def run(scales, msg_count, msg_length, rounds, seed):
+    print(f'{"keywords":>10} {"naive us/msg":>14} {"automaton us/msg":>18} {"speedup":>9}')
+    for n in scales:
+        rnd = random.Random(seed)
+        trigger = KeywordTrigger()
+        async def handler(client, msg):
+            pass
+        tf = TriggerFunction(handler)
+        for _ in range(n):
+            trigger.add(_random_text(rnd, rnd.randint(2, 5)), tf)
+        trigger.compile()
+        messages = [_TextMessage(_random_text(rnd, msg_length)) for _ in range(msg_count)]
+
+        naive = _time_per_call(lambda m: _naive_find(trigger.allkw, m.content), messages, rounds)
+        compiled = _time_per_call(trigger.find_handler, messages, rounds)
+        print(f'{n:>10} {naive * 1e6:>14.2f} {compiled * 1e6:>18.2f} {naive / compiled:>8.1f}x')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10,100,1000,5000')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--length', type=int, default=30)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    run([int(x) for x in args.scales.split(',')], args.messages, args.length, args.rounds, args.seed)
@@ -0,0 +1,98 @@
+'''
+Memory and construction speed of ORM rows, dict models against slotted rows
+
+A model of six columns is loaded from N cursor rows both ways, without a
+database: a DictCursor row (the dict the driver builds from the tuple it
+read) turned into a Model, and the tuple of a plain cursor turned into the
+model's `__slots_rows__` row class. Memory is what the N loaded objects hold
+on top of the column values, which both share.
+
+Usage:
+    python -m benchmark.bench_orm_rows [--rows 100000] [--repeat 5]
+'''
+import argparse
+import gc
+import logging
+import statistics
+import time
+import tracemalloc
+
+from infra.mysql import Model, IntegerField, StringField
+from utils.logger import logger
+
+logger.setLevel(logging.WARNING)
+
+class DictUser(Model):
+    __table__ = 'bench_user'
+
+    open_id = StringField(primary_key=True)
+    user_name = StringField()
+    city = StringField()
+    score = IntegerField()
+    subscribed_at = IntegerField()
+    updated_at = IntegerField()
+
+class SlotUser(Model):
+    __table__ = 'bench_user'
+    __slots_rows__ = True
+
+    open_id = StringField(primary_key=True)
+    user_name = StringField()
+    city = StringField()
+    score = IntegerField()
+    subscribed_at = IntegerField()
+    updated_at = IntegerField()
+
+COLUMNS = (DictUser.__primary_key__,) + tuple(DictUser.__fields__)
+
+def cursor_rows(n):
+    return [(f'oFw5as2T3lk5Awa3wrGj{i:08d}', f'user {i}', 'Shanghai', i % 1000, 1617000000 + i, 1618000000 + i) for i in range(n)]
+
+def load_dicts(rows):
+    # what DictCursor hands to findAll, then findAll itself
+    return [DictUser(**dict(zip(COLUMNS, r))) for r in rows]
+
+def load_slots(rows):
+    make = SlotUser.__row_class__._make
+    return [make(r) for r in rows]
+
+def timed(func, rows, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(rows)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def held_bytes(func, rows):
+    gc.collect()
+    tracemalloc.start()
+    loaded = func(rows)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+    return held
+
+def attribute_ns(obj, number=1000000):
+    start = time.perf_counter()
+    for _ in range(number):
+        obj.user_name
+    return (time.perf_counter() - start) / number * 1e9
+
+def run(n, repeat):
+    rows = cursor_rows(n)
+    print(f'{n} rows of {len(COLUMNS)} columns')
+    print(f'{"":>8} {"load ms":>9} {"us/row":>7} {"held MiB":>9} {"B/row":>6} {"attr ns":>8}')
+    for name, func in (('dict', load_dicts), ('slots', load_slots)):
+        seconds = timed(func, rows, repeat)
+        held = held_bytes(func, rows)
+        sample = func(rows[:1])[0]
+        print(f'{name:>8} {seconds * 1e3:>9.1f} {seconds / n * 1e6:>7.2f} {held / 2**20:>9.1f} {held / n:>6.0f} {attribute_ns(sample):>8.0f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
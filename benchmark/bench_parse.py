@@ -0,0 +1,64 @@
+'''
+Micro-benchmark of inbound message parsing, per message type
+
+Compares the previous path (wechatpy.parse_message, logging the whole message,
+parsing scene_id eagerly) with dispatcher.message_preprocess, including the
+fields a typical handler reads afterwards.
+
+Usage:
+    python -m benchmark.bench_parse [--number 20000]
+'''
+import argparse
+import json
+import timeit
+
+from wechatpy import parse_message, create_reply
+
+from dispatcher import message_preprocess
+
+_HEADER = '<ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[oFw5as2T3lk5Awa3wrGjwHgbwu8w]]></FromUserName><CreateTime>1617000000</CreateTime>'
+_SCENE = json.dumps({ 'etype': 1, 'module_id': 1, 'cron': { 'second': 1 } })
+
+MESSAGES = {
+    'text': f'<xml>{_HEADER}<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[帮助 hello]]></Content><MsgId>23123456789012345</MsgId></xml>',
+    'image': f'<xml>{_HEADER}<MsgType><![CDATA[image]]></MsgType><PicUrl><![CDATA[http://example.com/a.jpg]]></PicUrl><MediaId><![CDATA[media_id]]></MediaId><MsgId>23123456789012346</MsgId></xml>',
+    'location': f'<xml>{_HEADER}<MsgType><![CDATA[location]]></MsgType><Location_X>23.134521</Location_X><Location_Y>113.358803</Location_Y><Scale>20</Scale><Label><![CDATA[位置信息]]></Label><MsgId>23123456789012347</MsgId></xml>',
+    'subscribe': f'<xml>{_HEADER}<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event></xml>',
+    'subscribe_scan': f'<xml>{_HEADER}<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event><EventKey><![CDATA[qrscene_{_SCENE}]]></EventKey><Ticket><![CDATA[TICKET]]></Ticket></xml>',
+    'scan': f'<xml>{_HEADER}<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[SCAN]]></Event><EventKey><![CDATA[{_SCENE}]]></EventKey><Ticket><![CDATA[TICKET]]></Ticket></xml>',
+    'click': f'<xml>{_HEADER}<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[CLICK]]></Event><EventKey><![CDATA[MENU_KEY]]></EventKey></xml>',
+}
+
+def legacy_preprocess(xml):
+    # the path dispatcher.message_preprocess replaced
+    msg = parse_message(xml)
+    f'Receive message {msg.id}: {msg}'
+    key_list = [msg.type]
+    etype = None
+    if msg.type == "event":
+        if msg.event in ['subscribe_scan', 'scan']:
+            etype = json.loads(msg.scene_id).get('etype')
+        key_list.append(msg.event)
+    msg.__setattr__('_etype', etype)
+    return msg, key_list
+
+def _handle(preprocess, xml):
+    msg, key_list = preprocess(xml)
+    create_reply(None, msg)
+    return msg.source, msg.id
+
+def run(number):
+    print(f'{"type":>16} {"legacy us":>10} {"lazy us":>10} {"speedup":>9}')
+    for name, xml in MESSAGES.items():
+        legacy = timeit.timeit(lambda: _handle(legacy_preprocess, xml), number=number) / number
+        lazy = timeit.timeit(lambda: _handle(message_preprocess, xml), number=number) / number
+        print(f'{name:>16} {legacy * 1e6:>10.2f} {lazy * 1e6:>10.2f} {legacy / lazy:>8.1f}x')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+    import logging
+    from utils.logger import logger
+    logger.setLevel(logging.WARNING)
+    run(args.number)
@@ -0,0 +1,85 @@
+'''
+Cold start benchmark: importing the app, then registering and freezing N triggers
+
+Every measurement runs in a fresh interpreter, as a worker boot would, in three modes:
+    none    no trigger index, every trigger is converted and compiled
+    build   TRIGGER_INDEX enabled but its file missing, built and written
+    load    TRIGGER_INDEX file present, the compiled triggers are loaded
+
+The trigger words are generated here and handed to the child process, so the
+child loads the conversion tables only when registering needs them.
+
+Usage:
+    python -m benchmark.bench_startup [--scales 0,1000,10000] [--repeat 3]
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+def child(words_path, index_path):
+    start = time.perf_counter()
+    import config
+    # the app's own handlers get an index of their own
+    config.TRIGGER_INDEX.PATH = f'{index_path}.app' if index_path else None
+    import run
+    imported = time.perf_counter()
+
+    import logging
+    from benchmark.bench_dispatcher import KINDS, _register
+    from dispatcher.core import init_dispatcher_tree, _dispatcher_structure
+    from utils.logger import logger
+    logger.setLevel(logging.WARNING)
+    with open(words_path) as f:
+        words = json.load(f)
+    registering = time.perf_counter()
+    tree = init_dispatcher_tree(_dispatcher_structure)
+    for i, kind in enumerate(KINDS[:-1]):
+        _register(tree, kind, words[i::4])
+    tree.freeze(index_path or None)
+    frozen = time.perf_counter()
+    print(json.dumps({ 'import_ms': (imported - start) * 1e3, 'triggers_ms': (frozen - registering) * 1e3 }))
+
+def _spawn(words_path, index_path):
+    out = subprocess.run([sys.executable, '-m', 'benchmark.bench_startup', '--child', words_path, index_path or ''],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def run(scales, repeat, seed):
+    from benchmark.bench_dispatcher import _convertible_chars, _words
+    chars = _convertible_chars()
+    print(f'{"triggers":>9} {"mode":>6} {"import ms":>10} {"triggers ms":>12} {"total ms":>9}')
+    with tempfile.TemporaryDirectory() as tmp:
+        words_path = os.path.join(tmp, 'words.json')
+        for scale in scales:
+            with open(words_path, 'w') as f:
+                json.dump(_words(random.Random(seed), chars, scale), f)
+            index_path = os.path.join(tmp, f'triggers-{scale}.pickle')
+            for mode in ('none', 'build', 'load'):
+                results = []
+                for _ in range(repeat):
+                    if mode == 'build':
+                        for path in (index_path, f'{index_path}.app'):
+                            if os.path.exists(path):
+                                os.remove(path)
+                    results.append(_spawn(words_path, None if mode == 'none' else index_path))
+                import_ms = statistics.median(r['import_ms'] for r in results)
+                triggers_ms = statistics.median(r['triggers_ms'] for r in results)
+                print(f'{scale:>9} {mode:>6} {import_ms:>10.0f} {triggers_ms:>12.0f} {import_ms + triggers_ms:>9.0f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='0,1000,10000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', nargs=2, metavar=('WORDS', 'INDEX'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+    else:
+        run([int(x) for x in args.scales.split(',')], args.repeat, args.seed)
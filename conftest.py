@@ -0,0 +1,124 @@
+import re
+import sys
+import sqlite3
+import importlib
+
+import pytest
+
+# config.py is local to each deployment, without one the tests run on the defaults of _config.py
+try:
+    import config
+except ImportError:
+    sys.modules['config'] = importlib.import_module('_config')
+
+'''
+infra.mysql on an in-memory SQLite database, for the tests of the ORM and of what is built on it
+
+Statements are translated as far as the ORM needs: `%s` placeholders, upserts,
+and secondary keys. String columns compare as under MySQL's default collations,
+case-insensitive and ignoring trailing spaces.
+'''
+def _mysql_collation(a: str, b: str) -> int:
+    a, b = a.casefold().rstrip(' '), b.casefold().rstrip(' ')
+    return (a > b) - (a < b)
+
+def _sqlite(sql: str) -> str:
+    sql = sql.replace('%s', '?')
+    sql = re.sub(r', KEY \(\w+\)', '', sql)
+    sql = re.sub(r'(varchar\(\d+\)) NOT NULL', r'\1 NOT NULL COLLATE mysql', sql)
+    head, upsert, tail = sql.partition(' on duplicate key update ')
+    if upsert:
+        sql = head + ' on conflict do update set ' + re.sub(r'values\((`?\w+`?)\)', r'excluded.\1', tail)
+    return sql
+
+class _Cursor:
+    def __init__(self, db, dict_rows: bool):
+        self._cur = db.cursor()
+        self._dict_rows = dict_rows
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._cur.close()
+
+    async def execute(self, sql, args=()):
+        self._cur.execute(_sqlite(sql), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    async def executemany(self, sql, args_list):
+        self._cur.executemany(_sqlite(sql), [tuple(args) for args in args_list])
+        self.rowcount = self._cur.rowcount
+
+    def _row(self, row):
+        if self._dict_rows:
+            return { d[0]: v for d, v in zip(self._cur.description, row) }
+        return row
+
+    async def fetchall(self):
+        return [self._row(row) for row in self._cur.fetchall()]
+
+    async def fetchmany(self, size=None):
+        return [self._row(row) for row in self._cur.fetchmany(size or 1)]
+
+class _Connection:
+    def __init__(self, db):
+        self._db = db
+        self._began = False
+        self.closed = False
+
+    def cursor(self, cursor_class=None):
+        from aiomysql import DictCursor, SSDictCursor
+        return _Cursor(self._db, cursor_class in (DictCursor, SSDictCursor))
+
+    async def begin(self):
+        # one database behind every connection, a transaction already open is joined
+        if not self._db.in_transaction:
+            self._db.execute('BEGIN')
+            self._began = True
+
+    async def commit(self):
+        if self._began:
+            self._db.execute('COMMIT')
+            self._began = False
+
+    async def rollback(self):
+        if self._began:
+            self._db.execute('ROLLBACK')
+            self._began = False
+
+    async def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class SQLitePool:
+    size = freesize = minsize = maxsize = 1
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        self.db.create_collation('mysql', _mysql_collation)
+
+    async def acquire(self):
+        return _Connection(self.db)
+
+    async def release(self, conn):
+        pass
+
+    def create(self, *models):
+        for model in models:
+            self.db.execute(_sqlite(model.__create_stmt__))
+
+    def close(self):
+        self.db.close()
+
+@pytest.fixture
+def mysql_pool():
+    from infra import mysql
+    pool = SQLitePool()
+    mysql.set_pool(pool)
+    yield pool
+    mysql.set_pool(None)
+    pool.close()
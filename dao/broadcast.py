@@ -0,0 +1,47 @@
+from infra.mysql import Model, IntegerField, StringField, TextField
+
+# Template message broadcasts, see service/broadcast_service.py
+class Broadcast(Model):
+    __table__ = 'broadcast'
+    __indexes__ = ('status',)
+
+    broadcast_id = StringField(primary_key=True, ddl='varchar(64)')
+    template_id = StringField(ddl='varchar(64)')
+    # JSON of the template data, the same for every recipient
+    template_data = TextField(default='{}')
+    url = StringField(default='', ddl='varchar(1024)')
+    # recipients are the `audience_field` of the rows of `audience_model` matching `audience_where`
+    audience_model = StringField(ddl='varchar(255)')
+    audience_where = StringField(default='', ddl='varchar(1024)')
+    # JSON list
+    audience_args = StringField(default='[]', ddl='varchar(1024)')
+    audience_field = StringField(ddl='varchar(64)')
+    # running, done, cancelled
+    status = StringField(ddl='varchar(16)')
+    # JSON of the audience primary key the sends went up to
+    checkpoint = StringField(default='', ddl='varchar(255)')
+    total = IntegerField()
+    sent = IntegerField()
+    failed = IntegerField()
+    # worker running the broadcast, and when it took it over with how many sends done
+    owner = StringField(default='', ddl='varchar(128)')
+    started_at = IntegerField()
+    started_from = IntegerField()
+    # epoch milliseconds
+    created_at = IntegerField()
+    updated_at = IntegerField()
+
+# Result of a broadcast for one recipient, or a recipient still pending of an audience given as a list
+class BroadcastRecipient(Model):
+    __table__ = 'broadcast_recipient'
+    __indexes__ = ('broadcast_id',)
+
+    # broadcast_id:open_id
+    recipient_id = StringField(primary_key=True, ddl='varchar(128)')
+    broadcast_id = StringField(ddl='varchar(64)')
+    open_id = StringField(ddl='varchar(64)')
+    # pending, sent, failed
+    status = StringField(ddl='varchar(16)')
+    errcode = IntegerField()
+    msg_id = IntegerField()
+    updated_at = IntegerField()
\ No newline at end of file
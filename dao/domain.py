@@ -1,8 +1,10 @@
-from infra.mysql import Model, StringField
+from infra.mysql import Model, ModelCache, StringField
 
 # Sample ORM
 class User(Model):
     __table__ = 'user'
+    # looked up on every message, cached for five minutes
+    __cache__ = ModelCache(maxsize=10000, ttl=300, negative_ttl=30)
 
     open_id = StringField(primary_key=True)
     user_name = StringField()
\ No newline at end of file
@@ -0,0 +1,23 @@
+from infra.mysql import Model, IntegerField, StringField, TextField
+
+# Delayed and recurring jobs, see service/job_service.py
+class Job(Model):
+    __table__ = 'scheduled_job'
+    # due jobs are loaded by run_at, jobs changed by other workers by updated_at
+    __indexes__ = ('run_at', 'updated_at', 'user_id')
+
+    job_id = StringField(primary_key=True, ddl='varchar(64)')
+    handler_name = StringField(ddl='varchar(64)')
+    user_id = StringField(default='')
+    # JSON passed to the handler
+    payload = TextField(default='{}')
+    # epoch seconds of the next run
+    run_at = IntegerField()
+    # seconds between runs of a recurring job, 0 for none
+    interval_seconds = IntegerField()
+    # JSON of apscheduler CronTrigger fields of a recurring job, '' for none
+    cron = StringField(default='', ddl='varchar(255)')
+    # failed runs in a row
+    attempts = IntegerField()
+    # epoch milliseconds of the last change
+    updated_at = IntegerField()
\ No newline at end of file
@@ -1,12 +1,19 @@
-import json
+import logging
+from time import perf_counter
 from functools import wraps
-from wechatpy import parse_message, create_reply
+from wechatpy import create_reply
 from wechatpy.messages import BaseMessage
 from typing import List
 from json.decoder import JSONDecodeError
 
+import config
+
+from infra import metrics
 from infra.wechat import get_wx_client
+from infra.worker_pool import get_worker_pool
 from dispatcher.core import TriggerFunction, dispatcher
+from dispatcher.dedup import deduplicator, message_key
+from dispatcher.message import parse_message
 from utils.logger import logger
 
 ''' Sample Message
@@ -25,9 +32,9 @@ from utils.logger import logger
 
 def dispatcher_error_handler(func):
     @wraps(func)
-    async def wrapper(msg):
+    async def wrapper(*args):
         try:
-            return await func(msg)
+            return await func(*args)
         except (JSONDecodeError, KeyError) as e:
             logger.exception('400: Bad request')
             #return create_reply('400: Bad request', msg)
@@ -37,18 +44,18 @@ def dispatcher_error_handler(func):
     return wrapper
 
 def message_preprocess(msg):
+    if metrics.enabled:
+        start = perf_counter()
     msg = parse_message(msg)
-    logger.info(f'Receive message {msg.id}: {msg}')
+    if metrics.enabled:
+        metrics.set_current_message(msg)
+        metrics.observe_stage('parse', start, msg)
+    logger.info(f'Receive {msg.type} message {msg.id} from {msg.source}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Message {msg.id}: {msg}')
     key_list = [msg.type]
-    etype = None
-    
     if msg.type == "event":
-        if msg.event in ['subscribe_scan', 'scan']:
-            event_body = json.loads(msg.scene_id)
-            etype = event_body.get('etype')
         key_list.append(msg.event)
-
-    msg.__setattr__('_etype', etype)
     return msg, key_list
 
 async def invoke_trigger_function(tf, msg):
@@ -57,17 +64,61 @@ async def invoke_trigger_function(tf, msg):
         reply_str = None
     else:
         logger.info(f'Message {msg.id} triggered {tf.__name__}')
+        if metrics.enabled:
+            start = perf_counter()
         reply_str = await tf.func(get_wx_client(), msg)
+        if metrics.enabled:
+            metrics.observe_stage('handler', start, msg, tf)
     return create_reply(reply_str, msg)
 
+async def route_message(msg, key_list):
+    if metrics.enabled:
+        start = perf_counter()
+    tf = dispatcher.find_trigger_function(key_list, msg)
+    if metrics.enabled:
+        metrics.observe_stage('route', start, msg, tf)
+        metrics.count_message(msg, tf)
+    return await invoke_trigger_function(tf, msg)
+
 @dispatcher_error_handler
 async def msg_dispatcher(msg):
     msg, key_list = message_preprocess(msg)
-    tf = dispatcher.find_trigger_function(key_list, msg)
-    return await invoke_trigger_function(tf, msg)
+    return await deduplicator.run(message_key(msg), lambda: route_message(msg, key_list))
+
+@dispatcher_error_handler
+async def _route_queued_message(key, msg, key_list):
+    # the request is already acknowledged, so a passive reply cannot be delivered
+    try:
+        await route_message(msg, key_list)
+    finally:
+        deduplicator.complete(key, None)
+
+@dispatcher_error_handler
+async def msg_enqueuer(msg) -> bool:
+    '''
+    Parse the message and queue it for the worker pool instead of handling it inline
+    Messages from the same user are handled in order
+    Return False if the queue is full and the message is shed
+    '''
+    msg, key_list = message_preprocess(msg)
+    key = message_key(msg)
+    if deduplicator.claim(key) != None:
+        logger.info(f'Message {key} is a retry, already queued')
+        return True
+    accepted = get_worker_pool().submit(msg.source, lambda: _route_queued_message(key, msg, key_list))
+    if not accepted:
+        deduplicator.forget(key)
+        logger.warning(f'Message {msg.id} is shed: dispatch queue is full')
+    return accepted
 
 '''
 import submodules here
 '''
 from . import common
-from . import subscription
\ No newline at end of file
+from . import subscription
+
+'''
+compile the dispatcher tree once all submodules have registered their handlers
+'''
+TRIGGER_INDEX = getattr(config, 'TRIGGER_INDEX', None)
+dispatcher.freeze(TRIGGER_INDEX.PATH if TRIGGER_INDEX != None else None)
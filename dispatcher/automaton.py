@@ -0,0 +1,105 @@
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+'''
+Aho-Corasick automaton
+
+All patterns are compiled into one trie with failure links, so a single pass
+over the text finds every pattern it contains, no matter how many patterns
+are registered. Patterns are identified by their insertion index, and the
+lowest index wins when several patterns occur in the same text.
+'''
+_NO_MATCH = float('inf')
+
+class AhoCorasick:
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        self._best: List[float] = [_NO_MATCH]
+        self._built = False
+        for pattern in patterns:
+            self.add(pattern)
+        self.build()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, pattern: str) -> int:
+        if self._built:
+            raise RuntimeError('Cannot add pattern to a built automaton')
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._best.append(_NO_MATCH)
+            state = nxt
+        index = len(self.patterns)
+        self.patterns.append(pattern)
+        self._out[state].append(index)
+        if index < self._best[state]:
+            self._best[state] = index
+        return index
+
+    def build(self):
+        '''
+        Compute failure links breadth-first, then merge outputs along them
+        so that each state knows every pattern ending at it
+        '''
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fail
+                self._out[nxt] = self._out[nxt] + self._out[fail]
+                if self._best[fail] < self._best[nxt]:
+                    self._best[nxt] = self._best[fail]
+        self._built = True
+
+    def first(self, text: str) -> Optional[int]:
+        '''
+        Return the lowest index of the patterns occurring in text
+        '''
+        goto, fail, best_of = self._goto, self._fail, self._best
+        best = best_of[0]
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best_of[state] < best:
+                best = best_of[state]
+                if best == 0:
+                    break
+        if best == _NO_MATCH:
+            return None
+        return best
+
+    def find_all(self, text: str) -> Set[int]:
+        '''
+        Return the indexes of all patterns occurring in text
+        '''
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(out[0])
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
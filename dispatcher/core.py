@@ -1,4 +1,5 @@
 from utils.logger import logger
+import re
 from typing import List, Union
 from functools import wraps
 
@@ -37,14 +38,29 @@ dispatcher / DispatcherNode
 │          └── EtypeTrigger
 └── ...
 '''
+class DispatcherFrozenError(RuntimeError):
+    pass
+
 class DispatcherNode(dict):
+    # attribute names of the triggers of this node, in matching order
+    _trigger_names = ()
+
     def __init__(self, name=None):
         self.__name = name
+        self._frozen = False
+        self._route_table = None
+        # (trigger name, key, tf) registered but not added to the trigger yet
+        self._pending = []
 
     def get_name(self) -> str:
         return self.__name 
 
     def find_trigger_function(self, key_list: List[str], msg: BaseMessage) -> TriggerFunction:
+        if self._route_table is not None:
+            find_tf = self._route_table.get(tuple(key_list))
+            if find_tf is None:
+                return None
+            return find_tf(msg)
         reversed_key_list = list(key_list)
         reversed_key_list.reverse()
         return self._find_trigger_function(reversed_key_list, msg)
@@ -60,25 +76,98 @@ class DispatcherNode(dict):
     def _self_find_tf(self, msg):
         raise NotImplementedError
 
+    def freeze(self, index_path: str = None):
+        '''
+        Compile the tree into a flat `key path -> matcher` table
+        Call it once all handlers are registered, registering afterwards raises DispatcherFrozenError
+        With `index_path`, the compiled triggers are loaded from that file if it was
+        written for the same registrations, and written to it otherwise
+        '''
+        from .index import load_index, save_index
+        nodes = list(self._walk())
+        registrations = [(node.get_name(), name, key, tf) for node in nodes for name, key, tf in node._pending]
+        if index_path == None or not load_index(index_path, registrations, nodes):
+            for node in nodes:
+                node._apply_pending()
+                node._compile_triggers()
+            if index_path != None:
+                save_index(index_path, registrations, nodes)
+        for node in nodes:
+            node._pending = []
+        route_table = {}
+        self._compile_routes((), route_table)
+        self._route_table = route_table
+        logger.info(f'"{self.get_name()}" frozen with {len(route_table)} routes and {len(registrations)} triggers')
+
+    def is_frozen(self) -> bool:
+        return self._frozen
+
+    def _walk(self):
+        yield self
+        for node in self.values():
+            yield from node._walk()
+
+    def _register(self, trigger_name: str, keys, tf: TriggerFunction):
+        # added to the trigger on freeze, which may load the compiled triggers instead
+        if not isinstance(keys, (list, tuple, set, frozenset)):
+            keys = [keys]
+        for key in keys:
+            self._pending.append((trigger_name, key, tf))
+
+    def _apply_pending(self):
+        pending, self._pending = self._pending, []
+        for trigger_name, key, tf in pending:
+            getattr(self, trigger_name).add(key, tf)
+
+    def get_triggers(self) -> dict:
+        return { name: getattr(self, name) for name in self._trigger_names }
+
+    def set_triggers(self, triggers: dict):
+        for name in self._trigger_names:
+            setattr(self, name, triggers[name])
+
+    def _compile_triggers(self):
+        for trigger in self.get_triggers().values():
+            trigger.compile()
+
+    def _compile_routes(self, path: tuple, route_table: dict):
+        self._frozen = True
+        route_table[path] = self._self_find_tf
+        for key, node in self.items():
+            node._compile_routes(path + (key,), route_table)
+
+    def _ensure_mutable(self):
+        if self._frozen:
+            raise DispatcherFrozenError(f'Cannot register handler to "{self.get_name()}": dispatcher is frozen')
+
     def __getattr__(self, name):
         return self[name]
 
 class EventDispatcherNode(DispatcherNode):
+    _trigger_names = ('_etype_triggers',)
+
     def __init__(self, name=None):
         super().__init__(name)
         self._etype_triggers = EtypeTrigger()
     
     def _self_find_tf(self, msg):
+        if self._pending:
+            self._apply_pending()
         return self._etype_triggers.find_handler(msg)
+
+    def _compile_routes(self, path: tuple, route_table: dict):
+        super()._compile_routes(path, route_table)
+        route_table[path] = self._etype_triggers.find_handler
     
     def on_etype(self, etype):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            self._etype_triggers.add(etype, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as EtypeTrigger "{etype}"')
+            tf = TriggerFunction(wrapper, 'etype')
+            self._register('_etype_triggers', etype, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as EtypeTrigger "{etype}"')
             return func
         return deco
 
@@ -86,6 +175,8 @@ class EventDispatcherNode(DispatcherNode):
         return self.on_etype('*')(func)
 
 class TextDispatcherNode(DispatcherNode):
+    _trigger_names = ('_prefix_triggers', '_suffix_triggers', '_keyword_triggers', '_rex_triggers', '_etype_triggers')
+
     def __init__(self, name=None):
         super().__init__(name)
         self._prefix_triggers = PrefixTrigger()
@@ -93,103 +184,106 @@ class TextDispatcherNode(DispatcherNode):
         self._keyword_triggers = KeywordTrigger()
         self._rex_triggers = RexTrigger()
         self._etype_triggers = EtypeTrigger()
-        self._trigger_chain: List[BaseTrigger] = [ self._prefix_triggers, self._suffix_triggers, self._keyword_triggers, self._rex_triggers, self._etype_triggers ]
     
+    @property
+    def _trigger_chain(self) -> List[BaseTrigger]:
+        return list(self.get_triggers().values())
+
     def _self_find_tf(self, msg):
+        if self._pending:
+            self._apply_pending()
         for trigger in self._trigger_chain:
             tf = trigger.find_handler(msg)
             if tf:
                 return tf
         return None
+
+    def _compile_routes(self, path: tuple, route_table: dict):
+        super()._compile_routes(path, route_table)
+        # empty triggers can never match, so they are left out of the chain
+        handlers = tuple(trigger.find_handler for trigger in self._trigger_chain if len(trigger))
+        def match(msg):
+            for find_handler in handlers:
+                tf = find_handler(msg)
+                if tf:
+                    return tf
+            return None
+        route_table[path] = match
     
     def on_prefix(self, prefix: Union[str, List[str]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            if type(prefix) != list:
-                self._prefix_triggers.add(prefix, tf)
-            else:
-                for p in prefix:
-                    self._prefix_triggers.add(p, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as PrefixTrigger "{prefix}"')
+            tf = TriggerFunction(wrapper, 'prefix')
+            self._register('_prefix_triggers', prefix, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as PrefixTrigger "{prefix}"')
             return func
         return deco
     
     def on_fullmatch(self, fullmatch: Union[str, List[str]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 if msg.param.remain != '':
                     logger.info(f'Message {msg.id} is ignored by fullmatch condition')
                     return
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            if type(fullmatch) != list:
-                # on_fullmatch uses prefix trigger
-                # so on_fullmatch may conflict with on_prefix
-                self._prefix_triggers.add(fullmatch, tf)
-            else:
-                for f in fullmatch:
-                    self._prefix_triggers.add(f, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as FullmatchTrigger "{fullmatch}"')
+            tf = TriggerFunction(wrapper, 'fullmatch')
+            # on_fullmatch uses prefix trigger
+            # so on_fullmatch may conflict with on_prefix
+            self._register('_prefix_triggers', fullmatch, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as FullmatchTrigger "{fullmatch}"')
             return func
         return deco
     
     def on_suffix(self, suffix: Union[str, List[str]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            if type(suffix) != list:
-                self._suffix_triggers.add(suffix, tf)
-            else:
-                for s in suffix:
-                    self._suffix_triggers.add(s, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as SuffixTrigger "{suffix}"')
+            tf = TriggerFunction(wrapper, 'suffix')
+            self._register('_suffix_triggers', suffix, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as SuffixTrigger "{suffix}"')
             return func
         return deco
     
     def on_keyword(self, keyword: Union[str, List[str]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            if type(keyword) != list:
-                self._keyword_triggers.add(keyword, tf)
-            else:
-                for k in keyword:
-                    self._keyword_triggers.add(k, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as KeywordTrigger "{keyword}"')
+            tf = TriggerFunction(wrapper, 'keyword')
+            self._register('_keyword_triggers', keyword, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as KeywordTrigger "{keyword}"')
             return func
         return deco
     
-    def on_rex(self, rex: Union[str, List[str]]):
+    def on_rex(self, rex: Union[str, re.Pattern, List[Union[str, re.Pattern]]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            self._rex_triggers.add(rex, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as RexTrigger "{rex}"')
+            tf = TriggerFunction(wrapper, 'rex')
+            self._register('_rex_triggers', rex, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as RexTrigger "{rex}"')
             return func
         return deco
     
     def on_etype(self, etype: Union[str, List[str]]):
         def deco(func):
+            self._ensure_mutable()
             @wraps(func)
             async def wrapper(client, msg):
                 return await func(client, msg)
-            tf = TriggerFunction(wrapper)
-            if type(etype) != list:
-                self._etype_triggers.add(etype, tf)
-            else:
-                for c in etype:
-                    self._etype_triggers.add(c, tf)
-            logger.info(f'"{func.__name__}" registered to "{self.get_name()}" as EtypeTrigger "{etype}"')
+            tf = TriggerFunction(wrapper, 'etype')
+            self._register('_etype_triggers', etype, tf)
+            logger.debug(f'"{func.__name__}" registered to "{self.get_name()}" as EtypeTrigger "{etype}"')
             return func
         return deco
 
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+import config
+from utils.cache import TTLCache
+from utils.logger import logger
+
+'''
+WeChat retries a message up to three times when the reply is slow
+Each message key maps to a future of its reply, so a retry of a message
+in flight or recently handled gets the same reply without running the handler again
+'''
+def message_key(msg) -> str:
+    if msg.id:
+        return str(msg.id)
+    # events carry no MsgId, WeChat suggests FromUserName + CreateTime instead
+    return f'{msg.source}:{msg.time}'
+
+class MessageDeduplicator:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self._replies = TTLCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def claim(self, key: str) -> Optional[asyncio.Future]:
+        '''
+        Return the reply future if the key is already claimed, otherwise claim it and return None
+        '''
+        future = self._replies.get(key)
+        if future is not None:
+            self.hits += 1
+            return future
+        self.misses += 1
+        self._replies.set(key, asyncio.get_event_loop().create_future())
+        return None
+
+    def complete(self, key: str, reply):
+        future = self._replies.get(key)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def forget(self, key: str):
+        '''
+        Release the key so the next retry is handled again, waiting retries get no reply
+        '''
+        future = self._replies.pop(key)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def run(self, key: str, func: Callable[[], Awaitable]):
+        future = self.claim(key)
+        if future is not None:
+            logger.info(f'Message {key} is a retry, reuse its reply')
+            return await asyncio.shield(future)
+        try:
+            reply = await func()
+        except BaseException:
+            self.forget(key)
+            raise
+        self.complete(key, reply)
+        return reply
+
+    def stats(self) -> dict:
+        return { 'size': len(self._replies), 'hits': self.hits, 'misses': self.misses }
+
+_dedup_config = getattr(config, 'DEDUP', None)
+if _dedup_config == None:
+    deduplicator = MessageDeduplicator()
+else:
+    deduplicator = MessageDeduplicator(_dedup_config.MAX_SIZE, _dedup_config.TTL)
@@ -0,0 +1,147 @@
+import io
+import os
+import sys
+import hmac
+import pickle
+import hashlib
+from typing import List
+
+from utils.logger import logger
+from utils.private_file import open_private
+from .trigger import TriggerFunction
+
+'''
+Compiled trigger index persisted across restarts
+
+Registering a trigger converts and normalizes its key, and freezing builds the
+tries and automata, which takes seconds with large trigger sets. The compiled
+triggers of every node are pickled to a file, with each TriggerFunction stored
+as the position of its first registration, so the file holds plain data only.
+The file starts with a hash of the registrations (node, trigger, key, kind and
+handler name, in order); on the next boot the triggers are loaded from it if
+the hash matches, and rebuilt and written again otherwise.
+
+Unpickling runs code, so the file is guarded three ways: it must sit in a
+private directory and be private itself (see utils/private_file.py), its
+header carries an HMAC of its contents under a key kept in `<path>.key`,
+checked before anything is unpickled, and the unpickler only resolves the
+trigger classes.
+'''
+# bump whenever the layout of the trigger classes changes
+INDEX_VERSION = 2
+
+def registration_hash(registrations: list) -> str:
+    digest = hashlib.sha256(f'{INDEX_VERSION} {sys.version_info[:2]}'.encode())
+    for node_name, trigger_name, key, tf in registrations:
+        func = tf.func
+        digest.update(repr((node_name, trigger_name, key, tf.kind, func.__module__, func.__qualname__)).encode())
+    return digest.hexdigest()
+
+def _function_ids(registrations: list) -> dict:
+    ids = {}
+    for i, (_, _, _, tf) in enumerate(registrations):
+        ids.setdefault(id(tf), i)
+    return ids
+
+class _IndexPickler(pickle.Pickler):
+    def __init__(self, file, function_ids: dict):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._function_ids = function_ids
+
+    def persistent_id(self, obj):
+        if isinstance(obj, TriggerFunction):
+            return self._function_ids[id(obj)]
+        return None
+
+# classes the compiled triggers are made of, nothing else is unpickled
+_ALLOWED_CLASSES = {
+    ('dispatcher.trigger', 'EtypeTrigger'),
+    ('dispatcher.trigger', 'PrefixTrigger'),
+    ('dispatcher.trigger', 'SuffixTrigger'),
+    ('dispatcher.trigger', 'KeywordTrigger'),
+    ('dispatcher.trigger', 'RexTrigger'),
+    ('dispatcher.automaton', 'AhoCorasick'),
+    ('pygtrie', 'CharTrie'),
+    ('pygtrie', '_Node'),
+}
+
+class _IndexUnpickler(pickle.Unpickler):
+    def __init__(self, file, functions: List[TriggerFunction]):
+        super().__init__(file)
+        self._functions = functions
+
+    def persistent_load(self, pid):
+        return self._functions[pid]
+
+    def find_class(self, module, name):
+        if (module, name) not in _ALLOWED_CLASSES:
+            raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a trigger index')
+        return super().find_class(module, name)
+
+def _index_key(path: str, create: bool) -> bytes:
+    '''
+    The HMAC key of the index at `path`, generated when `create` is set and there is none
+    '''
+    fd = open_private(f'{path}.key', os.O_RDWR, create=create)
+    with os.fdopen(fd, 'r+b') as f:
+        key = f.read()
+        if len(key) < 32 and create:
+            key = os.urandom(32)
+            f.seek(0)
+            f.truncate()
+            f.write(key)
+    return key
+
+def _signature(key: bytes, header: str, payload: bytes) -> str:
+    return hmac.new(key, header.encode() + payload, hashlib.sha256).hexdigest()
+
+def save_index(path: str, registrations: list, nodes: list):
+    triggers = { node.get_name(): node.get_triggers() for node in nodes if node.get_triggers() }
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        payload = io.BytesIO()
+        _IndexPickler(payload, _function_ids(registrations)).dump(triggers)
+        payload = payload.getvalue()
+        header = registration_hash(registrations)
+        signature = _signature(_index_key(path, True), header, payload)
+        with os.fdopen(open_private(tmp_path, os.O_WRONLY | os.O_TRUNC), 'wb') as f:
+            f.write(f'{header} {signature}\n'.encode())
+            f.write(payload)
+        # other processes booting at the same time see the old file or the new one, never a partial one
+        os.replace(tmp_path, path)
+    except (OSError, pickle.PicklingError, KeyError):
+        logger.exception(f'Failed to save the trigger index to {path}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    logger.info(f'Trigger index saved to {path}')
+
+def load_index(path: str, registrations: list, nodes: list) -> bool:
+    '''
+    Set the triggers of `nodes` from the index at `path`
+    Return False if there is no index for these registrations
+    '''
+    try:
+        with os.fdopen(open_private(path, os.O_RDONLY, create=False), 'rb') as f:
+            header, _, signature = f.readline().decode('ascii').strip().partition(' ')
+            if header != registration_hash(registrations):
+                logger.info(f'Trigger index {path} is outdated, rebuilding')
+                return False
+            payload = f.read()
+        if not hmac.compare_digest(signature, _signature(_index_key(path, False), header, payload)):
+            logger.warning(f'Trigger index {path} fails its HMAC check, rebuilding')
+            return False
+        triggers = _IndexUnpickler(io.BytesIO(payload), [tf for _, _, _, tf in registrations]).load()
+    except FileNotFoundError:
+        return False
+    except PermissionError as e:
+        logger.error(f'Trigger index {path} refused, rebuilding: {e}')
+        return False
+    except Exception:
+        logger.exception(f'Failed to load the trigger index from {path}, rebuilding')
+        return False
+    for node in nodes:
+        if node.get_name() in triggers:
+            node.set_triggers(triggers[node.get_name()])
+    logger.info(f'Trigger index loaded from {path}')
+    return True
@@ -0,0 +1,88 @@
+import json
+from functools import cached_property
+from xml.etree import ElementTree
+
+from wechatpy import parse_message as parse_full_message
+from wechatpy.events import EVENT_TYPES
+from wechatpy.fields import StringField
+from wechatpy.messages import MESSAGE_TYPES, BaseMessage, UnknownMessage
+
+'''
+Inbound message parsed only as far as routing needs
+
+Only the routing fields (MsgType, Event, Content, EventKey, MsgId) and the
+header fields every reply needs are read up front. Any other attribute of the
+matching wechatpy message class is served by a full wechatpy message, parsed
+the first time a handler touches such an attribute. The JSON payload of
+scene_id is parsed on first access as well.
+'''
+_EAGER_TAGS = frozenset(('MsgType', 'Event', 'EventKey', 'Content', 'MsgId', 'FromUserName', 'ToUserName', 'CreateTime'))
+
+def _resolve_message_class(data: dict):
+    # same rules as wechatpy.parse_message, applied to the routing fields only
+    message_type = (data.get('MsgType') or '').lower()
+    event_type = None
+    if message_type == 'event' or message_type.startswith('device_'):
+        if data.get('Event') is not None:
+            event_type = data['Event'].lower()
+        if event_type is None and message_type.startswith('device_'):
+            event_type = message_type
+        elif message_type.startswith('device_'):
+            event_type = f'device_{event_type}'
+
+        if event_type == 'subscribe' and data.get('EventKey'):
+            event_key = data['EventKey']
+            if event_key.startswith(('scanbarcode|', 'scanimage|')):
+                event_type = 'subscribe_scan_product'
+                data['Event'] = event_type
+            elif event_key.startswith('qrscene_'):
+                event_type = 'subscribe_scan'
+                data['Event'] = event_type
+                data['EventKey'] = event_key[len('qrscene_'):]
+        return EVENT_TYPES.get(event_type, UnknownMessage)
+    return MESSAGE_TYPES.get(message_type, UnknownMessage)
+
+class LazyMessage(BaseMessage):
+    content = StringField('Content')
+    scene_id = StringField('EventKey')
+
+    def __init__(self, raw, data: dict, message_class):
+        super().__init__(data)
+        self._raw = raw
+        self._message_class = message_class
+        self.type = message_class.type
+        self.event = getattr(message_class, 'event', None)
+
+    @cached_property
+    def message(self) -> BaseMessage:
+        '''
+        The complete wechatpy message
+        '''
+        return parse_full_message(self._raw)
+
+    @cached_property
+    def scene(self):
+        '''
+        scene_id parsed as the JSON object described in dispatcher.dtype
+        '''
+        return json.loads(self.scene_id)
+
+    @cached_property
+    def _etype(self):
+        if self.type == 'event' and self.event in ['subscribe_scan', 'scan']:
+            return self.scene.get('etype')
+        return None
+
+    def __getattr__(self, name):
+        # only called for attributes not parsed up front
+        if name.startswith('_') or not hasattr(self._message_class, name):
+            raise AttributeError(f"'{self._message_class.__name__}' object has no attribute '{name}'")
+        return getattr(self.message, name)
+
+    def __repr__(self):
+        return f'{self._message_class.__name__}({self._data!r})'
+
+def parse_message(xml) -> LazyMessage:
+    root = ElementTree.fromstring(xml)
+    data = { child.tag: child.text for child in root if child.tag in _EAGER_TAGS }
+    return LazyMessage(xml, data, _resolve_message_class(data))
@@ -1,7 +1,8 @@
 from dispatcher.core import dispatcher
+from infra.outbound import get_outbound
 
 @dispatcher.event.subscribe
 @dispatcher.event.subscribe_scan
 async def subscrpition_hello_world(wx_client, event_msg):
     user_id = event_msg.source
-    wx_client.message.send_text(user_id=user_id, content='hello world')
\ No newline at end of file
+    get_outbound().send_text(user_id=user_id, content='hello world')
\ No newline at end of file
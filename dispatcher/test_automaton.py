@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from dispatcher.automaton import AhoCorasick
+from dispatcher.trigger import KeywordTrigger, TriggerFunction
+
+class _TextMessage:
+    def __init__(self, content):
+        self.content = content
+
+def _words(rnd, alphabet, count, max_length=4):
+    words = []
+    while len(words) < count:
+        word = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, max_length)))
+        if word not in words:
+            words.append(word)
+    return words
+
+def test_first_is_lowest_index_occurring():
+    rnd = random.Random(1)
+    # a small alphabet, so patterns overlap and nest in each other
+    patterns = _words(rnd, 'abc', 30)
+    automaton = AhoCorasick(patterns)
+    for _ in range(500):
+        text = ''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 12)))
+        expected = next((i for i, p in enumerate(patterns) if p in text), None)
+        assert automaton.first(text) == expected
+
+def test_find_all():
+    rnd = random.Random(2)
+    patterns = _words(rnd, 'abc', 30)
+    automaton = AhoCorasick(patterns)
+    for _ in range(500):
+        text = ''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 12)))
+        assert automaton.find_all(text) == { i for i, p in enumerate(patterns) if p in text }
+
+def test_empty():
+    automaton = AhoCorasick()
+    assert automaton.first('abc') is None
+    assert automaton.find_all('abc') == set()
+
+def test_add_after_build():
+    automaton = AhoCorasick(['a'])
+    with pytest.raises(RuntimeError):
+        automaton.add('b')
+
+def test_keyword_trigger_matches_dict_iteration():
+    rnd = random.Random(3)
+    trigger = KeywordTrigger()
+    for word in _words(rnd, 'abc', 40):
+        trigger.add(word, TriggerFunction(lambda: None, 'keyword'))
+    for _ in range(500):
+        msg = _TextMessage(''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 12))))
+        # the linear scan KeywordTrigger used before the automaton
+        expected = next((tf for kw, tf in trigger.allkw.items() if kw in msg.content), None)
+        assert trigger.find_handler(msg) is expected
+        if expected is not None:
+            assert msg.param.keyword in msg.content
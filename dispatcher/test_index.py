@@ -0,0 +1,151 @@
+import os
+import json
+import pickle
+import random
+from collections import OrderedDict
+
+import pytest
+
+from dispatcher import index
+from dispatcher.core import DispatcherFrozenError, init_dispatcher_tree, _dispatcher_structure
+from dispatcher.message import parse_message
+
+_HEADER = '<ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[user]]></FromUserName><CreateTime>1600000000</CreateTime>'
+_TEXT = '<xml>' + _HEADER + '<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[{}]]></Content><MsgId>1</MsgId></xml>'
+_EVENT = '<xml>' + _HEADER + '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[{}]]></Event>{}</xml>'
+_SCENE = json.dumps({ 'etype': 1 })
+
+WORDS = ['天气', '天', '气温', '你好', '好', '提醒我', '帮助', '帮', '搜索', '天气预报', '早安', '晚安']
+
+def _handler(name):
+    async def handler(client, msg):
+        return name
+    handler.__name__ = name
+    return handler
+
+def _build(words=WORDS):
+    tree = init_dispatcher_tree(_dispatcher_structure)
+    text = tree.text
+    for i, word in enumerate(words):
+        kind = ('prefix', 'suffix', 'keyword', 'rex')[i % 4]
+        register = {
+            'prefix': text.on_prefix,
+            'suffix': text.on_suffix,
+            'keyword': text.on_keyword,
+            'rex': lambda word: text.on_rex(f'{word}\\s*(\\d+)'),
+        }[kind]
+        register(word)(_handler(f'{kind}_{i}'))
+    text.on_etype(1)(_handler('text_etype'))
+    text(_handler('text_default'))
+    tree.event.subscribe(_handler('subscribe'))
+    tree.event.subscribe_scan.on_etype(1)(_handler('subscribe_scan'))
+    tree.event.scan.on_etype(1)(_handler('scan'))
+    tree.event.unsubscribe(_handler('unsubscribe'))
+    return tree
+
+def _messages():
+    rnd = random.Random(1)
+    chars = ''.join(WORDS) + '雨晴 123'
+    xmls = [_TEXT.format(''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 10)))) for _ in range(300)]
+    xmls += [_TEXT.format(word) for word in WORDS]
+    xmls += [
+        _EVENT.format('subscribe', ''),
+        _EVENT.format('subscribe', f'<EventKey><![CDATA[qrscene_{_SCENE}]]></EventKey>'),
+        _EVENT.format('SCAN', f'<EventKey><![CDATA[{_SCENE}]]></EventKey>'),
+        _EVENT.format('unsubscribe', ''),
+    ]
+    return xmls
+
+def _route(tree, xml):
+    msg = parse_message(xml)
+    key_list = [msg.type]
+    if msg.type == 'event':
+        key_list.append(msg.event)
+    tf = tree.find_trigger_function(key_list, msg)
+    return tf.__name__ if tf else None
+
+def _routes(tree):
+    return [_route(tree, xml) for xml in _messages()]
+
+def test_freeze_keeps_routing():
+    # an unfrozen tree walks the nodes, as before freeze existed
+    expected = _routes(_build())
+    tree = _build()
+    tree.freeze()
+    assert _routes(tree) == expected
+    assert len(set(expected)) > 5
+
+def test_register_after_freeze():
+    tree = _build()
+    tree.freeze()
+    with pytest.raises(DispatcherFrozenError):
+        tree.text.on_keyword('late')(_handler('late'))
+
+@pytest.fixture
+def loads(monkeypatch):
+    # the results of load_index, freeze imports it when it runs
+    results = []
+    load_index = index.load_index
+    def spy(*args):
+        results.append(load_index(*args))
+        return results[-1]
+    monkeypatch.setattr(index, 'load_index', spy)
+    return results
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'run' / 'triggers.idx')
+
+def test_index_round_trip(path, loads):
+    expected = _routes(_build())
+    _build().freeze(path)
+    tree = _build()
+    tree.freeze(path)
+    assert loads == [False, True]
+    assert _routes(tree) == expected
+
+def test_outdated_index_is_rebuilt(path, loads):
+    _build().freeze(path)
+    tree = _build(WORDS[:-1])
+    tree.freeze(path)
+    assert loads == [False, False]
+    assert _routes(tree) == _routes(_build(WORDS[:-1]))
+    # written again for the new registrations
+    _build(WORDS[:-1]).freeze(path)
+    assert loads[-1] == True
+
+def test_tampered_index_is_rejected(path, loads):
+    _build().freeze(path)
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        data[-10] ^= 0xff
+        f.seek(0)
+        f.write(data)
+    tree = _build()
+    tree.freeze(path)
+    assert loads == [False, False]
+    assert _routes(tree) == _routes(_build())
+
+def test_index_without_its_key_is_rejected(path, loads):
+    _build().freeze(path)
+    os.remove(f'{path}.key')
+    _build().freeze(path)
+    assert loads == [False, False]
+
+def test_signed_index_of_other_classes_is_rejected(path):
+    tree = _build()
+    nodes = list(tree._walk())
+    registrations = [(node.get_name(), name, key, tf) for node in nodes for name, key, tf in node._pending]
+    tree.freeze(path)
+    payload = pickle.dumps(OrderedDict())
+    header = index.registration_hash(registrations)
+    signature = index._signature(index._index_key(path, False), header, payload)
+    with open(path, 'wb') as f:
+        f.write(f'{header} {signature}\n'.encode() + payload)
+    assert index.load_index(path, registrations, nodes) == False
+
+def test_index_open_to_other_users_is_refused(path, loads):
+    _build().freeze(path)
+    os.chmod(os.path.dirname(path), 0o755)
+    _build().freeze(path)
+    assert loads == [False, False]
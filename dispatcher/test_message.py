@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from wechatpy import parse_message as parse_full_message
+
+from dispatcher.dedup import MessageDeduplicator, message_key
+from dispatcher.message import parse_message
+
+_HEADER = '<ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[user]]></FromUserName><CreateTime>1600000000</CreateTime>'
+TEXT = '<xml>' + _HEADER + '<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[hello]]></Content><MsgId>1234567890</MsgId></xml>'
+IMAGE = '<xml>' + _HEADER + '<MsgType><![CDATA[image]]></MsgType><PicUrl><![CDATA[http://example.com/a.png]]></PicUrl><MediaId><![CDATA[media]]></MediaId><MsgId>1234567891</MsgId></xml>'
+SUBSCRIBE_SCAN = '<xml>' + _HEADER + '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event><EventKey><![CDATA[qrscene_{"etype": "bind"}]]></EventKey><Ticket><![CDATA[ticket]]></Ticket></xml>'
+SCAN = '<xml>' + _HEADER + '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[SCAN]]></Event><EventKey><![CDATA[{"etype": "bind"}]]></EventKey><Ticket><![CDATA[ticket]]></Ticket></xml>'
+UNSUBSCRIBE = '<xml>' + _HEADER + '<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[unsubscribe]]></Event></xml>'
+
+@pytest.mark.parametrize('xml', [TEXT, IMAGE, SUBSCRIBE_SCAN, SCAN, UNSUBSCRIBE])
+def test_fields_match_wechatpy(xml):
+    lazy, full = parse_message(xml), parse_full_message(xml)
+    assert type(lazy.message) is type(full)
+    for name in ('id', 'source', 'target', 'time', 'type'):
+        assert getattr(lazy, name) == getattr(full, name)
+    assert getattr(lazy, 'event', None) == getattr(full, 'event', None)
+
+def test_routing_fields():
+    msg = parse_message(TEXT)
+    assert msg.content == 'hello'
+    assert 'message' not in msg.__dict__
+
+def test_other_fields_parse_on_first_access():
+    msg = parse_message(IMAGE)
+    assert msg.image == 'http://example.com/a.png'
+    assert msg.media_id == 'media'
+    assert 'message' in msg.__dict__
+
+def test_unknown_attribute():
+    with pytest.raises(AttributeError):
+        parse_message(TEXT).image
+
+def test_scene():
+    msg = parse_message(SUBSCRIBE_SCAN)
+    assert msg.event == 'subscribe_scan'
+    assert msg.scene == { 'etype': 'bind' }
+    assert msg._etype == 'bind'
+    assert parse_message(SCAN)._etype == 'bind'
+
+def test_message_key():
+    assert message_key(parse_message(TEXT)) == '1234567890'
+    # events carry no MsgId
+    event = parse_message(UNSUBSCRIBE)
+    assert message_key(event) == f'user:{event.time}'
+
+def test_duplicate_msg_id_runs_handler_once():
+    runs = []
+    async def handle():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return 'reply'
+    async def main():
+        dedup = MessageDeduplicator()
+        first = dedup.run(message_key(parse_message(TEXT)), handle)
+        # retried by WeChat while the first is still running, and once it is done
+        retry = dedup.run(message_key(parse_message(TEXT)), handle)
+        replies = await asyncio.gather(first, retry)
+        replies.append(await dedup.run(message_key(parse_message(TEXT)), handle))
+        return replies, dedup.stats()
+    replies, stats = asyncio.run(main())
+    assert replies == ['reply'] * 3
+    assert len(runs) == 1
+    assert stats['hits'] == 2
+
+def test_failed_handler_runs_again():
+    runs = []
+    async def handle():
+        runs.append(1)
+        if len(runs) == 1:
+            raise RuntimeError('failed')
+        return 'reply'
+    async def main():
+        dedup = MessageDeduplicator()
+        with pytest.raises(RuntimeError):
+            await dedup.run('key', handle)
+        return await dedup.run('key', handle)
+    assert asyncio.run(main()) == 'reply'
+    assert len(runs) == 2
@@ -0,0 +1,45 @@
+import re
+import random
+
+import pytest
+
+from dispatcher.trigger import RexTrigger, TriggerFunction, required_literal
+
+class _TextMessage:
+    def __init__(self, content):
+        self.content = content
+
+@pytest.mark.parametrize('pattern, literal', [
+    ('hello', 'hello'),
+    ('^天气(.*)$', '天气'),
+    (r'ab\d+cde', 'cde'),
+    ('(ab)+c', 'ab'),
+    ('a(?:bc)d', 'abcd'),
+    ('x*yz', 'yz'),
+    ('ab|cd', ''),
+    ('a?b', 'b'),
+    ('.*', ''),
+])
+def test_required_literal(pattern, literal):
+    assert required_literal(re.compile(pattern)) == literal
+
+def test_required_literal_ignorecase():
+    assert required_literal(re.compile('hello', re.IGNORECASE)) == ''
+
+PATTERNS = ['ab+c', 'b(ca)?', '^a', 'c$', 'a|d', 'bb', '(?i)AC', 'd{2}', r'\d', 'ca*b', 'abc', '[ab]c', 'x?da']
+
+def test_prefilter_matches_linear_search():
+    trigger = RexTrigger()
+    for pattern in PATTERNS:
+        trigger.add(pattern, TriggerFunction(lambda: None, 'rex'))
+    rnd = random.Random(1)
+    for _ in range(1000):
+        msg = _TextMessage(''.join(rnd.choice('abcdAC1') for _ in range(rnd.randint(0, 8))))
+        # the scan in registration order RexTrigger used before the prefilter
+        expected = next(((rex, tf) for rex, tf in trigger.allrex.items() if rex.search(msg.content)), None)
+        tf = trigger.find_handler(msg)
+        if expected is None:
+            assert tf is None
+        else:
+            assert tf is expected[1]
+            assert msg.param.match.group(0) == expected[0].search(msg.content).group(0)
@@ -1,10 +1,16 @@
 import re
 import pygtrie
-import zhconv
+from functools import cached_property
 from typing import List
 
-from utils.format import normalize_str
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+from utils.format import normalize_str, convert
 from utils.logger import logger
+from .automaton import AhoCorasick
 
 from wechatpy.messages import TextMessage, BaseMessage
 
@@ -14,15 +20,21 @@ others are designed for text message
 text message is a kind of event message
 '''
 class TriggerFunction:
-    def __init__(self, func):
+    def __init__(self, func, kind: str = None):
         self.func = func
         self.__name__ = func.__name__
+        # kind of the trigger it is registered to, a metrics label
+        self.kind = kind
 
 
 class BaseParameter:
     def __init__(self, msg:str):
         self.plain_text = msg
-        self.norm_text = normalize_str(msg)
+
+    @cached_property
+    def norm_text(self):
+        # normalized on first access, most handlers never read it
+        return normalize_str(self.plain_text)
 
 class PrefixHandlerParameter(BaseParameter):
     def __init__(self, msg:str, prefix):
@@ -54,13 +66,24 @@ class BaseTrigger:
     def add(self, x, tf: TriggerFunction):
         raise NotImplementedError
 
+    def compile(self):
+        '''
+        Prepare lookup structures once all handlers are added
+        '''
+        pass
+
     def find_handler(self, msg: BaseMessage):
         raise NotImplementedError
 
+    def __len__(self):
+        raise NotImplementedError
+
 class EtypeTrigger(BaseTrigger):
     def __init__(self):
         super().__init__()
         self.all_etype = {}
+        self._specific = None
+        self._default = None
     
     def add(self, etype, tf: TriggerFunction):
         if etype in self.all_etype:
@@ -68,15 +91,27 @@ class EtypeTrigger(BaseTrigger):
             logger.warning(f'Failed to add etype trigger `{etype}`: Conflicts between {tf.__name__} and {other.__name__}')
             return
         self.all_etype[etype] = tf
+        self._specific = None
         logger.debug(f'Succeed to add etype trigger `{etype}`')
+
+    def compile(self):
+        self._specific = { etype: tf for etype, tf in self.all_etype.items() if etype != '*' }
+        self._default = self.all_etype.get('*')
     
     def find_handler(self, msg: BaseMessage):
-        for etype in self.all_etype:
-            if etype == '*':
-                continue;
-            if etype == msg._etype:
-                return self.all_etype[etype]
-        return self.all_etype.get('*')
+        if self._specific is None:
+            self.compile()
+        if not self._specific:
+            return self._default
+        try:
+            tf = self._specific.get(msg._etype)
+        except TypeError:
+            # unhashable etype never equals a registered one
+            tf = None
+        return tf or self._default
+
+    def __len__(self):
+        return len(self.all_etype)
 
 
 class PrefixTrigger(BaseTrigger):
@@ -90,7 +125,7 @@ class PrefixTrigger(BaseTrigger):
             logger.warning(f'Failed to add prefix trigger `{prefix}`: Conflicts between {tf.__name__} and {other.__name__}')
             return
         self.trie[prefix] = tf
-        self.trie[zhconv.convert(prefix, "zh-hant")] = tf
+        self.trie[convert(prefix, "zh-hant")] = tf
         logger.debug(f'Succeed to add prefix trigger `{prefix}`')
 
     def find_handler(self, text_msg: TextMessage):
@@ -102,6 +137,9 @@ class PrefixTrigger(BaseTrigger):
         text_msg.__setattr__('param', PrefixHandlerParameter(raw_msg, prefix))
         return item.value
 
+    def __len__(self):
+        return len(self.trie)
+
 class SuffixTrigger(BaseTrigger):   
     def __init__(self):
         super().__init__()
@@ -114,7 +152,7 @@ class SuffixTrigger(BaseTrigger):
             logger.warning(f'Failed to add suffix trigger `{suffix}`: Conflicts between {tf.__name__} and {other.__name__}')
             return
         self.trie[suffix_r] = tf
-        self.trie[zhconv.convert(suffix_r, "zh-hant")] = tf
+        self.trie[convert(suffix_r, "zh-hant")] = tf
         logger.debug(f'Succeed to add suffix trigger `{suffix}`')
 
     def find_handler(self, text_msg: TextMessage):
@@ -126,10 +164,19 @@ class SuffixTrigger(BaseTrigger):
         text_msg.__setattr__('param', SuffixHandlerParameter(raw_msg, suffix))
         return item.value
 
+    def __len__(self):
+        return len(self.trie)
+
 class KeywordTrigger(BaseTrigger):
+    '''
+    All keywords are compiled into one Aho-Corasick automaton
+    If several keywords occur in a message, the earliest registered one wins
+    '''
     def __init__(self):
         super().__init__()
         self.allkw = {}
+        self._automaton = None
+        self._handlers = []
 
     def add(self, keyword: str, tf: TriggerFunction):
         keyword = normalize_str(keyword)
@@ -138,31 +185,130 @@ class KeywordTrigger(BaseTrigger):
             logger.warning(f'Failed to add keyword trigger `{keyword}`: Conflicts between {tf.__name__} and {other.__name__}')
             return
         self.allkw[keyword] = tf
-        self.allkw[zhconv.convert(keyword, "zh-hant")] = tf
+        self.allkw[convert(keyword, "zh-hant")] = tf
+        self._automaton = None
         logger.debug(f'Succeed to add keyword trigger `{keyword}`')
 
+    def compile(self):
+        self._automaton = AhoCorasick(self.allkw)
+        self._handlers = list(self.allkw.items())
+
     def find_handler(self, text_msg: TextMessage):
+        if self._automaton is None:
+            self.compile()
         raw_msg = text_msg.content
-        for kw in self.allkw:
-            if kw in raw_msg:
-                text_msg.__setattr__('param', KeywordHandlerParameter(raw_msg, kw))
-                return self.allkw[kw]
-        return None
+        index = self._automaton.first(raw_msg)
+        if index is None:
+            return None
+        kw, tf = self._handlers[index]
+        text_msg.__setattr__('param', KeywordHandlerParameter(raw_msg, kw))
+        return tf
+
+    def __len__(self):
+        return len(self.allkw)
 
 class RexTrigger(BaseTrigger):
+    '''
+    Each pattern is indexed by the longest literal any of its matches must contain
+    One automaton scan over the message tells which patterns can possibly match,
+    and only those are searched, still in registration order
+    '''
     def __init__(self):
         super().__init__()
         self.allrex = {}
+        self._prefilter = None
+        self._entries = []
+        self._literal_entries = []
+        self._unfiltered = []
       
     def add(self, rex: re.Pattern, tf: TriggerFunction):
+        if isinstance(rex, str):
+            rex = re.compile(rex)
         self.allrex[rex] = tf
+        self._prefilter = None
         logger.debug(f'Succeed to add rex trigger `{rex.pattern}`')
 
+    def compile(self):
+        self._entries = list(self.allrex.items())
+        self._unfiltered = []
+        literal_index = {}
+        self._literal_entries = []
+        for i, (rex, _) in enumerate(self._entries):
+            literal = required_literal(rex)
+            if not literal:
+                self._unfiltered.append(i)
+                continue
+            if literal not in literal_index:
+                literal_index[literal] = len(self._literal_entries)
+                self._literal_entries.append([])
+            self._literal_entries[literal_index[literal]].append(i)
+        self._prefilter = AhoCorasick(literal_index)
+
     def find_handler(self, text_msg: TextMessage):
+        if self._prefilter is None:
+            self.compile()
         raw_msg = text_msg.content
-        for rex in self.allrex:
+        candidates = list(self._unfiltered)
+        for i in self._prefilter.find_all(raw_msg):
+            candidates.extend(self._literal_entries[i])
+        candidates.sort()
+        for i in candidates:
+            rex, tf = self._entries[i]
+            if type(rex) is tuple:
+                # loaded from a trigger index, compiled on first use
+                rex = re.compile(*rex)
+                self._entries[i] = (rex, tf)
             match = rex.search(raw_msg)
             if match:
                 text_msg.__setattr__('param', RexHandlerParameter(raw_msg, match))
-                return self.allrex[rex]
+                return tf
         return None
+
+    def __getstate__(self):
+        # patterns are pickled as (pattern, flags), compiling thousands of them would dominate loading
+        state = self.__dict__.copy()
+        state['allrex'] = { (rex.pattern, rex.flags): tf for rex, tf in self.allrex.items() }
+        state['_entries'] = [(rex if type(rex) is tuple else (rex.pattern, rex.flags), tf) for rex, tf in self._entries]
+        return state
+
+    def __len__(self):
+        return len(self.allrex)
+
+def _inline_groups(parsed):
+    # a group is matched in place, so its items continue the enclosing sequence
+    for op, av in parsed:
+        if op is sre_constants.SUBPATTERN and not av[1] & re.IGNORECASE:
+            yield from _inline_groups(av[3])
+        else:
+            yield op, av
+
+def _literal_runs(parsed, runs: List[str]):
+    '''
+    Collect the runs of consecutive literal characters that every match of
+    the parsed pattern contains. Unknown constructs only end a run,
+    so the result can miss literals but never reports a wrong one.
+    '''
+    current = []
+    for op, av in _inline_groups(parsed):
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_repeat, _, sub = av
+            if min_repeat >= 1:
+                _literal_runs(sub, runs)
+        if current:
+            runs.append(''.join(current))
+            current = []
+    if current:
+        runs.append(''.join(current))
+
+def required_literal(rex: re.Pattern) -> str:
+    '''
+    Return the longest literal every match of rex must contain, or \'\' if none
+    '''
+    if not isinstance(rex.pattern, str) or rex.flags & re.IGNORECASE:
+        return ''
+    runs = []
+    _literal_runs(sre_parse.parse(rex.pattern, rex.flags), runs)
+    return max(runs, key=len, default='')
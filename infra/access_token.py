@@ -0,0 +1,175 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils.logger import logger
+from utils.private_file import open_private, private_file
+
+'''
+access_token management shared by every worker process on the host
+
+Tokens live in a SQLite file, and refreshes are serialized by an exclusive
+file lock, so workers reuse each other's tokens instead of invalidating them.
+Within a process a refresh is single-flight: concurrent callers await the
+refresh in progress. The store is read and written on the default executor,
+as the lock is taken there, so the event loop never waits on the disk. A
+background task refreshes the token `refresh_margin` seconds before it
+expires, so requests rarely wait for a refresh at all.
+'''
+Token = Tuple[str, float]
+
+class MemoryTokenStore:
+    '''
+    Per-process store, used when no host-wide store is configured
+    '''
+    def __init__(self):
+        self._tokens = {}
+
+    def get(self, appid) -> Optional[Token]:
+        return self._tokens.get(appid)
+
+    def set(self, appid, token: str, expires_at: float):
+        self._tokens[appid] = (token, expires_at)
+
+    @contextmanager
+    def lock(self, appid):
+        yield
+
+class SQLiteTokenStore:
+    '''
+    The token is a secret: the file and its lock files are created with mode 0600
+    in a private directory, and refused if another user owns or may write them
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        # called from executor threads, one at a time
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # sqlite connections must not cross a fork, so each process opens its own
+        if self._conn == None or self._pid != os.getpid():
+            # the WAL and shared memory files get the mode of the database
+            private_file(self.path)
+            self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS access_token (appid TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, appid) -> Optional[Token]:
+        with self._lock:
+            row = self._connection().execute('SELECT token, expires_at FROM access_token WHERE appid=?', (appid,)).fetchone()
+        if row == None:
+            return None
+        return row[0], row[1]
+
+    def set(self, appid, token: str, expires_at: float):
+        with self._lock:
+            self._connection().execute('INSERT OR REPLACE INTO access_token (appid, token, expires_at) VALUES (?, ?, ?)', (appid, token, expires_at))
+
+    @contextmanager
+    def lock(self, appid):
+        if fcntl == None:
+            yield
+            return
+        with os.fdopen(open_private(f'{self.path}.{appid}.lock', os.O_WRONLY | os.O_APPEND), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class AccessTokenManager:
+    def __init__(self, appid, fetch: Callable[[], Awaitable[dict]], store=None, refresh_margin=300, check_interval=60):
+        self.appid = appid
+        self._fetch = fetch
+        self.store = store or MemoryTokenStore()
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self._token: Optional[Token] = None
+        self._inflight: Optional[asyncio.Future] = None
+        self._task = None
+
+    def _fresh(self, token: Optional[Token]) -> bool:
+        return token != None and token[1] - time.time() > self.refresh_margin
+
+    async def get_token(self) -> str:
+        if self._fresh(self._token):
+            return self._token[0]
+        return await self.refresh()
+
+    async def refresh(self, stale_token: Optional[str] = None) -> str:
+        '''
+        Make sure a fresh token is held, fetching one if no worker has
+        `stale_token` is a token WeChat rejected, which must not be reused
+        '''
+        for _ in range(2):
+            started = self._inflight == None
+            if started:
+                self._inflight = asyncio.ensure_future(self._refresh(stale_token))
+                self._inflight.add_done_callback(self._clear_inflight)
+            token = await asyncio.shield(self._inflight)
+            # a refresh joined midway may predate the rejection of stale_token, one
+            # started here fetched after it, and WeChat may hand out the same token again
+            if stale_token == None or token != stale_token or started:
+                return token
+        return token
+
+    def _clear_inflight(self, future):
+        self._inflight = None
+
+    def _usable(self, token: Optional[Token], stale_token: Optional[str]) -> bool:
+        return self._fresh(token) and token[0] != stale_token
+
+    async def _refresh(self, stale_token: Optional[str]) -> str:
+        loop = asyncio.get_event_loop()
+        stored = await loop.run_in_executor(None, self.store.get, self.appid)
+        if self._usable(stored, stale_token):
+            self._token = stored
+            return stored[0]
+        lock = self.store.lock(self.appid)
+        await loop.run_in_executor(None, lock.__enter__)
+        try:
+            # another worker may have refreshed while this one waited for the lock
+            stored = await loop.run_in_executor(None, self.store.get, self.appid)
+            if self._usable(stored, stale_token):
+                self._token = stored
+                return stored[0]
+            res = await self._fetch()
+            token = (res['access_token'], time.time() + res.get('expires_in', 7200))
+            await loop.run_in_executor(None, self.store.set, self.appid, *token)
+            self._token = token
+            logger.info(f'<infra> access_token of {self.appid} refreshed, expires in {res.get("expires_in")}s')
+            return token[0]
+        finally:
+            lock.__exit__(None, None, None)
+
+    async def _keep_fresh(self):
+        while True:
+            try:
+                await self.get_token()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f'<infra> failed to refresh access_token of {self.appid}')
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._keep_fresh())
+
+    async def stop(self):
+        if self._task != None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,229 @@
+import json
+import urllib.parse
+from time import perf_counter
+
+import httpx
+from wechatpy.exceptions import WeChatClientException
+
+from infra import metrics
+from infra.access_token import AccessTokenManager
+from utils.logger import logger
+
+'''
+Asynchronous WeChat official account API client
+
+Mirrors the subset of wechatpy.client.WeChatClient used by this project,
+but every API call is a coroutine sharing one pooled httpx.AsyncClient,
+so a slow WeChat API call only suspends its own request.
+
+    client = AsyncWeChatClient(APP_ID, APP_SECRET)
+    await client.message.send_text(user_id=open_id, content='hello world')
+'''
+API_BASE_URL = 'https://api.weixin.qq.com/cgi-bin/'
+
+# access_token is invalid or expired, refresh it and retry once
+TOKEN_EXPIRED_CODES = (40001, 40014, 42001)
+
+def http2_available() -> bool:
+    try:
+        import h2
+    except ImportError:
+        return False
+    return True
+
+class BaseAsyncAPI:
+    def __init__(self, client):
+        self._client = client
+
+    async def _get(self, url, **kwargs):
+        return await self._client.get(url, **kwargs)
+
+    async def _post(self, url, **kwargs):
+        return await self._client.post(url, **kwargs)
+
+class AsyncMessageAPI(BaseAsyncAPI):
+    '''
+    Customer service messages, only deliverable within 48 hours of the user's last interaction
+    '''
+    async def send(self, user_id, msg_type, body: dict, account=None, **kwargs):
+        data = {
+            'touser': user_id,
+            'msgtype': msg_type,
+            msg_type: body,
+        }
+        if account:
+            data['customservice'] = {'kf_account': account}
+        return await self._post('message/custom/send', data=data, **kwargs)
+
+    async def send_text(self, user_id, content, account=None, **kwargs):
+        return await self.send(user_id, 'text', {'content': content}, account, **kwargs)
+
+    async def send_image(self, user_id, media_id, account=None, **kwargs):
+        return await self.send(user_id, 'image', {'media_id': media_id}, account, **kwargs)
+
+    async def send_voice(self, user_id, media_id, account=None, **kwargs):
+        return await self.send(user_id, 'voice', {'media_id': media_id}, account, **kwargs)
+
+    async def send_video(self, user_id, media_id, title=None, description=None, account=None, **kwargs):
+        video = {'media_id': media_id}
+        if title:
+            video['title'] = title
+        if description:
+            video['description'] = description
+        return await self.send(user_id, 'video', video, account, **kwargs)
+
+    async def send_articles(self, user_id, articles, account=None, **kwargs):
+        return await self.send(user_id, 'news', {'articles': articles}, account, **kwargs)
+
+    async def send_template(self, user_id, template_id, data, url=None, mini_program=None, **kwargs):
+        return await self._client.template.send(user_id, template_id, data, url, mini_program, **kwargs)
+
+class AsyncTemplateAPI(BaseAsyncAPI):
+    '''
+    Template messages, which have no 48 hours limitation
+    '''
+    async def send(self, user_id, template_id, data, url=None, mini_program=None, **kwargs):
+        body = {
+            'touser': user_id,
+            'template_id': template_id,
+            'data': data,
+        }
+        if url:
+            body['url'] = url
+        if mini_program:
+            body['miniprogram'] = mini_program
+        return await self._post('message/template/send', data=body, **kwargs)
+
+    async def get_all_private_template(self, **kwargs):
+        return await self._get('template/get_all_private_template', **kwargs)
+
+    async def get(self, template_id_short, **kwargs):
+        res = await self._post('template/api_add_template', data={'template_id_short': template_id_short}, **kwargs)
+        return res['template_id']
+
+    async def delete(self, template_id, **kwargs):
+        return await self._post('template/del_private_template', data={'template_id': template_id}, **kwargs)
+
+class AsyncQRCodeAPI(BaseAsyncAPI):
+    async def create(self, qrcode_data: dict, **kwargs):
+        return await self._post('qrcode/create', data=qrcode_data, **kwargs)
+
+    async def show(self, ticket, **kwargs):
+        if isinstance(ticket, dict):
+            ticket = ticket['ticket']
+        return await self._get('https://mp.weixin.qq.com/cgi-bin/showqrcode', params={'ticket': ticket}, raw=True, **kwargs)
+
+    @staticmethod
+    def get_url(ticket) -> str:
+        if isinstance(ticket, dict):
+            ticket = ticket['ticket']
+        return f'https://mp.weixin.qq.com/cgi-bin/showqrcode?ticket={urllib.parse.quote(ticket)}'
+
+class AsyncUserAPI(BaseAsyncAPI):
+    async def get(self, user_id, lang='zh_CN', **kwargs):
+        return await self._get('user/info', params={'openid': user_id, 'lang': lang}, **kwargs)
+
+    async def get_batch(self, user_list, **kwargs):
+        user_list = [u if isinstance(u, dict) else {'openid': u, 'lang': 'zh_CN'} for u in user_list]
+        res = await self._post('user/info/batchget', data={'user_list': user_list}, **kwargs)
+        return res['user_info_list']
+
+    async def get_followers(self, first_user_id=None, **kwargs):
+        params = {}
+        if first_user_id:
+            params['next_openid'] = first_user_id
+        return await self._get('user/get', params=params, **kwargs)
+
+    async def update_remark(self, user_id, remark, **kwargs):
+        return await self._post('user/info/updateremark', data={'openid': user_id, 'remark': remark}, **kwargs)
+
+class AsyncMediaAPI(BaseAsyncAPI):
+    async def upload(self, media_type, media_file, **kwargs):
+        return await self._post('media/upload', params={'type': media_type}, files={'media': media_file}, **kwargs)
+
+    async def download(self, media_id, **kwargs) -> bytes:
+        return await self._get('media/get', params={'media_id': media_id}, raw=True, **kwargs)
+
+    async def upload_image(self, media_file, **kwargs) -> str:
+        res = await self._post('media/uploadimg', files={'media': media_file}, **kwargs)
+        return res['url']
+
+class AsyncWeChatClient:
+    def __init__(self, appid, secret, timeout=5, max_connections=100, max_keepalive_connections=20, http2=True, token_store=None):
+        self.appid = appid
+        self.secret = secret
+        self.http = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            http2=http2 and http2_available())
+        self.token_manager = AccessTokenManager(appid, self.fetch_access_token, token_store)
+
+        self.message = AsyncMessageAPI(self)
+        self.template = AsyncTemplateAPI(self)
+        self.qrcode = AsyncQRCodeAPI(self)
+        self.user = AsyncUserAPI(self)
+        self.media = AsyncMediaAPI(self)
+
+    async def fetch_access_token(self) -> dict:
+        return await self._request('GET', 'token', params={
+            'grant_type': 'client_credential',
+            'appid': self.appid,
+            'secret': self.secret,
+        }, with_token=False)
+
+    async def get_access_token(self) -> str:
+        return await self.token_manager.get_token()
+
+    async def get(self, url, **kwargs):
+        return await self._request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request('POST', url, **kwargs)
+
+    async def _request(self, method, url, params=None, data=None, files=None, timeout=None, raw=False, with_token=True, retry_token=True):
+        params = dict(params or {})
+        token = None
+        if with_token:
+            token = await self.get_access_token()
+            params['access_token'] = token
+        kwargs = {'params': params}
+        if data is not None:
+            kwargs['content'] = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            kwargs['headers'] = {'Content-Type': 'application/json'}
+        if files is not None:
+            kwargs['files'] = files
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if metrics.enabled:
+            start = perf_counter()
+        try:
+            res = await self.http.request(method, url, **kwargs)
+            res.raise_for_status()
+        except httpx.HTTPError as e:
+            if metrics.enabled:
+                metrics.observe_api(url, start, type(e).__name__)
+            raise
+
+        if raw and not res.headers.get('Content-Type', '').startswith(('application/json', 'text/plain')):
+            if metrics.enabled:
+                metrics.observe_api(url, start)
+            return res.content
+        result = json.loads(res.content.decode('utf-8', 'ignore'), strict=False)
+        errcode = result.get('errcode', 0) if isinstance(result, dict) else 0
+        if metrics.enabled:
+            metrics.observe_api(url, start, errcode)
+        if errcode == 0:
+            return result
+        if errcode in TOKEN_EXPIRED_CODES and with_token and retry_token:
+            logger.warning(f'<infra> wechat access_token rejected with {errcode}, refresh and retry')
+            await self.token_manager.refresh(stale_token=token)
+            return await self._request(method, url, params=params, data=data, files=files, timeout=timeout, raw=raw, retry_token=False)
+        raise WeChatClientException(errcode, result.get('errmsg'), client=self, request=res.request, response=res)
+
+    def start(self):
+        self.token_manager.start()
+
+    async def aclose(self):
+        await self.token_manager.stop()
+        await self.http.aclose()
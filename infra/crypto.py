@@ -0,0 +1,80 @@
+import hmac
+import asyncio
+import hashlib
+import binascii
+from xml.etree import ElementTree
+
+from wechatpy.exceptions import InvalidSignatureException
+from wechatpy.utils import to_binary
+
+from utils.logger import logger
+
+'''
+Long lived message crypto for the encrypted (safe) mode
+
+The AES key is decoded and the cipher set up once at startup instead of per request,
+and payloads larger than `offload_size` bytes are decrypted/encrypted in the default executor
+'''
+def _signature(*args) -> str:
+    return hashlib.sha1(b''.join(sorted(to_binary(a) for a in args))).hexdigest()
+
+def check_signature(token, signature, timestamp, nonce):
+    if not hmac.compare_digest(_signature(token, timestamp, nonce), to_binary(signature).decode()):
+        raise InvalidSignatureException()
+
+class MessageCrypto:
+    def __init__(self, token, encoding_aes_key, app_id, offload_size=16 * 1024):
+        # plaintext deployments never load the AES implementation
+        from wechatpy.crypto import WeChatCrypto, PrpCrypto
+        self._crypto = WeChatCrypto(token, encoding_aes_key, app_id)
+        self._prp = PrpCrypto(self._crypto.key)
+        self.token = token
+        self.app_id = app_id
+        self.offload_size = offload_size
+
+    def check_signature(self, signature, timestamp, nonce):
+        check_signature(self.token, signature, timestamp, nonce)
+
+    def _decrypt(self, body, msg_signature, timestamp, nonce) -> str:
+        encrypt = ElementTree.fromstring(body).findtext('Encrypt')
+        if encrypt == None:
+            raise KeyError('Encrypt')
+        if not hmac.compare_digest(_signature(self.token, timestamp, nonce, encrypt), to_binary(msg_signature).decode()):
+            raise InvalidSignatureException()
+        return self._prp.decrypt(encrypt, self.app_id)
+
+    def _encrypt(self, reply: str, nonce, timestamp) -> str:
+        return self._crypto._encrypt_message(reply, nonce, timestamp, lambda key: self._prp)
+
+    async def _run(self, size, func, *args):
+        if size <= self.offload_size:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def decrypt_message(self, body, msg_signature, timestamp, nonce) -> str:
+        return await self._run(len(body), self._decrypt, body, msg_signature, timestamp, nonce)
+
+    async def encrypt_message(self, reply: str, nonce, timestamp) -> str:
+        return await self._run(len(reply), self._encrypt, reply, nonce, timestamp)
+
+msg_crypto = None
+
+def set_crypto(crypto: MessageCrypto):
+    global msg_crypto
+    msg_crypto = crypto
+
+def new_crypto(token, encoding_aes_key, app_id):
+    return MessageCrypto(token, encoding_aes_key, app_id)
+
+def get_crypto() -> MessageCrypto:
+    return msg_crypto
+
+def init_crypto(token, encoding_aes_key, app_id):
+    try:
+        crypto = new_crypto(token, encoding_aes_key, app_id)
+    except (AssertionError, ValueError, binascii.Error):
+        # plaintext mode doesn't need a valid APP_AES_KEY
+        logger.warning("<infra> crypto disabled: APP_AES_KEY is not a valid EncodingAESKey")
+        return
+    set_crypto(crypto)
+    logger.info("<infra> crypto initialized")
@@ -0,0 +1,152 @@
+import contextvars
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import config
+
+'''
+In-process counters and histograms, exposed in the Prometheus text format
+
+Call sites guard every measurement with `if metrics.enabled:`, the same way
+DEBUG logging is guarded, so with METRICS.ENABLED off a request pays one flag
+check per stage and nothing else.
+
+    if metrics.enabled:
+        start = perf_counter()
+    ...
+    if metrics.enabled:
+        metrics.observe_stage('route', start, msg, tf)
+
+Series live in the worker process, so with several workers each one serves its
+own /metrics and Prometheus should scrape every worker.
+'''
+METRICS = getattr(config, 'METRICS', None)
+enabled = METRICS != None and METRICS.ENABLED
+
+# seconds, from 50us up, message handling is mostly far below a millisecond
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra='') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {value}' for labels, value in self._values.items()]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, *labelvalues):
+        self._values[labelvalues] = value
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count of each bucket and +Inf, sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def collect(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_str} {total}')
+            lines.append(f'{self.name}_count{label_str} {cumulative}')
+        return lines
+
+_registry = []
+
+def counter(name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    metric = Counter(name, documentation, labelnames)
+    _registry.append(metric)
+    return metric
+
+def gauge(name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    metric = Gauge(name, documentation, labelnames)
+    _registry.append(metric)
+    return metric
+
+def histogram(name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _registry.append(metric)
+    return metric
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+stage_seconds = histogram('wechat_stage_seconds', 'Latency of each stage of handling a /wechat request', ('stage', 'type', 'event', 'trigger'))
+messages_total = counter('wechat_messages_total', 'Messages routed, by the kind of trigger they hit', ('type', 'event', 'trigger'))
+api_seconds = histogram('wechat_api_seconds', 'Latency of WeChat API calls', ('endpoint',))
+api_calls_total = counter('wechat_api_calls_total', 'WeChat API calls by errcode, 0 is success', ('endpoint', 'errcode'))
+mysql_pool_in_use = gauge('mysql_pool_in_use', 'MySQL connections checked out of the pool')
+mysql_pool_waiters = gauge('mysql_pool_waiters', 'Queries waiting for a free MySQL connection')
+mysql_pool_acquire_seconds = histogram('mysql_pool_acquire_seconds', 'Wait for a free MySQL connection')
+mysql_pool_errors_total = counter('mysql_pool_errors_total', 'Acquire timeouts, acquires rejected by the open circuit breaker and statement timeouts', ('reason',))
+write_behind_pending = gauge('mysql_write_behind_pending', 'Buffered writes not yet flushed, lost if the worker crashes')
+write_behind_writes_total = counter('mysql_write_behind_writes_total', 'Buffered writes by buffered, coalesced, flushed, failed or lost', ('result',))
+write_behind_flush_seconds = histogram('mysql_write_behind_flush_seconds', 'Latency of write-behind flushes')
+model_cache_total = counter('mysql_model_cache_total', 'Model.find lookups of cached models, by hit, negative_hit or miss', ('table', 'result'))
+broadcast_messages_total = counter('wechat_broadcast_messages_total', 'Template messages of broadcasts, by sent or failed', ('result',))
+
+# message of the request being handled, so stages outside the dispatcher are labelled too
+_current_message = contextvars.ContextVar('current_message', default=None)
+
+def set_current_message(msg):
+    _current_message.set(msg)
+
+def observe_stage(stage: str, start: float, msg=None, tf=None):
+    if msg is None:
+        msg = _current_message.get()
+    if msg is None:
+        labels = ('', '')
+    else:
+        labels = (msg.type, msg.event or '')
+    stage_seconds.observe(perf_counter() - start, stage, *labels, tf.kind if tf is not None else '')
+
+def count_message(msg, tf):
+    messages_total.inc(msg.type, msg.event or '', tf.kind if tf is not None else 'none')
+
+def observe_api(endpoint: str, start: float, errcode=0):
+    api_seconds.observe(perf_counter() - start, endpoint)
+    api_calls_total.inc(endpoint, str(errcode))
@@ -1,16 +1,53 @@
-import aiomysql
+import copy
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from time import perf_counter
+from typing import AsyncIterator, Iterable, List, Sequence
+
 import config
+from infra import metrics
+from utils.cache import LRUCache, SingleFlight
 from utils.logger import logger
 
 __pool = None
 
+# share of statements logged at DEBUG, logging every one costs more than running it
+SQL_LOG_SAMPLE_RATE = getattr(config.MYSQL, 'LOG_SAMPLE_RATE', 1.0)
+# rows per multi-row INSERT of executemany
+INSERT_CHUNK_SIZE = getattr(config.MYSQL, 'INSERT_CHUNK_SIZE', 1000)
+# rows fetched per round trip when streaming
+STREAM_BATCH_SIZE = getattr(config.MYSQL, 'STREAM_BATCH_SIZE', 1000)
+# primary keys per IN (...) query of find_many
+FIND_CHUNK_SIZE = getattr(config.MYSQL, 'FIND_CHUNK_SIZE', 500)
+# connections of each worker's pool, MIN_SIZE of them opened before serving
+POOL_MIN_SIZE = getattr(config.MYSQL, 'MIN_SIZE', 1)
+POOL_MAX_SIZE = getattr(config.MYSQL, 'MAX_SIZE', 10)
+# seconds before a connection is reopened, -1 for never
+POOL_RECYCLE = getattr(config.MYSQL, 'RECYCLE', -1)
+# seconds to wait for a free connection and for a statement, None for no limit
+ACQUIRE_TIMEOUT = getattr(config.MYSQL, 'ACQUIRE_TIMEOUT', None)
+STATEMENT_TIMEOUT = getattr(config.MYSQL, 'STATEMENT_TIMEOUT', None)
+BREAKER_THRESHOLD = getattr(config.MYSQL, 'BREAKER_THRESHOLD', 5)
+BREAKER_COOLDOWN = getattr(config.MYSQL, 'BREAKER_COOLDOWN', 5)
+
 async def new_pool(loop):
+    # imported on first use, so deployments without MySQL never load it
+    import aiomysql
     pool = await aiomysql.create_pool(
         host=config.MYSQL.HOST, 
         port=config.MYSQL.PORT,
         user=config.MYSQL.USER,
         password=config.MYSQL.PASSWORD,
-        db=config.MYSQL.DB, loop=loop)
+        db=config.MYSQL.DB,
+        minsize=POOL_MIN_SIZE,
+        maxsize=POOL_MAX_SIZE,
+        pool_recycle=POOL_RECYCLE,
+        loop=loop)
     return pool
 
 def set_pool(pool):
@@ -20,21 +57,202 @@ def set_pool(pool):
 def get_pool():
     return __pool
 
+# the WriteBehindBuffer of models writing behind, see infra/write_behind.py
+_write_buffer = None
+
+def set_write_buffer(buffer):
+    global _write_buffer
+    _write_buffer = buffer
+
+@asynccontextmanager
+async def _direct_write(model):
+    # a flush in flight may hold older rows of a write-behind model, see WriteBehindBuffer.exclusive
+    if model.__write_behind__ and _write_buffer is not None:
+        async with _write_buffer.exclusive():
+            yield
+    else:
+        yield
+
+async def warm_up(pool, size):
+    '''
+    Check out `size` connections at once and ping them, so they are open
+    and alive before the first request needs one
+    '''
+    conns = await asyncio.gather(*(pool.acquire() for _ in range(size)))
+    try:
+        await asyncio.gather(*(conn.ping() for conn in conns))
+    finally:
+        for conn in conns:
+            await pool.release(conn)
+
 async def init_pool(loop):
     pool = await new_pool(loop)
+    start = perf_counter()
+    await warm_up(pool, POOL_MIN_SIZE)
     set_pool(pool)
-    logger.info("<infra> mysql initialized")
+    logger.info(f"<infra> mysql initialized, {POOL_MIN_SIZE} connections warmed up in {(perf_counter() - start) * 1e3:.0f}ms")
+
+class PoolUnavailableError(RuntimeError):
+    pass
+
+class PoolGuard:
+    '''
+    Stats and circuit breaker of the connection pool
+
+    Waiting longer than `acquire_timeout` for a connection fails with
+    PoolUnavailableError. After `breaker_threshold` such timeouts in a row the
+    breaker opens, and for `breaker_cooldown` seconds queries fail at once
+    instead of piling up behind a pool with no connection to give. After
+    that acquires are let through again, the first to succeed closes it.
+    '''
+    def __init__(self, acquire_timeout=None, breaker_threshold=5, breaker_cooldown=5, wait_samples=1024):
+        self.acquire_timeout = acquire_timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.in_use = 0
+        self.waiters = 0
+        self._timeouts_in_row = 0
+        self._open_until = None
+        self._waits = deque(maxlen=wait_samples)
+        self._max_wait = 0.0
+        self._counters = { 'acquired': 0, 'acquire_timeouts': 0, 'rejected': 0, 'statement_timeouts': 0 }
+
+    def check(self):
+        if self._open_until != None and time.monotonic() < self._open_until:
+            self._count('rejected')
+            raise PoolUnavailableError('MySQL circuit breaker is open')
+
+    def waiting(self, delta: int):
+        self.waiters += delta
+        if metrics.enabled:
+            metrics.mysql_pool_waiters.set(self.waiters)
+
+    def acquired(self, wait: float):
+        self._timeouts_in_row = 0
+        if self._open_until != None:
+            self._open_until = None
+            logger.info('<infra> mysql circuit breaker closed')
+        self._waits.append(wait)
+        if wait > self._max_wait:
+            self._max_wait = wait
+        self._counters['acquired'] += 1
+        self.using(1)
+        if metrics.enabled:
+            metrics.mysql_pool_acquire_seconds.observe(wait)
+
+    def using(self, delta: int):
+        self.in_use += delta
+        if metrics.enabled:
+            metrics.mysql_pool_in_use.set(self.in_use)
+
+    def acquire_timed_out(self):
+        self._count('acquire_timeouts')
+        self._timeouts_in_row += 1
+        if self._timeouts_in_row >= self.breaker_threshold:
+            self._open_until = time.monotonic() + self.breaker_cooldown
+            logger.error(f'<infra> mysql circuit breaker open for {self.breaker_cooldown}s after {self._timeouts_in_row} acquire timeouts in a row')
+
+    def statement_timed_out(self):
+        self._count('statement_timeouts')
 
+    def _count(self, name: str):
+        self._counters[name] += 1
+        if metrics.enabled:
+            metrics.mysql_pool_errors_total.inc(name)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+        return {
+            'in_use': self.in_use,
+            'waiters': self.waiters,
+            'breaker_open': self._open_until != None and time.monotonic() < self._open_until,
+            'acquire_wait_p50': percentile(0.5),
+            'acquire_wait_p99': percentile(0.99),
+            'acquire_wait_max': self._max_wait,
+            **self._counters,
+        }
+
+_guard = PoolGuard(ACQUIRE_TIMEOUT, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+def pool_stats() -> dict:
+    stats = _guard.stats()
+    if __pool != None:
+        stats.update(size=__pool.size, free=__pool.freesize, min_size=__pool.minsize, max_size=__pool.maxsize)
+    return stats
+
+@asynccontextmanager
+async def _acquire():
+    _guard.check()
+    start = perf_counter()
+    _guard.waiting(1)
+    try:
+        if _guard.acquire_timeout:
+            conn = await asyncio.wait_for(__pool.acquire(), _guard.acquire_timeout)
+        else:
+            conn = await __pool.acquire()
+    except asyncio.TimeoutError:
+        _guard.acquire_timed_out()
+        raise PoolUnavailableError(f'no free MySQL connection within {_guard.acquire_timeout}s')
+    finally:
+        _guard.waiting(-1)
+    _guard.acquired(perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        _guard.using(-1)
+        await __pool.release(conn)
+
+async def _timed(conn, statement):
+    '''
+    Await `statement` on `conn` for at most STATEMENT_TIMEOUT seconds
+    On timeout the connection is closed rather than reused, as its reply may
+    still arrive, and the server may still be running the statement
+    '''
+    if not STATEMENT_TIMEOUT:
+        return await statement
+    try:
+        return await asyncio.wait_for(statement, STATEMENT_TIMEOUT)
+    except asyncio.TimeoutError:
+        conn.close()
+        _guard.statement_timed_out()
+        raise
+
+
+def _dict_cursor():
+    from aiomysql import DictCursor
+    return DictCursor
+
+def _ss_dict_cursor():
+    from aiomysql import SSDictCursor
+    return SSDictCursor
+
+def _ss_cursor():
+    from aiomysql import SSCursor
+    return SSCursor
 
 def log(sql, args=()):
-    logger.info('SQL: %s' % sql)
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < SQL_LOG_SAMPLE_RATE:
+        logger.debug('SQL: %s' % sql)
+
+@lru_cache(maxsize=1024)
+def rewrite(sql: str) -> str:
+    '''
+    `?` placeholders to the `%s` of the driver, once per statement template
+    '''
+    return sql.replace('?', '%s')
 
-async def select(sql, args, size=None):
+async def select(sql, args, size=None, tuples=False):
+    '''
+    Rows as dicts, or as tuples in the order of the selected columns with `tuples=True`
+    '''
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
+    async with _acquire() as conn:
+        async with conn.cursor(None if tuples else _dict_cursor()) as cur:
+            await _timed(conn, cur.execute(rewrite(sql), args or ()))
             if size:
                 rs = await cur.fetchmany(size)
             else:
@@ -42,6 +260,24 @@ async def select(sql, args, size=None):
         logger.debug('rows returned: %s' % len(rs))
         return rs
 
+async def stream(sql, args=None, batch_size=None, tuples=False) -> AsyncIterator[List]:
+    '''
+    Yield the rows of a query in lists of `batch_size`, through a server-side cursor
+    so only one batch is held in memory
+    The connection stays busy until the iteration ends, and stopping early
+    still has the server send, and the driver skip, the remaining rows
+    '''
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    log(sql, args)
+    async with _acquire() as conn:
+        async with conn.cursor(_ss_cursor() if tuples else _ss_dict_cursor()) as cur:
+            await _timed(conn, cur.execute(rewrite(sql), args or ()))
+            while True:
+                rs = await _timed(conn, cur.fetchmany(batch_size))
+                if not rs:
+                    break
+                yield rs
+
 '''
 --------- IMPOARTANT ---------
  DON'T SET autocommit AS True
@@ -50,25 +286,255 @@ async def select(sql, args, size=None):
 '''
 async def execute(sql, args=None, autocommit=False):
     log(sql)
-    async with __pool.get() as conn:
+    async with _acquire() as conn:
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
+            async with conn.cursor(_dict_cursor()) as cur:
                 if args:
-                    await cur.execute(sql.replace('?', '%s'), args)
+                    await _timed(conn, cur.execute(rewrite(sql), args))
                 else:
-                    await cur.execute(sql)
+                    await _timed(conn, cur.execute(sql))
                 affected = cur.rowcount
                 logger.debug(f'rows affected: {affected}')
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
-            if not autocommit:
+            # a connection closed on timeout has nothing left to roll back
+            if not autocommit and not conn.closed:
                 await conn.rollback()
             raise
         return affected
 
+async def executemany(sql, args_list: Iterable[Sequence], chunk_size=None):
+    '''
+    Run `sql` once per item of `args_list` in one transaction
+    An INSERT ... VALUES statement is sent as multi-row INSERTs of `chunk_size` rows
+    '''
+    chunk_size = chunk_size or INSERT_CHUNK_SIZE
+    log(sql)
+    affected = 0
+    async with _acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                for chunk in _chunks(args_list, chunk_size):
+                    await _timed(conn, cur.executemany(rewrite(sql), chunk))
+                    affected += cur.rowcount
+            await conn.commit()
+        except BaseException:
+            if not conn.closed:
+                await conn.rollback()
+            raise
+    logger.debug(f'rows affected: {affected}')
+    return affected
+
+insert_many = executemany
+
+def _case_update(table: str, key: str, columns: Sequence[str], chunk: List[Sequence], version=None):
+    # CASE only reads the key, which is not assigned, so the SET order does not matter
+    whens = ' '.join(['when ? then ?'] * len(chunk))
+    sets = ', '.join('`%s`=case `%s` %s end' % (column, key, whens) for column in columns)
+    n = len(columns)
+    args = [arg for i in range(n) for row in chunk for arg in (row[n], row[i])]
+    if version is None:
+        where = '`%s` in (%s)' % (key, create_args_string(len(chunk)))
+        args.extend(row[n] for row in chunk)
+    else:
+        where = ' or '.join(['(`%s`=? and `%s`=?)' % (key, version)] * len(chunk))
+        args.extend(arg for row in chunk for arg in (row[n], row[n + 1]))
+    return 'update `%s` set %s where %s' % (table, sets, where), args
+
+async def update_many(table: str, key: str, columns: Sequence[str], args_list: Iterable[Sequence], chunk_size=None, version: str = None) -> int:
+    '''
+    Update rows of `table` by `key` in one transaction, each item of `args_list` being
+    the values of `columns` followed by the key, and by the expected value of column `version` if given
+    Rows are sent as one UPDATE ... SET `column`=CASE `key` WHEN ... END statement per `chunk_size` rows
+    (MYSQL.FIND_CHUNK_SIZE by default) rather than one round trip each, keys missing from `table` are not inserted
+    With `version`, a row is only updated while its `version` column holds the expected value
+    '''
+    chunk_size = chunk_size or FIND_CHUNK_SIZE
+    affected = 0
+    async with _acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                for chunk in _chunks(args_list, chunk_size):
+                    sql, args = _case_update(table, key, columns, chunk, version)
+                    log(sql)
+                    await _timed(conn, cur.execute(rewrite(sql), args))
+                    affected += cur.rowcount
+            await conn.commit()
+        except BaseException:
+            if not conn.closed:
+                await conn.rollback()
+            raise
+    logger.debug(f'rows affected: {affected}')
+    return affected
+
+def _chunks(items: Iterable, size: int):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+_MISSING = object()
+
+def _match_key(key):
+    # keys as MySQL compares them under the default collations: case-insensitive, trailing spaces ignored
+    return str(key).casefold().rstrip(' ')
+
+class ModelCache:
+    '''
+    Read-through cache of `Model.find`, opted into per model:
+
+        class User(Model):
+            __cache__ = ModelCache(maxsize=10000, ttl=300, negative_ttl=30)
+
+    Rows are kept per primary key for `ttl` seconds, the least recently used
+    out first, and primary keys without a row for `negative_ttl` (`ttl` by
+    default, 0 to not cache them). Concurrent misses of a key share one query.
+    save, update, remove and save_many of the model drop the keys they write;
+    statements run through `execute` do not, and other workers keep their
+    copy until it expires, so `ttl` bounds how stale a row may be.
+    '''
+    def __init__(self, maxsize=1024, ttl=60, negative_ttl=None):
+        self.table = None
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._rows = LRUCache(maxsize, ttl)
+        self._loads = SingleFlight()
+        # bumped by every invalidation, a query overlapping one is not cached
+        self._invalidations = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    async def get(self, pk, load):
+        row = self.peek(pk)
+        if row is not _MISSING:
+            return row
+        return await self._loads.run(pk, lambda: self._load(pk, load))
+
+    def peek(self, pk):
+        '''
+        The cached row of `pk`, None for a key cached as missing, or _MISSING
+        if it is not cached; counted as a hit or a miss
+        '''
+        row = self._rows.get(pk, _MISSING)
+        if row is _MISSING:
+            self.misses += 1
+            result = 'miss'
+        elif row is None:
+            self.negative_hits += 1
+            result = 'negative_hit'
+        else:
+            self.hits += 1
+            result = 'hit'
+        if metrics.enabled:
+            metrics.model_cache_total.inc(self.table, result)
+        return row
+
+    async def _load(self, pk, load):
+        invalidations = self._invalidations
+        self.queries += 1
+        row = await load()
+        self.store(pk, row, invalidations)
+        return row
+
+    def store(self, pk, row, invalidations: int):
+        '''
+        Cache `row` of `pk`, None if there is no such row, as read by a query
+        started when `invalidations` was the invalidation count
+        '''
+        if invalidations != self._invalidations:
+            return
+        if row is not None:
+            self._rows.set(pk, row)
+        elif self.negative_ttl > 0:
+            self._rows.set(pk, None, self.negative_ttl)
+
+    @property
+    def invalidations(self) -> int:
+        return self._invalidations
+
+    def invalidate(self, pk):
+        self._invalidations += 1
+        self._rows.pop(pk)
+        self._loads.forget(pk)
+
+    def clear(self):
+        self._invalidations += 1
+        self._rows.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._rows),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'queries': self.queries,
+            'invalidations': self._invalidations,
+        }
+
+class BatchLoader:
+    '''
+    Coalesces lookups of `model` by primary key, DataLoader style: the keys
+    asked for while the event loop runs its current callbacks, as the tasks of
+    one `asyncio.gather` do, are fetched by one `find_many` once they are done
+
+        users = await asyncio.gather(*(User.load(open_id) for open_id in open_ids))
+
+    `Model.load` uses one loader per model; create one per request instead to
+    keep batches from mixing requests. Rows are not kept between batches, the
+    model's ModelCache is what caches them.
+    '''
+    def __init__(self, model, max_batch_size=None):
+        self.model = model
+        self.max_batch_size = max_batch_size or FIND_CHUNK_SIZE
+        self._pending = {}
+
+    async def load(self, pk):
+        future = self._pending.get(pk)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            future = self._pending[pk] = loop.create_future()
+        # shielded, a caller giving up must not cancel the others waiting for the key
+        model = await asyncio.shield(future)
+        # a copy each, as find returns
+        return None if model is None else copy.copy(model)
+
+    async def load_many(self, pks: Iterable) -> List:
+        return await asyncio.gather(*(self.load(pk) for pk in pks))
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        batch = list(pending.items())
+        for start in range(0, len(batch), self.max_batch_size):
+            asyncio.ensure_future(self._fetch(batch[start:start + self.max_batch_size]))
+
+    async def _fetch(self, batch):
+        try:
+            models = await self.model.find_many([pk for pk, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), model in zip(batch, models):
+            if not future.done():
+                future.set_result(model)
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -140,6 +606,9 @@ class ModelMetaclass(type):
             if isinstance(v, Field):
                 createStmt += f"{k} {v.column_type} NOT NULL,"
         createStmt += f"PRIMARY KEY ({primaryKey})"
+        # secondary indexes, one per column named in __indexes__
+        for k in attrs.get('__indexes__', ()):
+            createStmt += f", KEY ({k})"
         createStmt += ")"
 
         if not primaryKey:
@@ -157,9 +626,23 @@ class ModelMetaclass(type):
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__upsert__'] = '%s on duplicate key update %s' % (attrs['__insert__'], ', '.join(map(lambda f: '%s=values(%s)' % (f, f), escaped_fields)) or '`%s`=`%s`' % (primaryKey, primaryKey))
+        if attrs.get('__cache__') is not None:
+            attrs['__cache__'].table = tableName
+        model = type.__new__(cls, name, bases, attrs)
+        model.__model__ = model
+        if model.__slots_rows__:
+            model.__row_class__ = _row_class(model)
+        return model
 
 class Model(dict, metaclass=ModelMetaclass):
+    # a ModelCache to cache find, see ModelCache
+    __cache__ = None
+    # buffer save and update, see infra/write_behind.py
+    __write_behind__ = False
+    # load rows as instances of a slotted class generated from the fields, see Row
+    __slots_rows__ = False
+    __row_class__ = None
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -211,8 +694,69 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        rs = await select(' '.join(sql), args, tuples=cls.__slots_rows__)
+        build = cls._builder()
+        return [build(r) for r in rs]
+
+    @classmethod
+    async def iterAll(cls, where=None, args=None, batch_size=None, keyset=False, batches=False, after=None, **kw):
+        '''
+        Iterate over the rows findAll would return, `batch_size` rows in memory at a time
+        Yields models, or lists of models with `batches=True`
+
+        By default one query is streamed through a server-side cursor, holding a
+        connection for the whole scan. With `keyset=True` each batch is its own
+        query, `pk > last pk ORDER BY pk LIMIT batch_size`, so no connection is
+        held between batches and the scan may take as long as it needs; rows
+        come in primary key order and `orderBy` is not supported then, and the
+        scan may resume from the rows after the primary key `after`.
+        '''
+        batch_size = batch_size or STREAM_BATCH_SIZE
+        if keyset:
+            source = cls._keyset_batches(where, args, batch_size, after)
+        else:
+            sql = [cls.__select__]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            orderBy = kw.get('orderBy', None)
+            if orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            source = stream(' '.join(sql), args, batch_size, tuples=cls.__slots_rows__)
+        build = cls._builder()
+        async for rs in source:
+            models = [build(r) for r in rs]
+            if batches:
+                yield models
+            else:
+                for model in models:
+                    yield model
+
+    @classmethod
+    async def _keyset_batches(cls, where, args, batch_size, after=None):
+        pk = cls.__primary_key__
+        last = after
+        while True:
+            conditions = [f'({where})'] if where else []
+            batch_args = list(args or [])
+            if last is not None:
+                conditions.append(f'`{pk}` > ?')
+                batch_args.append(last)
+            sql = [cls.__select__]
+            if conditions:
+                sql.append('where')
+                sql.append(' and '.join(conditions))
+            sql.append(f'order by `{pk}` limit ?')
+            batch_args.append(batch_size)
+            rs = await select(' '.join(sql), batch_args, tuples=cls.__slots_rows__)
+            if not rs:
+                return
+            yield rs
+            if len(rs) < batch_size:
+                return
+            # the primary key is the first column selected
+            last = rs[-1][0] if cls.__slots_rows__ else rs[-1][pk]
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
@@ -229,31 +773,289 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        if cls.__cache__ is not None:
+            row = await cls.__cache__.get(pk, lambda: cls._find_row(pk))
+        else:
+            row = await cls._find_row(pk)
+        if row is None:
+            return None
+        # a new model, so changing it never changes the cached row
+        return cls._builder()(row)
+
+    @classmethod
+    async def _find_row(cls, pk):
+        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1, tuples=cls.__slots_rows__)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return rs[0]
+
+    @classmethod
+    def _builder(cls):
+        '''
+        The function making a model of a row from select, a dict or a tuple
+        '''
+        if cls.__row_class__ is not None:
+            return cls.__row_class__._make
+        return lambda r: cls(**r)
+
+    @classmethod
+    async def find_many(cls, pks: Iterable, chunk_size=None) -> List:
+        '''
+        Find objects by primary keys, in the order of `pks`, None where there is no row
+        Keys are looked up with `IN (...)` queries of `chunk_size` keys
+        (MYSQL.FIND_CHUNK_SIZE by default), the cached ones of a cached model are not
+        '''
+        pks = list(pks)
+        cache = cls.__cache__
+        rows = {}
+        missing = []
+        for pk in dict.fromkeys(pks):
+            row = cache.peek(pk) if cache is not None else _MISSING
+            if row is _MISSING:
+                missing.append(pk)
+            else:
+                rows[pk] = row
+        if missing:
+            invalidations = cache.invalidations if cache is not None else 0
+            found = await cls._find_rows(missing, chunk_size or FIND_CHUNK_SIZE)
+            for pk in missing:
+                rows[pk] = found.get(pk)
+                if cache is not None:
+                    cache.store(pk, rows[pk], invalidations)
+        build = cls._builder()
+        return [None if rows[pk] is None else build(rows[pk]) for pk in pks]
+
+    @classmethod
+    async def _find_rows(cls, pks: List, chunk_size: int) -> dict:
+        '''
+        Rows by the key of `pks` they were found by
+        MySQL may match a key to a row storing it differently, in another case under
+        a case-insensitive collation, or as a string for an int. Such rows are matched
+        by _match_key, and left over rows mean a collation rule beyond it, such as
+        accents, so the keys still unmatched are then looked up one by one as find does
+        '''
+        pk_name = cls.__primary_key__
+        found = {}
+        for chunk in _chunks(pks, chunk_size):
+            sql = '%s where `%s` in (%s)' % (cls.__select__, pk_name, create_args_string(len(chunk)))
+            by_key = { r[0] if cls.__slots_rows__ else r[pk_name]: r for r in await select(sql, chunk, tuples=cls.__slots_rows__) }
+            if cls.__cache__ is not None:
+                cls.__cache__.queries += 1
+            unmatched = []
+            for pk in chunk:
+                if pk in by_key:
+                    found[pk] = by_key[pk]
+                else:
+                    unmatched.append(pk)
+            if not unmatched or not by_key:
+                continue
+            claimed = set(pk for pk in chunk if pk in by_key)
+            normalized = { _match_key(key): key for key in by_key }
+            for pk in unmatched:
+                key = normalized.get(_match_key(pk))
+                if key is not None:
+                    found[pk] = by_key[key]
+                    claimed.add(key)
+            if len(claimed) < len(by_key):
+                for pk in unmatched:
+                    if pk not in found:
+                        found[pk] = await cls._find_row(pk)
+        return found
+
+    @classmethod
+    async def load(cls, pk):
+        '''
+        Same as find, but the loads of this model started in the same event loop
+        iteration are looked up together by one find_many
+        '''
+        loader = cls.__dict__.get('_loader')
+        if loader is None:
+            loader = BatchLoader(cls)
+            setattr(cls, '_loader', loader)
+        return await loader.load(pk)
+
+    @classmethod
+    def _invalidate(cls, pk):
+        if cls.__cache__ is not None:
+            cls.__cache__.invalidate(pk)
 
     async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
+        if self.__write_behind__ and _write_buffer is not None:
+            _write_buffer.add(self)
+            return
+        args = self._insert_args()
         rows = await execute(self.__insert__, args)
+        self._invalidate(args[-1])
         if rows != 1:
             logger.warn('failed to insert record: affected rows: %s' % rows)
 
+    def _insert_args(self) -> List:
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        return args
+
+    @classmethod
+    async def save_many(cls, rows: Iterable, chunk_size=None, upsert=False) -> int:
+        '''
+        Insert `rows`, models or dicts of field values, in one transaction
+        with multi-row INSERTs of `chunk_size` rows (MYSQL.INSERT_CHUNK_SIZE by default)
+        With `upsert=True` rows whose primary key exists are updated instead
+        '''
+        sql = cls.__upsert__ if upsert else cls.__insert__
+        args_list = ((row if getattr(row, '__model__', None) is cls else cls(**row))._insert_args() for row in rows)
+        if cls.__cache__ is None and not cls.__write_behind__:
+            return await executemany(sql, args_list, chunk_size)
+        pks = []
+        def collect(args_list):
+            for args in args_list:
+                pks.append(args[-1])
+                # a buffered, older write of the row must not overwrite it later
+                if cls.__write_behind__ and _write_buffer is not None:
+                    _write_buffer.discard(cls, args[-1])
+                yield args
+        try:
+            async with _direct_write(cls):
+                return await executemany(sql, collect(args_list), chunk_size)
+        finally:
+            for pk in pks:
+                cls._invalidate(pk)
+
+    @classmethod
+    async def remove_many(cls, pks: Iterable, chunk_size=None) -> int:
+        '''
+        Delete the rows of `pks` with `IN (...)` statements of `chunk_size` keys
+        (MYSQL.FIND_CHUNK_SIZE by default), each committed on its own
+        '''
+        pks = list(pks)
+        affected = 0
+        async with _direct_write(cls):
+            for chunk in _chunks(pks, chunk_size or FIND_CHUNK_SIZE):
+                if cls.__write_behind__ and _write_buffer is not None:
+                    for pk in chunk:
+                        _write_buffer.discard(cls, pk)
+                affected += await execute('delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(chunk))), chunk)
+        for pk in pks:
+            cls._invalidate(pk)
+        return affected
+
     async def update(self):
+        if self.__write_behind__ and _write_buffer is not None:
+            _write_buffer.add(self, upsert=False)
+            return
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
+        self._invalidate(args[-1])
         if rows != 1:
             logger.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        async with _direct_write(self.__model__):
+            if self.__write_behind__ and _write_buffer is not None:
+                _write_buffer.discard(self.__model__, args[0])
+            rows = await execute(self.__delete__, args)
+        self._invalidate(args[0])
         if rows != 1:
             logger.warn('failed to remove by primary key: affected rows: %s' % rows)
 
+class Row(object):
+    '''
+    Base of the row classes of models declaring `__slots_rows__ = True`
+
+    Such a model loads rows as instances of `Model.__row_class__`, generated
+    from its fields: the columns are slots, read and written as plain
+    attributes, and rows are built from the tuples of a plain cursor rather
+    than from dicts. A row takes a fraction of the memory of a model and is
+    faster to build, which counts when findAll or iterAll load many of them.
+
+    Rows save, update and remove like models and can be read as mappings,
+    `row['open_id']` and `dict(row)` work. Their layout is fixed, setting an
+    attribute that is not a column raises AttributeError.
+
+        class User(Model):
+            __slots_rows__ = True
+            ...
+
+        users = await User.findAll()
+        user = User.__row_class__(open_id=open_id, user_name=name)
+        await user.save()
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__columns__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__columns__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__columns__
+
+    def __iter__(self):
+        return iter(self.__columns__)
+
+    def __len__(self):
+        return len(self.__columns__)
+
+    def keys(self):
+        return self.__columns__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__columns__ else default
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self.__model__ is other.__model__ and self._values() == other._values()
+        if isinstance(other, dict):
+            return dict(self) == other
+        return NotImplemented
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__columns__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__columns__))
+
+    def getValue(self, key):
+        return getattr(self, key, None)
+
+    getValueOrDefault = Model.getValueOrDefault
+    _insert_args = Model._insert_args
+    save = Model.save
+    update = Model.update
+    remove = Model.remove
+
+    @classmethod
+    def _invalidate(cls, pk):
+        cls.__model__._invalidate(pk)
+
+def _row_class(model) -> type:
+    columns = (model.__primary_key__,) + tuple(model.__fields__)
+    # generated, as namedtuple does, so building a row is one tuple unpacking
+    source = 'def __init__(self, %s):\n' % ', '.join('%s=None' % c for c in columns)
+    source += ''.join('    self.%s = %s\n' % (c, c) for c in columns)
+    source += 'def _make(cls, row):\n'
+    source += '    self = _new(cls)\n'
+    source += '    %s, = row\n' % ', '.join('self.%s' % c for c in columns)
+    source += '    return self\n'
+    namespace = {}
+    exec(source, { '_new': object.__new__ }, namespace)
+    attrs = {
+        '__slots__': columns,
+        '__columns__': columns,
+        '__init__': namespace['__init__'],
+        '_make': classmethod(namespace['_make']),
+        '__model__': model,
+    }
+    for name in ('__table__', '__primary_key__', '__fields__', '__mappings__', '__insert__', '__update__', '__delete__', '__upsert__', '__write_behind__'):
+        attrs[name] = getattr(model, name)
+    return type('%sRow' % model.__name__, (Row,), attrs)
+
 async def init_tables():
     for stmt in create_stmts:
         await execute(stmt)
\ No newline at end of file
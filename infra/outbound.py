@@ -0,0 +1,245 @@
+import time
+import random
+import itertools
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from wechatpy.exceptions import WeChatClientException
+
+from utils.logger import logger
+
+'''
+Outbound message scheduler
+
+Customer service and template sends are queued per WeChat API endpoint and
+drained by a few workers per endpoint, each send first taking a token from the
+endpoint's token bucket. Each worker has a queue of its own and the sends to a
+user always go to the same one, so a user gets them in the order they were
+made. Throttling errors come from endpoint-wide quotas, so they pause the
+endpoint's bucket for a jittered exponential backoff, and the throttled send
+goes back to the head of its queue to keep its place. Text messages to a user
+that are still queued are merged into one send. Every send returns an
+asyncio.Future of the API result, which handlers may await or leave alone,
+failures are logged either way.
+
+    get_outbound().send_text(user_id, 'hello world')
+'''
+CUSTOM_SEND = 'message/custom/send'
+TEMPLATE_SEND = 'message/template/send'
+
+# -1: system busy, 45009: API calls reach the limit, 45047: customer service messages reach the limit
+THROTTLE_CODES = (-1, 45009, 45047)
+
+# WeChat truncates customer service text beyond this length
+MAX_TEXT_LENGTH = 2000
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float):
+        '''
+        Hand out no token for `seconds`, and start empty afterwards
+        '''
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        while True:
+            paused = self._paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class _SendJob:
+    def __init__(self, endpoint: str, call: Callable[['_SendJob'], Awaitable], user_id=None, content=None):
+        self.endpoint = endpoint
+        self.call = call
+        self.user_id = user_id
+        self.content = content
+        self.future = asyncio.get_event_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundScheduler:
+    def __init__(self, client, rate_limits: Dict[str, tuple], concurrency=8, max_retries=5, retry_base_delay=1.0, max_queue_size=10000):
+        self.client = client
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.max_queue_size = max_queue_size
+        self._buckets = { endpoint: TokenBucket(rate, burst) for endpoint, (rate, burst) in rate_limits.items() }
+        # per endpoint, a queue for each of its workers
+        self._queues: Dict[str, List[asyncio.Queue]] = {}
+        # sends to no user in particular take the queues in turn
+        self._round_robin = itertools.count()
+        self._tasks = []
+        # queued but not yet started text jobs, by user
+        self._pending_text: Dict[str, _SendJob] = {}
+        self._counters = { 'sent': 0, 'failed': 0, 'retried': 0, 'coalesced': 0, 'rejected': 0 }
+
+    def start(self):
+        for endpoint in (CUSTOM_SEND, TEMPLATE_SEND):
+            self._queue(endpoint)
+
+    def _queue(self, endpoint: str, user_id=None) -> asyncio.Queue:
+        queues = self._queues.get(endpoint)
+        if queues == None:
+            # max_queue_size bounds the queues of the endpoint together, see _enqueue
+            queues = self._queues[endpoint] = [asyncio.Queue() for _ in range(self.concurrency)]
+            self._tasks.extend(asyncio.ensure_future(self._work(endpoint, queue)) for queue in queues)
+        key = hash(user_id) if user_id != None else next(self._round_robin)
+        return queues[key % len(queues)]
+
+    async def stop(self, timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while any(not q.empty() for queues in self._queues.values() for q in queues) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _enqueue(self, job: _SendJob) -> asyncio.Future:
+        job.future.add_done_callback(lambda f: self._log_failure(job, f))
+        queue = self._queue(job.endpoint, job.user_id)
+        if sum(q.qsize() for q in self._queues[job.endpoint]) >= self.max_queue_size:
+            self._counters['rejected'] += 1
+            job.future.set_exception(asyncio.QueueFull(f'outbound queue of {job.endpoint} is full'))
+        else:
+            queue.put_nowait(job)
+        return job.future
+
+    def submit(self, endpoint: str, call: Callable[[], Awaitable], user_id=None) -> asyncio.Future:
+        # later text must not be merged ahead of this send
+        self._pending_text.pop(user_id, None)
+        return self._enqueue(_SendJob(endpoint, lambda job: call(), user_id))
+
+    def send_text(self, user_id, content, account=None) -> asyncio.Future:
+        pending = self._pending_text.get(user_id)
+        if pending != None and account == None and len(pending.content) + len(content) < MAX_TEXT_LENGTH:
+            # merge into the queued message, all callers share its result
+            pending.content = f'{pending.content}\n{content}'
+            self._counters['coalesced'] += 1
+            return pending.future
+        job = _SendJob(CUSTOM_SEND, lambda job: self.client.message.send_text(user_id, job.content, account), user_id, content)
+        future = self._enqueue(job)
+        if account == None and not future.done():
+            self._pending_text[user_id] = job
+        return future
+
+    def send(self, user_id, msg_type, body: dict, account=None) -> asyncio.Future:
+        return self.submit(CUSTOM_SEND, lambda: self.client.message.send(user_id, msg_type, body, account), user_id)
+
+    def send_template(self, user_id, template_id, data, url=None, mini_program=None) -> asyncio.Future:
+        return self.submit(TEMPLATE_SEND, lambda: self.client.template.send(user_id, template_id, data, url, mini_program), user_id)
+
+    async def _work(self, endpoint: str, queue: asyncio.Queue):
+        bucket = self._buckets.get(endpoint)
+        # a throttled job, retried before the rest of the queue
+        retry = None
+        while True:
+            if retry != None:
+                job, retry = retry, None
+            else:
+                job = await queue.get()
+                if self._pending_text.get(job.user_id) is job:
+                    del self._pending_text[job.user_id]
+            if job.future.done():
+                continue
+            if bucket != None:
+                await bucket.acquire()
+            try:
+                result = await job.call(job)
+                self._counters['sent'] += 1
+                job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except WeChatClientException as e:
+                if e.errcode not in THROTTLE_CODES or job.attempts >= self.max_retries:
+                    self._counters['failed'] += 1
+                    job.future.set_exception(e)
+                    continue
+                self._throttle(job, bucket, e.errcode)
+                retry = job
+                if bucket == None:
+                    await asyncio.sleep(self._backoff(job))
+            except Exception as e:
+                self._counters['failed'] += 1
+                job.future.set_exception(e)
+
+    def _backoff(self, job: _SendJob) -> float:
+        return self.retry_base_delay * (2 ** (job.attempts - 1)) * random.uniform(0.5, 1.5)
+
+    def _throttle(self, job: _SendJob, bucket: Optional[TokenBucket], errcode: int):
+        job.attempts += 1
+        self._counters['retried'] += 1
+        delay = self._backoff(job)
+        # the quota is the endpoint's, so every worker of it holds off
+        if bucket != None:
+            bucket.pause(delay)
+        logger.warning(f'<infra> {job.endpoint} to {job.user_id} throttled with {errcode}, retry {job.attempts} in {delay:.1f}s')
+
+    def _log_failure(self, job: _SendJob, future: asyncio.Future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e != None:
+            logger.error(f'<infra> {job.endpoint} to {job.user_id} failed: {e!r}')
+
+    def stats(self) -> dict:
+        return {
+            'queues': { endpoint: sum(queue.qsize() for queue in queues) for endpoint, queues in self._queues.items() },
+            **self._counters,
+        }
+
+outbound = None
+
+def set_outbound(scheduler: OutboundScheduler):
+    global outbound
+    outbound = scheduler
+
+def new_outbound(client, outbound_config, workers=1):
+    '''
+    Rate limits are host-wide, each of `workers` processes gets its share
+    '''
+    rate_limits = { CUSTOM_SEND: (50, 100), TEMPLATE_SEND: (50, 100) }
+    if outbound_config != None:
+        rate_limits = outbound_config.RATE_LIMITS
+    rate_limits = { endpoint: (rate / workers, max(1, burst // workers)) for endpoint, (rate, burst) in rate_limits.items() }
+    if outbound_config == None:
+        return OutboundScheduler(client, rate_limits)
+    return OutboundScheduler(client, rate_limits,
+        concurrency=outbound_config.CONCURRENCY,
+        max_retries=outbound_config.MAX_RETRIES,
+        retry_base_delay=outbound_config.RETRY_BASE_DELAY,
+        max_queue_size=outbound_config.MAX_QUEUE_SIZE)
+
+def get_outbound() -> OutboundScheduler:
+    return outbound
+
+def init_outbound(client, outbound_config=None, workers=1):
+    scheduler = new_outbound(client, outbound_config, workers)
+    scheduler.start()
+    set_outbound(scheduler)
+    logger.info("<infra> outbound scheduler initialized")
+
+async def close_outbound(timeout=10):
+    if outbound != None:
+        await outbound.stop(timeout)
+        logger.info("<infra> outbound scheduler closed")
@@ -1,16 +1,96 @@
+import os
 import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from typing import TYPE_CHECKING
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from utils.logger import logger
+from utils.private_file import open_private
+
+if TYPE_CHECKING:
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+'''
+With several worker processes, scheduled jobs must run in one of them only
+
+Every worker creates its scheduler and adds the same jobs to it while it
+starts, but only the worker holding an exclusive lock on `lock_path` starts
+it. The lock is released by the kernel when its holder exits, and the other
+workers retry every `interval` seconds, so a respawned or surviving worker
+takes over and runs the jobs it added at startup.
+
+Schedulers are not shared between workers: a job added once the worker
+serves, as by a request handler, would only run in the worker that added it
+if that worker leads, so add_job refuses it in the others. Such jobs belong
+in service.job_service, which keeps them in MySQL.
+
+The lock file lives in a private directory, see utils/private_file.py, or
+any local user could hold it and stop every scheduled job.
+'''
+class LeaderElection:
+    def __init__(self, lock_path, interval=10):
+        self.lock_path = lock_path
+        self.interval = interval
+        self._file = None
+        self._task = None
+
+    def is_leader(self) -> bool:
+        return self._file != None
+
+    def try_acquire(self) -> bool:
+        if self._file != None:
+            return True
+        if fcntl == None:
+            # no file locks on this platform, assume a single process
+            self._file = True
+            return True
+        f = os.fdopen(open_private(self.lock_path, os.O_WRONLY | os.O_APPEND), 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    async def _campaign(self, on_elected):
+        while True:
+            try:
+                if self.try_acquire():
+                    break
+            except OSError:
+                # e.g. the lock directory refused by open_private, no worker could ever lead
+                logger.exception(f'<infra> process {os.getpid()} failed to take the scheduler lock {self.lock_path}, retrying')
+            await asyncio.sleep(self.interval)
+        logger.info(f"<infra> process {os.getpid()} elected to run the scheduler")
+        on_elected()
+
+    def start(self, on_elected):
+        self._task = asyncio.ensure_future(self._campaign(on_elected))
+
+    def stop(self):
+        if self._task != None:
+            self._task.cancel()
+            self._task = None
+        if self._file not in (None, True):
+            self._file.close()
+        self._file = None
 
 aio_scheduler = None
+election = None
+# set once the worker has added its startup jobs
+_frozen = False
 
-def set_scheduler(scheduler: AsyncIOScheduler):
+def set_scheduler(scheduler: 'AsyncIOScheduler'):
     global aio_scheduler
     aio_scheduler = scheduler
 
 def new_scheduler(loop):
+    # imported on first use, apscheduler alone takes a good part of the startup time
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
     if loop != None:
         return AsyncIOScheduler(event_loop=loop)
     return AsyncIOScheduler()
@@ -18,13 +98,51 @@ def new_scheduler(loop):
 def get_scheduler():
     return aio_scheduler
 
-def init_scheduler(loop):
+def is_leader() -> bool:
+    return election == None or election.is_leader()
+
+def add_job(func, trigger=None, **kw):
+    '''
+    Add a job to the scheduler of this worker, see the module docstring
+    Give it an `id`, every worker adds it alike
+    '''
+    if _frozen and not is_leader():
+        raise RuntimeError(f"process {os.getpid()} does not run the scheduler, job {kw.get('id', func)} would never run")
+    return aio_scheduler.add_job(func, trigger, **kw)
+
+def freeze_jobs():
+    '''
+    Mark the startup jobs added, called once the worker is about to serve
+    '''
+    global _frozen
+    _frozen = True
+
+def init_scheduler(loop, lock_path=None, interval=10):
+    '''
+    Without `lock_path` the scheduler starts right away
+    '''
+    global election
     scheduler = new_scheduler(loop)
     set_scheduler(scheduler)
-    scheduler.start()
+    if lock_path == None:
+        scheduler.start()
+    else:
+        election = LeaderElection(lock_path, interval)
+        election.start(scheduler.start)
     logger.info("<infra> scheduler initialized")
 
+def close_scheduler():
+    global election, _frozen
+    _frozen = False
+    if election != None:
+        election.stop()
+        election = None
+    if aio_scheduler != None and aio_scheduler.running:
+        aio_scheduler.shutdown(wait=False)
+        logger.info("<infra> scheduler closed")
+
 if __name__ == '__main__':
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
     def say_hello():
         print('hello')
     scheduler = AsyncIOScheduler()
@@ -0,0 +1,83 @@
+import time
+import asyncio
+
+from infra.access_token import AccessTokenManager, MemoryTokenStore, SQLiteTokenStore
+
+class _Fetch:
+    '''
+    Hands out token-1, token-2, ... or the same token every time with `same`
+    '''
+    def __init__(self, expires_in=7200, delay=0.01, same=False):
+        self.calls = 0
+        self.expires_in = expires_in
+        self.delay = delay
+        self.same = same
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return { 'access_token': 'token' if self.same else f'token-{self.calls}', 'expires_in': self.expires_in }
+
+def test_concurrent_callers_share_one_fetch():
+    fetch = _Fetch()
+    async def main():
+        manager = AccessTokenManager('appid', fetch)
+        return await asyncio.gather(*(manager.get_token() for _ in range(20)))
+    assert asyncio.run(main()) == ['token-1'] * 20
+    assert fetch.calls == 1
+
+def test_fresh_token_is_reused():
+    fetch = _Fetch()
+    async def main():
+        manager = AccessTokenManager('appid', fetch)
+        return [await manager.get_token() for _ in range(3)]
+    assert asyncio.run(main()) == ['token-1'] * 3
+    assert fetch.calls == 1
+
+def test_token_within_margin_is_refreshed():
+    # expires within the refresh margin as soon as it is fetched
+    fetch = _Fetch(expires_in=100)
+    async def main():
+        manager = AccessTokenManager('appid', fetch, refresh_margin=300)
+        return [await manager.get_token() for _ in range(2)]
+    assert asyncio.run(main()) == ['token-1', 'token-2']
+
+def test_stale_token_is_not_reused():
+    fetch = _Fetch()
+    async def main():
+        store = MemoryTokenStore()
+        manager = AccessTokenManager('appid', fetch, store)
+        token = await manager.get_token()
+        return token, await manager.refresh(stale_token=token), store.get('appid')[0]
+    assert asyncio.run(main()) == ('token-1', 'token-2', 'token-2')
+
+def test_refresh_is_bounded_when_wechat_repeats_the_token():
+    fetch = _Fetch(same=True)
+    async def main():
+        manager = AccessTokenManager('appid', fetch)
+        await manager.get_token()
+        return await asyncio.wait_for(manager.refresh(stale_token='token'), 1)
+    assert asyncio.run(main()) == 'token'
+    assert fetch.calls == 2
+
+def test_workers_share_the_sqlite_store(tmp_path):
+    path = str(tmp_path / 'run' / 'token.sqlite3')
+    fetch = _Fetch(delay=0.05)
+    async def main():
+        # a manager, and its store connection and lock, per worker process
+        managers = [AccessTokenManager('appid', fetch, SQLiteTokenStore(path)) for _ in range(3)]
+        return await asyncio.gather(*(m.get_token() for m in managers))
+    assert asyncio.run(main()) == ['token-1'] * 3
+    assert fetch.calls == 1
+    token, expires_at = SQLiteTokenStore(path).get('appid')
+    assert token == 'token-1' and expires_at > time.time()
+
+def test_keep_fresh_refreshes_in_background():
+    fetch = _Fetch(expires_in=100, delay=0)
+    async def main():
+        manager = AccessTokenManager('appid', fetch, refresh_margin=300, check_interval=0.01)
+        manager.start()
+        await asyncio.sleep(0.1)
+        await manager.stop()
+    asyncio.run(main())
+    assert fetch.calls > 1
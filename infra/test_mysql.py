@@ -0,0 +1,227 @@
+import asyncio
+
+import pytest
+
+from infra import mysql
+from infra.mysql import Model, ModelCache, IntegerField, StringField
+
+class CachedUser(Model):
+    __table__ = 'test_cached_user'
+    __cache__ = ModelCache(maxsize=100, ttl=60, negative_ttl=60)
+
+    open_id = StringField(primary_key=True)
+    name = StringField()
+    score = IntegerField()
+
+def _reset(model):
+    model.__cache__.clear()
+    model.__cache__.queries = 0
+
+def test_model_cache_single_flight():
+    cache = ModelCache()
+    loads = []
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return { 'open_id': 'a' }
+    async def main():
+        rows = await asyncio.gather(*(cache.get('a', load) for _ in range(5)))
+        rows.append(await cache.get('a', load))
+        return rows
+    assert asyncio.run(main()) == [{ 'open_id': 'a' }] * 6
+    assert len(loads) == 1
+    assert (cache.misses, cache.hits) == (5, 1)
+
+def test_model_cache_skips_a_load_overlapping_an_invalidation():
+    cache = ModelCache()
+    async def main():
+        async def stale():
+            # the row changes while it is read
+            cache.invalidate('a')
+            return { 'open_id': 'a', 'name': 'old' }
+        await cache.get('a', stale)
+        async def fresh():
+            return { 'open_id': 'a', 'name': 'new' }
+        return await cache.get('a', fresh)
+    assert asyncio.run(main())['name'] == 'new'
+
+def test_model_cache_negative_ttl():
+    cache = ModelCache(negative_ttl=0)
+    loads = []
+    async def load():
+        loads.append(1)
+    async def main():
+        await cache.get('a', load)
+        await cache.get('a', load)
+    asyncio.run(main())
+    assert len(loads) == 2
+
+def test_find_reads_through_the_cache(mysql_pool):
+    mysql_pool.create(CachedUser)
+    _reset(CachedUser)
+    async def main():
+        await CachedUser(open_id='a', name='alice', score=1).save()
+        first = await CachedUser.find('a')
+        second = await CachedUser.find('a')
+        missing = [await CachedUser.find('b'), await CachedUser.find('b')]
+        return first, second, missing
+    first, second, missing = asyncio.run(main())
+    assert first == second == { 'open_id': 'a', 'name': 'alice', 'score': 1 }
+    # copies, so changing one never changes the cached row
+    assert first is not second
+    assert missing == [None, None]
+    assert CachedUser.__cache__.queries == 2
+
+def test_writes_invalidate_the_cache(mysql_pool):
+    mysql_pool.create(CachedUser)
+    _reset(CachedUser)
+    async def main():
+        user = CachedUser(open_id='a', name='alice', score=1)
+        await user.save()
+        await CachedUser.find('a')
+        user.score = 2
+        await user.update()
+        updated = await CachedUser.find('a')
+        await user.remove()
+        removed = await CachedUser.find('a')
+        await CachedUser.save_many([{ 'open_id': 'a', 'name': 'again', 'score': 3 }])
+        return updated, removed, await CachedUser.find('a')
+    updated, removed, saved = asyncio.run(main())
+    assert updated.score == 2
+    assert removed is None
+    assert saved.name == 'again'
+
+class Account(Model):
+    __table__ = 'test_account'
+
+    open_id = StringField(primary_key=True)
+    name = StringField()
+
+class Counter(Model):
+    __table__ = 'test_counter'
+
+    counter_id = IntegerField(primary_key=True)
+    value = IntegerField()
+
+def _count_selects(monkeypatch) -> list:
+    queries = []
+    select = mysql.select
+    async def counting(sql, args, *rest, **kw):
+        queries.append(list(args))
+        return await select(sql, args, *rest, **kw)
+    monkeypatch.setattr(mysql, 'select', counting)
+    return queries
+
+def test_find_many_keeps_order(mysql_pool, monkeypatch):
+    mysql_pool.create(Account)
+    queries = _count_selects(monkeypatch)
+    async def main():
+        await Account.save_many(Account(open_id=f'u{i}', name=f'user {i}') for i in range(5))
+        return await Account.find_many(['u3', 'missing', 'u0', 'u3', 'u1', 'u4'], chunk_size=2)
+    found = asyncio.run(main())
+    assert [a.open_id if a else None for a in found] == ['u3', None, 'u0', 'u3', 'u1', 'u4']
+    assert found[0] is not found[3]
+    # distinct keys only, two per query
+    assert queries == [['u3', 'missing'], ['u0', 'u1'], ['u4']]
+
+def test_find_many_matches_keys_as_mysql_compares_them(mysql_pool):
+    mysql_pool.create(Account, Counter)
+    async def main():
+        await Account(open_id='Alice', name='alice').save()
+        await Counter(counter_id=7, value=1).save()
+        return await Account.find_many(['alice', 'ALICE ', 'bob']), await Counter.find_many(['7', 7])
+    accounts, counters = asyncio.run(main())
+    assert [a.name if a else None for a in accounts] == ['alice', 'alice', None]
+    assert [c.value for c in counters] == [1, 1]
+
+def test_find_many_agrees_with_find(mysql_pool):
+    mysql_pool.create(Account)
+    keys = ['Alice', 'alice ', 'BOB', 'carol', 'nobody']
+    async def main():
+        await Account(open_id='alice', name='a').save()
+        await Account(open_id='Bob', name='b').save()
+        await Account(open_id='carol', name='c').save()
+        return await Account.find_many(keys), [await Account.find(pk) for pk in keys]
+    many, one_by_one = asyncio.run(main())
+    assert many == one_by_one
+
+def test_load_batches_concurrent_lookups(mysql_pool, monkeypatch):
+    mysql_pool.create(Account)
+    async def main():
+        await Account.save_many(Account(open_id=f'u{i}', name=f'user {i}') for i in range(3))
+        queries = _count_selects(monkeypatch)
+        accounts = await asyncio.gather(*(Account.load(pk) for pk in ['u2', 'u0', 'u2', 'nobody']))
+        return accounts, queries
+    accounts, queries = asyncio.run(main())
+    assert [a.open_id if a else None for a in accounts] == ['u2', 'u0', 'u2', None]
+    assert accounts[0] is not accounts[2]
+    assert len(queries) == 1
+
+def test_update_many(mysql_pool):
+    mysql_pool.create(Account)
+    async def main():
+        await Account.save_many(Account(open_id=f'u{i}', name=f'user {i}') for i in range(5))
+        updated = await mysql.update_many('test_account', 'open_id', ('name',), [(f'new {i}', f'u{i}') for i in (4, 0, 2)] + [('ghost', 'nobody')], chunk_size=2)
+        return updated, await Account.findAll(orderBy='open_id')
+    updated, accounts = asyncio.run(main())
+    assert updated == 3
+    assert [a.name for a in accounts] == ['new 0', 'user 1', 'new 2', 'user 3', 'new 4']
+
+def test_update_many_checks_the_version(mysql_pool):
+    mysql_pool.create(Counter)
+    async def main():
+        await Counter.save_many([Counter(counter_id=1, value=10), Counter(counter_id=2, value=20)])
+        # value is both the version and set, the WHERE reads it before the SET
+        updated = await mysql.update_many('test_counter', 'counter_id', ('value',), [(11, 1, 10), (21, 2, 19)], version='value')
+        return updated, [c.value for c in await Counter.findAll(orderBy='counter_id')]
+    assert asyncio.run(main()) == (1, [11, 20])
+
+class SlimUser(Model):
+    __table__ = 'test_slim_user'
+    __slots_rows__ = True
+    __cache__ = ModelCache()
+
+    open_id = StringField(primary_key=True)
+    name = StringField()
+    score = IntegerField()
+
+def test_row_class_is_slotted():
+    row = SlimUser.__row_class__(open_id='a', name='alice', score=1)
+    assert not hasattr(row, '__dict__')
+    assert row.__columns__ == ('open_id', 'name', 'score')
+    with pytest.raises(AttributeError):
+        row.nickname = 'al'
+
+def test_row_reads_as_a_mapping():
+    row = SlimUser.__row_class__(open_id='a', name='alice', score=1)
+    assert row['name'] == 'alice'
+    assert dict(row) == { 'open_id': 'a', 'name': 'alice', 'score': 1 }
+    assert row == SlimUser.__row_class__(open_id='a', name='alice', score=1)
+    assert row != SlimUser.__row_class__(open_id='a', name='alice', score=2)
+    assert 'score' in row and 'nickname' not in row
+    assert row.get('nickname', 'none') == 'none'
+    row['score'] = 2
+    assert row.score == 2
+
+def test_rows_load_and_write(mysql_pool):
+    mysql_pool.create(SlimUser)
+    SlimUser.__cache__.clear()
+    Row = SlimUser.__row_class__
+    async def main():
+        await SlimUser.save_many([Row(open_id=f'u{i}', name=f'user {i}', score=i) for i in range(4)])
+        found = await SlimUser.find('u1')
+        found.score = 10
+        await found.update()
+        await (await SlimUser.find('u2')).remove()
+        # defaults filled in on save, as for models
+        await Row(open_id='u9', name='nine').save()
+        rows = await SlimUser.findAll(orderBy='open_id')
+        streamed = [row async for row in SlimUser.iterAll(batch_size=2)]
+        many = await SlimUser.find_many(['u3', 'u1'])
+        return found, rows, streamed, many
+    found, rows, streamed, many = asyncio.run(main())
+    assert type(found) is SlimUser.__row_class__
+    assert [(r.open_id, r.score) for r in rows] == [('u0', 0), ('u1', 10), ('u3', 3), ('u9', 0)]
+    assert sorted(streamed, key=lambda r: r.open_id) == rows
+    assert all(type(r) is SlimUser.__row_class__ for r in rows + streamed + many)
+    assert [r.open_id for r in many] == ['u3', 'u1']
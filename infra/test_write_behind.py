@@ -0,0 +1,131 @@
+import asyncio
+
+from infra import mysql
+from infra.mysql import Model, IntegerField, StringField
+from infra.write_behind import WriteBehindBuffer
+
+class LastSeen(Model):
+    __table__ = 'test_last_seen'
+    __write_behind__ = True
+
+    open_id = StringField(primary_key=True)
+    seen_at = IntegerField()
+
+def _rows(pool):
+    return sorted(pool.db.execute('select open_id, seen_at from test_last_seen').fetchall())
+
+def _run(pool, scenario, **kw):
+    '''
+    Run `scenario(buffer)` with a started buffer, the timer off, and stop it
+    '''
+    pool.create(LastSeen)
+    async def main():
+        buffer = WriteBehindBuffer(interval=3600, **kw)
+        buffer.start()
+        mysql.set_write_buffer(buffer)
+        try:
+            return await scenario(buffer)
+        finally:
+            mysql.set_write_buffer(None)
+            await buffer.stop()
+    return asyncio.run(main())
+
+def test_writes_are_coalesced_until_flushed(mysql_pool):
+    async def scenario(buffer):
+        for seen_at in range(3):
+            await LastSeen(open_id='a', seen_at=seen_at).save()
+        await LastSeen(open_id='b', seen_at=1).save()
+        assert _rows(mysql_pool) == []
+        assert await buffer.flush() == 2
+        return buffer.stats()
+    stats = _run(mysql_pool, scenario)
+    assert _rows(mysql_pool) == [('a', 2), ('b', 1)]
+    assert (stats['buffered'], stats['coalesced'], stats['flushed']) == (4, 2, 2)
+
+def test_update_inserts_no_row(mysql_pool):
+    async def scenario(buffer):
+        await mysql.execute('insert into test_last_seen (open_id, seen_at) values (?, ?)', ['a', 1])
+        await LastSeen(open_id='a', seen_at=2).update()
+        # never saved, or removed since
+        await LastSeen(open_id='b', seen_at=2).update()
+        await buffer.flush()
+    _run(mysql_pool, scenario)
+    assert _rows(mysql_pool) == [('a', 2)]
+
+def test_update_of_a_buffered_save_inserts_it(mysql_pool):
+    async def scenario(buffer):
+        await LastSeen(open_id='a', seen_at=1).save()
+        await LastSeen(open_id='a', seen_at=2).update()
+        await buffer.flush()
+    _run(mysql_pool, scenario)
+    assert _rows(mysql_pool) == [('a', 2)]
+
+def test_remove_drops_the_buffered_row(mysql_pool):
+    async def scenario(buffer):
+        await LastSeen(open_id='a', seen_at=1).save()
+        await LastSeen(open_id='a').remove()
+        await buffer.flush()
+    _run(mysql_pool, scenario)
+    assert _rows(mysql_pool) == []
+
+def test_remove_waits_for_the_flush_in_flight(mysql_pool, monkeypatch):
+    executemany = mysql.executemany
+    async def slow(*args, **kw):
+        await asyncio.sleep(0.05)
+        return await executemany(*args, **kw)
+    monkeypatch.setattr(mysql, 'executemany', slow)
+    async def scenario(buffer):
+        await LastSeen(open_id='a', seen_at=1).save()
+        flush = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+        # the flush holds the row, it must not be written after the DELETE
+        await LastSeen(open_id='a').remove()
+        await flush
+    _run(mysql_pool, scenario)
+    assert _rows(mysql_pool) == []
+
+def test_failed_flush_is_restored_behind_newer_writes(mysql_pool, monkeypatch):
+    executemany = mysql.executemany
+    failures = [1]
+    async def failing(*args, **kw):
+        if failures:
+            failures.pop()
+            await asyncio.sleep(0.01)
+            raise ConnectionError('lost')
+        return await executemany(*args, **kw)
+    monkeypatch.setattr(mysql, 'executemany', failing)
+    async def scenario(buffer):
+        await LastSeen(open_id='a', seen_at=1).save()
+        await LastSeen(open_id='b', seen_at=1).save()
+        flush = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+        # written while the failing flush runs
+        await LastSeen(open_id='a', seen_at=2).update()
+        assert await flush == 0
+        assert await buffer.flush() == 2
+        return buffer.stats()
+    stats = _run(mysql_pool, scenario)
+    # a's save failed, so its newer update still inserts it
+    assert _rows(mysql_pool) == [('a', 2), ('b', 1)]
+    assert (stats['failed'], stats['flushed']) == (2, 2)
+
+def test_max_buffered(mysql_pool):
+    async def scenario(buffer):
+        for i in range(5):
+            await LastSeen(open_id=f'u{i}', seen_at=1).save()
+        # a buffered key is still written
+        await LastSeen(open_id='u0', seen_at=2).save()
+        stats = buffer.stats()
+        await buffer.flush()
+        return stats
+    stats = _run(mysql_pool, scenario, max_buffered=3)
+    assert (stats['pending'], stats['lost']) == (3, 2)
+    assert _rows(mysql_pool) == [('u0', 2), ('u1', 1), ('u2', 1)]
+
+def test_max_pending_flushes_early(mysql_pool):
+    async def scenario(buffer):
+        for i in range(3):
+            await LastSeen(open_id=f'u{i}', seen_at=1).save()
+        await asyncio.sleep(0.01)
+    _run(mysql_pool, scenario, max_pending=3)
+    assert len(_rows(mysql_pool)) == 3
@@ -1,4 +1,6 @@
-from wechatpy.client import WeChatClient
+import config
+from infra.aiowechat import AsyncWeChatClient
+from infra.access_token import SQLiteTokenStore
 from utils.logger import logger
 
 wx_client = None
@@ -7,13 +9,35 @@ def set_wx_client(client):
     global wx_client
     wx_client = client
 
+def new_token_store():
+    # without TOKEN_STORE, each process keeps its own access_token
+    store = getattr(config, 'TOKEN_STORE', None)
+    if store == None:
+        return None
+    return SQLiteTokenStore(store.PATH)
+
 def new_wx_client(id, secret):
-    return WeChatClient(id, secret)
+    http = getattr(config, 'WECHAT_HTTP', None)
+    if http == None:
+        return AsyncWeChatClient(id, secret, token_store=new_token_store())
+    return AsyncWeChatClient(id, secret,
+        timeout=http.TIMEOUT,
+        max_connections=http.MAX_CONNECTIONS,
+        max_keepalive_connections=http.MAX_KEEPALIVE_CONNECTIONS,
+        http2=http.HTTP2,
+        token_store=new_token_store())
 
-def get_wx_client():
+def get_wx_client() -> AsyncWeChatClient:
     return wx_client
 
 def init_wx_client(id, secret):
     client = new_wx_client(id, secret)
     set_wx_client(client)
-    logger.info("<infra> wechat client initialized")
\ No newline at end of file
+    # keep the access_token fresh in the background
+    client.start()
+    logger.info("<infra> wechat client initialized")
+
+async def close_wx_client():
+    if wx_client != None:
+        await wx_client.aclose()
+        logger.info("<infra> wechat client closed")
@@ -0,0 +1,134 @@
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Hashable
+
+from utils.logger import logger
+
+'''
+Bounded pool of asyncio workers draining an in-process queue
+
+Jobs sharing a key (e.g. an openid) run one at a time in submission order,
+jobs with different keys run concurrently on up to `workers` coroutines.
+When `max_queue_size` jobs are waiting, new jobs are refused.
+'''
+Job = Callable[[], Awaitable]
+
+class KeyedWorkerPool:
+    def __init__(self, workers: int = 16, max_queue_size: int = 1000, wait_samples: int = 1024):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self._pending: Dict[Hashable, deque] = {}
+        self._ready = None
+        self._tasks = []
+        self._depth = 0
+        self._busy = 0
+        self._waits = deque(maxlen=wait_samples)
+        self._counters = { 'submitted': 0, 'processed': 0, 'failed': 0, 'dropped': 0 }
+        self._max_depth = 0
+        self._max_wait = 0.0
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._work(i)) for i in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        '''
+        Wait up to `timeout` seconds for queued jobs, then cancel the workers
+        '''
+        deadline = time.monotonic() + timeout
+        while self._depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._depth:
+            logger.warning(f'<infra> worker pool stopped with {self._depth} jobs unprocessed')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, key: Hashable, job: Job) -> bool:
+        if self._depth >= self.max_queue_size:
+            self._counters['dropped'] += 1
+            return False
+        self._depth += 1
+        self._counters['submitted'] += 1
+        if self._depth > self._max_depth:
+            self._max_depth = self._depth
+        item = (time.monotonic(), job)
+        if key in self._pending:
+            # a worker already owns this key, it will pick the job up in order
+            self._pending[key].append(item)
+        else:
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        return True
+
+    async def _work(self, worker_id: int):
+        while True:
+            key = await self._ready.get()
+            jobs = self._pending[key]
+            enqueued_at, job = jobs[0]
+            wait = time.monotonic() - enqueued_at
+            self._waits.append(wait)
+            if wait > self._max_wait:
+                self._max_wait = wait
+            self._busy += 1
+            try:
+                await job()
+                self._counters['processed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._counters['failed'] += 1
+                logger.exception(f'<infra> worker {worker_id} failed to process job of {key}')
+            finally:
+                self._busy -= 1
+                self._depth -= 1
+                jobs.popleft()
+                if jobs:
+                    # requeue at the tail, so one busy key cannot starve the others
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+        return {
+            'workers': self.workers,
+            'busy_workers': self._busy,
+            'queue_depth': self._depth,
+            'max_queue_depth': self._max_depth,
+            'max_queue_size': self.max_queue_size,
+            'pending_keys': len(self._pending),
+            'wait_p50': percentile(0.5),
+            'wait_p99': percentile(0.99),
+            'wait_max': self._max_wait,
+            **self._counters,
+        }
+
+worker_pool = None
+
+def set_worker_pool(pool: KeyedWorkerPool):
+    global worker_pool
+    worker_pool = pool
+
+def new_worker_pool(workers, max_queue_size):
+    return KeyedWorkerPool(workers, max_queue_size)
+
+def get_worker_pool() -> KeyedWorkerPool:
+    return worker_pool
+
+def init_worker_pool(workers, max_queue_size):
+    pool = new_worker_pool(workers, max_queue_size)
+    pool.start()
+    set_worker_pool(pool)
+    logger.info(f"<infra> worker pool initialized with {workers} workers")
+
+async def close_worker_pool(timeout=10):
+    if worker_pool != None:
+        await worker_pool.stop(timeout)
+        logger.info("<infra> worker pool closed")
@@ -0,0 +1,228 @@
+import time
+import asyncio
+from time import perf_counter
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from infra import metrics
+from infra import mysql
+from utils.logger import logger
+
+'''
+Write-behind of loss-tolerant models
+
+Models declaring `__write_behind__ = True`, such as last-seen timestamps or
+event logs, do not write on `save` and `update`. The row is buffered per
+primary key instead, a later write of the same key replacing it, and every
+`interval` seconds, or once `max_pending` rows are buffered, all of them are
+written in one transaction per model and kind of write: saved rows as upserts
+(INSERT ... ON DUPLICATE KEY UPDATE), updated rows as batched UPDATEs, which
+insert no row deleted or never saved meanwhile. An update of a row saved in
+the buffer is written as an upsert, as the save would have been. `remove`
+drops the buffered row of its key.
+
+Direct writes of these models, `remove`, `remove_many` and `save_many`, run
+under `exclusive`, so no flush runs at the same time: a flush holding an older
+row of a key can neither upsert it after the DELETE or INSERT of that key,
+nor restore it when it fails.
+
+Reads do not see buffered rows until they are flushed, and a worker crashing
+loses its buffered rows, at most `interval` seconds of writes. Rows of a
+failed flush are kept for the next one, and at most `max_buffered` rows are
+buffered in all: while flushes fail, writes of more keys are dropped.
+
+Each worker buffers its own writes, so the flush runs in every worker on a
+timer of its own rather than as a scheduler job, which only the elected
+worker runs.
+'''
+class WriteBehindBuffer:
+    def __init__(self, interval: float = 1, max_pending: int = 1000, max_buffered: int = 100000, chunk_size=None):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self.chunk_size = chunk_size
+        # model -> primary key -> (upsert, insert arguments), upsert False for a plain update
+        self._pending: Dict[type, Dict] = {}
+        self._size = 0
+        # when the oldest buffered row was written
+        self._since = None
+        self._lock = None
+        self._task = None
+        self._size_flush = None
+        self._counters = { 'buffered': 0, 'coalesced': 0, 'flushed': 0, 'failed': 0, 'lost': 0, 'flushes': 0 }
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+
+    def start(self):
+        self._lock = asyncio.Lock()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        '''
+        Stop the timer and flush what is buffered, rows still not written are lost
+        '''
+        if self._task != None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._size:
+            logger.error(f'<infra> {self._size} buffered writes lost on shutdown')
+            self._count('lost', self._size)
+            self._pending = {}
+            self._set_size(0)
+
+    def add(self, model, upsert=True):
+        '''
+        Buffer a save of `model`, or an update with `upsert=False`
+        '''
+        rows = self._pending.setdefault(model.__model__, {})
+        pk = model.getValue(model.__primary_key__)
+        if pk in rows:
+            self._count('coalesced')
+            # the save buffered is not written yet, so the row may not exist
+            upsert = upsert or rows[pk][0]
+        elif self._size >= self.max_buffered:
+            # flushes keep failing, the rows already buffered are kept, as in _restore
+            self._count('lost')
+            return
+        else:
+            self._set_size(self._size + 1)
+        rows[pk] = (upsert, model._insert_args())
+        self._count('buffered')
+        if self._since == None:
+            self._since = time.monotonic()
+        model._invalidate(pk)
+        if self._size >= self.max_pending and (self._size_flush == None or self._size_flush.done()):
+            self._size_flush = asyncio.ensure_future(self.flush())
+
+    @asynccontextmanager
+    async def exclusive(self):
+        '''
+        Hold flushes off while a direct write runs, waiting for the one in flight
+        '''
+        if self._lock == None:
+            yield
+            return
+        async with self._lock:
+            yield
+
+    def discard(self, model_class, pk):
+        rows = self._pending.get(model_class)
+        if rows and rows.pop(pk, None) != None:
+            self._set_size(self._size - 1)
+
+    async def flush(self) -> int:
+        '''
+        Write every buffered row, return how many were written
+        '''
+        async with self._lock:
+            if not self._size:
+                return 0
+            pending, self._pending = self._pending, {}
+            since, self._since = self._since, None
+            self._set_size(0)
+            start = perf_counter()
+            flushed = 0
+            for model, pending_rows in pending.items():
+                for upsert in (True, False):
+                    rows = { pk: row for pk, row in pending_rows.items() if row[0] == upsert }
+                    if not rows:
+                        continue
+                    try:
+                        await self._write(model, upsert, [args for _, args in rows.values()])
+                    except Exception:
+                        logger.exception(f'<infra> failed to flush {len(rows)} buffered writes of {model.__table__}')
+                        self._count('failed', len(rows))
+                        self._restore(model, rows, since)
+                        continue
+                    flushed += len(rows)
+                    # reads cached while the rows were buffered are outdated now
+                    for pk in rows:
+                        model._invalidate(pk)
+            elapsed = perf_counter() - start
+            self._counters['flushes'] += 1
+            self._last_flush_seconds = elapsed
+            self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+            self._count('flushed', flushed)
+            if metrics.enabled:
+                metrics.write_behind_flush_seconds.observe(elapsed)
+            return flushed
+
+    async def _write(self, model, upsert: bool, args_list: list):
+        if upsert:
+            await mysql.executemany(model.__upsert__, args_list, self.chunk_size)
+        else:
+            columns = [model.__mappings__[f].name or f for f in model.__fields__]
+            await mysql.update_many(model.__table__, model.__primary_key__, columns, args_list, self.chunk_size)
+
+    def _restore(self, model, rows: dict, since):
+        current = self._pending.setdefault(model, {})
+        size = self._size
+        for pk, (upsert, args) in rows.items():
+            # written again since, the newer row wins, inserting it if the failed one would have
+            if pk in current:
+                if upsert and not current[pk][0]:
+                    current[pk] = (True, current[pk][1])
+                continue
+            if size >= self.max_buffered:
+                self._count('lost')
+                continue
+            current[pk] = (upsert, args)
+            size += 1
+        self._set_size(size)
+        if since != None and (self._since == None or since < self._since):
+            self._since = since
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('<infra> write-behind flush failed')
+
+    def _count(self, result: str, amount=1):
+        self._counters[result] += amount
+        if metrics.enabled and amount:
+            metrics.write_behind_writes_total.inc(result, amount=amount)
+
+    def _set_size(self, size: int):
+        self._size = size
+        if metrics.enabled:
+            metrics.write_behind_pending.set(size)
+
+    def stats(self) -> dict:
+        return {
+            'pending': self._size,
+            'oldest_pending_seconds': time.monotonic() - self._since if self._since != None else 0,
+            'last_flush_seconds': self._last_flush_seconds,
+            'max_flush_seconds': self._max_flush_seconds,
+            **self._counters,
+        }
+
+write_behind = None
+
+def get_write_behind() -> WriteBehindBuffer:
+    return write_behind
+
+def init_write_behind(write_behind_config=None):
+    global write_behind
+    if write_behind_config == None:
+        write_behind = WriteBehindBuffer()
+    else:
+        write_behind = WriteBehindBuffer(
+            interval=write_behind_config.INTERVAL,
+            max_pending=write_behind_config.MAX_PENDING,
+            max_buffered=write_behind_config.MAX_BUFFERED)
+    write_behind.start()
+    mysql.set_write_buffer(write_behind)
+    logger.info("<infra> write-behind buffer initialized")
+
+async def close_write_behind():
+    global write_behind
+    if write_behind != None:
+        mysql.set_write_buffer(None)
+        await write_behind.stop()
+        write_behind = None
+        logger.info("<infra> write-behind buffer closed")
@@ -1,28 +1,86 @@
 # -*- coding: utf-8 -*-
 from infra.quart_app import app
-from infra.scheduler import init_scheduler
+from infra.scheduler import init_scheduler, close_scheduler, freeze_jobs
 #from infra.mysql import init_pool, init_tables
-from infra.wechat import init_wx_client
+from infra.mysql import pool_stats
+from infra.write_behind import init_write_behind, close_write_behind, get_write_behind
+from infra.wechat import init_wx_client, close_wx_client, get_wx_client
+from infra.outbound import init_outbound, close_outbound, get_outbound
+from infra.worker_pool import init_worker_pool, close_worker_pool, get_worker_pool
+from infra.crypto import init_crypto, get_crypto, check_signature
+from infra import metrics
 from utils.logger import logger
 
 import os, asyncio, json
+from time import perf_counter
+from functools import wraps
 from quart import request
 
 from wechatpy import parse_message, create_reply
-from wechatpy.utils import check_signature
 
-from dispatcher import msg_dispatcher
+import config
+from dispatcher import msg_dispatcher, msg_enqueuer
+from dispatcher.dedup import deduplicator
 from service import wechat_service
-from utils.deco import controller, api_controller
+from service.job_service import init_job_service, close_job_service, get_job_runner
+from service import broadcast_service
+from dao.domain import User
+from utils.deco import controller, api_controller, admin_only, InvalidRequestError
 from config import APP_ID, APP_SECRET, APP_TOKEN, APP_AES_KEY
 
+# worker processes on this host, set by serve.py
+WORKERS = int(os.environ.get('SERVE_WORKERS', 1))
+SCHEDULER = getattr(config, 'SCHEDULER', None)
+
+# acknowledge-then-process mode, see DISPATCH in _config.py
+DISPATCH = getattr(config, 'DISPATCH', None)
+ASYNC_DISPATCH = DISPATCH != None and DISPATCH.ASYNC
+
 @app.before_serving
 async def startup():
     loop = asyncio.get_event_loop()
-    init_scheduler(loop)
+    if SCHEDULER == None:
+        init_scheduler(loop)
+    else:
+        # only the elected worker runs scheduled jobs
+        init_scheduler(loop, SCHEDULER.LEADER_LOCK, SCHEDULER.ELECTION_INTERVAL)
     # await init_pool(loop)
     # await init_tables()
+    # init_job_service()
+    # broadcast_service.init_broadcast_service()
+    init_write_behind(getattr(config, 'WRITE_BEHIND', None))
     init_wx_client(APP_ID, APP_SECRET)
+    init_outbound(get_wx_client(), getattr(config, 'OUTBOUND', None), WORKERS)
+    init_crypto(APP_TOKEN, APP_AES_KEY, APP_ID)
+    if ASYNC_DISPATCH:
+        init_worker_pool(DISPATCH.WORKERS, DISPATCH.MAX_QUEUE_SIZE)
+    # jobs added from now on only run in the worker running the scheduler
+    freeze_jobs()
+
+@app.after_serving
+async def shutdown():
+    await close_worker_pool()
+    await broadcast_service.close_broadcast_service()
+    await close_outbound()
+    await close_write_behind()
+    await close_wx_client()
+    close_job_service()
+    close_scheduler()
+
+async def acknowledge(msg):
+    accepted = await msg_enqueuer(msg)
+    if accepted == False and DISPATCH.SHED_POLICY == 'reject':
+        # let WeChat retry the message later
+        return "", 503
+    return "success"
+
+def render(reply) -> str:
+    if not metrics.enabled:
+        return reply.render()
+    start = perf_counter()
+    xml = reply.render()
+    metrics.observe_stage('render', start)
+    return xml
 
 @app.route("/wechat", methods=["GET", "POST"])
 @controller
@@ -33,7 +91,11 @@ async def wechat():
     encrypt_type = request.args.get("encrypt_type", "raw")
     msg_signature = request.args.get("msg_signature", "")
     request_body = await request.data
+    if metrics.enabled:
+        start = perf_counter()
     check_signature(APP_TOKEN, signature, timestamp, nonce)
+    if metrics.enabled:
+        metrics.observe_stage('signature', start)
 
     if request.method == "GET":
         echo_str = request.args.get("echostr", "")
@@ -42,18 +104,33 @@ async def wechat():
     # POST request
     if encrypt_type == "raw":
         # plaintext mode
+        if ASYNC_DISPATCH:
+            return await acknowledge(request_body)
         reply = await msg_dispatcher(request_body)
         if reply != None:
-            return reply.render()
+            return render(reply)
         else:
             return ""
     else:
         # encryption mode
-        from wechatpy.crypto import WeChatCrypto
-        crypto = WeChatCrypto(APP_TOKEN, APP_AES_KEY, APP_ID)
-        msg = crypto.decrypt_message(request_body, msg_signature, timestamp, nonce)
+        crypto = get_crypto()
+        if metrics.enabled:
+            start = perf_counter()
+        msg = await crypto.decrypt_message(request_body, msg_signature, timestamp, nonce)
+        if metrics.enabled:
+            metrics.observe_stage('decrypt', start)
+        if ASYNC_DISPATCH:
+            return await acknowledge(msg)
         reply = await msg_dispatcher(msg)
-        return crypto.encrypt_message(reply.render(), nonce, timestamp)
+        if reply == None:
+            return ""
+        xml = render(reply)
+        if metrics.enabled:
+            start = perf_counter()
+        encrypted = await crypto.encrypt_message(xml, nonce, timestamp)
+        if metrics.enabled:
+            metrics.observe_stage('encrypt', start)
+        return encrypted
 
 @app.route("/api/generateQrCode", methods=["POST"])
 @api_controller
@@ -61,5 +138,91 @@ async def getSubcriptionQrCode():
     request_body = await request.get_json()
     return await wechat_service.generate_qr_code(request_body)
 
+@app.route("/api/generateQrCodes", methods=["POST"])
+@api_controller
+async def getSubcriptionQrCodes():
+    # a JSON array of bodies, answered in the same order
+    request_body = await request.get_json()
+    if not isinstance(request_body, list) or len(request_body) > wechat_service.QR_CODE_BULK_MAX_SIZE:
+        raise InvalidRequestError(f'expect a JSON array of at most {wechat_service.QR_CODE_BULK_MAX_SIZE} bodies')
+    return await wechat_service.generate_qr_codes(request_body)
+
+@app.route("/api/createBroadcast", methods=["POST"])
+@admin_only
+@api_controller
+async def createBroadcast():
+    # { template_id, data, url, open_ids }, to every user without open_ids
+    request_body = await request.get_json()
+    open_ids = request_body.get('open_ids')
+    if open_ids != None and not isinstance(open_ids, list):
+        raise InvalidRequestError('expect open_ids to be a JSON array')
+    audience = open_ids if open_ids != None else User
+    broadcast_id = await broadcast_service.create_broadcast(request_body['template_id'], request_body['data'], audience, request_body.get('url', ''))
+    return { 'broadcast_id': broadcast_id }
+
+@app.route("/api/broadcastProgress", methods=["GET"])
+@admin_only
+@api_controller
+async def getBroadcastProgress():
+    return await broadcast_service.get_broadcast(request.args.get('broadcast_id'))
+
+@app.route("/api/cancelBroadcast", methods=["POST"])
+@admin_only
+@api_controller
+async def cancelBroadcast():
+    request_body = await request.get_json()
+    return { 'cancelled': await broadcast_service.cancel_broadcast(request_body['broadcast_id']) }
+
+def stats_route(func):
+    # internal state, served to admins and only with METRICS.ENABLED, like /metrics
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return "metrics are disabled", 404
+        return await func(*args, **kwargs)
+    return admin_only(wrapper)
+
+@app.route("/api/dispatchStats", methods=["GET"])
+@stats_route
+@api_controller
+async def getDispatchStats():
+    stats = { 'dedup': deduplicator.stats() }
+    pool = get_worker_pool()
+    if pool != None:
+        stats.update(pool.stats())
+    return stats
+
+@app.route("/api/outboundStats", methods=["GET"])
+@stats_route
+@api_controller
+async def getOutboundStats():
+    return get_outbound().stats()
+
+@app.route("/api/mysqlStats", methods=["GET"])
+@stats_route
+@api_controller
+async def getMysqlStats():
+    return pool_stats()
+
+@app.route("/api/jobStats", methods=["GET"])
+@stats_route
+@api_controller
+async def getJobStats():
+    runner = get_job_runner()
+    return runner.stats() if runner != None else {}
+
+@app.route("/api/writeBehindStats", methods=["GET"])
+@stats_route
+@api_controller
+async def getWriteBehindStats():
+    return get_write_behind().stats()
+
+@app.route("/metrics", methods=["GET"])
+@admin_only
+async def getMetrics():
+    if not metrics.enabled:
+        return "metrics are disabled", 404
+    return metrics.render(), 200, { 'Content-Type': metrics.CONTENT_TYPE }
+
 if __name__ == '__main__':
     app.run('0.0.0.0', 80)
\ No newline at end of file
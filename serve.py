@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-process server
+
+The app is imported once in this parent process, which registers every handler
+and freezes the dispatcher, and the Chinese conversion tables are built as well.
+The listening sockets are bound here too, then one worker per core is forked.
+Workers share the prebuilt state copy-on-write, accept on the same sockets and
+only set up their own connections in `run.startup`. A worker that dies is
+replaced, SIGTERM or SIGINT stops all of them.
+
+Usage:
+    python serve.py [--bind 0.0.0.0:80] [--workers 4]
+'''
+import argparse
+import asyncio
+import gc
+import os
+import signal
+import sys
+import time
+
+from hypercorn.config import Config
+from hypercorn.asyncio.run import worker_serve
+
+# a worker dying sooner than this after its start is respawned with a delay, not in a loop
+MIN_WORKER_LIFETIME = 1
+
+def prebuild():
+    import run
+    from utils.format import preload
+    preload()
+    # keep the garbage collector from touching, and so copying, the shared objects
+    gc.collect()
+    gc.freeze()
+    return run.app
+
+def reset_logging(app):
+    # Quart logs through a queue drained by a thread, and threads do not survive the fork
+    from logging.handlers import QueueHandler
+    from quart.logging import default_handler
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, QueueHandler):
+            app.logger.removeHandler(handler)
+            app.logger.addHandler(default_handler)
+
+def serve_worker(app, config: Config, sockets):
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    reset_logging(app)
+    try:
+        asyncio.run(worker_serve(app, config, sockets=sockets))
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+class Supervisor:
+    def __init__(self, app, config: Config, workers: int):
+        self.app = app
+        self.config = config
+        self.workers = workers
+        self.sockets = config.create_sockets()
+        self._children = {}
+        self._stopping = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(self.app, self.config, self.sockets)
+        self._children[pid] = time.monotonic()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.workers):
+            self._spawn()
+        print(f'Serving {self.config.bind} with {self.workers} workers', file=sys.stderr)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_at = self._children.pop(pid, None)
+            if started_at == None or self._stopping:
+                continue
+            print(f'Worker {pid} exited with status {status}, respawning', file=sys.stderr)
+            if time.monotonic() - started_at < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self._stopping:
+                self._spawn()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', action='append', help='host:port, may be repeated, 0.0.0.0:80 by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # read by run.py to split host-wide limits between workers
+    os.environ['SERVE_WORKERS'] = str(args.workers)
+    config = Config()
+    config.bind = args.bind or ['0.0.0.0:80']
+    config.workers = args.workers
+    Supervisor(prebuild(), config, args.workers).run()
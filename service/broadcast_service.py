@@ -0,0 +1,271 @@
+import os, json, time, uuid, socket, asyncio, importlib
+from datetime import datetime
+from typing import List, Optional
+
+from wechatpy.exceptions import WeChatClientException
+
+import config
+from dao.broadcast import Broadcast, BroadcastRecipient
+from infra import metrics, scheduler
+from infra.mysql import Model, execute
+from infra.outbound import get_outbound
+from utils.logger import logger
+
+'''
+Template message broadcasts
+
+A broadcast sends one template message to an audience: an iterable of
+openids, kept as pending BroadcastRecipient rows first, or the rows of a
+model matching a where clause. The audience is scanned in primary key order
+in batches of BROADCAST.BATCH_SIZE, sent through the outbound scheduler,
+which applies the template rate limit, with at most BROADCAST.CONCURRENCY
+sends in flight. After each batch its results are written as
+BroadcastRecipient rows with one save_many and the primary key reached is
+checkpointed to the Broadcast row.
+
+A broadcast runs in the worker that created it, which refreshes the
+Broadcast row at least every BROADCAST.STALE_AFTER / 4 seconds. Broadcasts
+not refreshed for BROADCAST.STALE_AFTER seconds, as when their worker
+crashed, are taken over from their checkpoint by the worker running the
+scheduler. Sends of the batch in flight during a crash may go out twice.
+
+    broadcast_id = await create_broadcast(template_id, { 'first': { 'value': 'hello' } }, User)
+    await get_broadcast(broadcast_id)  # progress, throughput and ETA
+'''
+BROADCAST = getattr(config, 'BROADCAST', None)
+BROADCAST_BATCH_SIZE = getattr(BROADCAST, 'BATCH_SIZE', 500)
+BROADCAST_CONCURRENCY = getattr(BROADCAST, 'CONCURRENCY', 100)
+BROADCAST_STALE_AFTER = getattr(BROADCAST, 'STALE_AFTER', 120)
+
+PENDING, SENT, FAILED = 'pending', 'sent', 'failed'
+RUNNING, DONE, CANCELLED = 'running', 'done', 'cancelled'
+
+# broadcast id -> task, of the broadcasts this worker runs
+_running = {}
+_stopping = False
+
+def _owner() -> str:
+   # not computed on import, serve.py imports the app before forking the workers
+   return f'{socket.gethostname()}:{os.getpid()}'
+
+def _now_ms() -> int:
+   return int(time.time() * 1000)
+
+def _model_path(model) -> str:
+   return f'{model.__module__}:{model.__qualname__}'
+
+def _load_model(path: str):
+   module, name = path.split(':')
+   return getattr(importlib.import_module(module), name)
+
+def _recipient_id(broadcast_id: str, open_id: str) -> str:
+   return f'{broadcast_id}:{open_id}'
+
+async def create_broadcast(template_id: str, data: dict, audience, url='', where=None, args=None, field='open_id') -> str:
+   '''
+   Send template `template_id` with `data` to `audience`, an iterable of openids
+   or a Model whose rows matching `where` and `args` are the recipients, by their `field`
+   The sends run in the background of this worker, return the broadcast id
+   '''
+   broadcast_id = uuid.uuid4().hex
+   now = _now_ms()
+   if isinstance(audience, type) and issubclass(audience, Model):
+      model = audience
+      total = await model.findNumber('count(*)', where, args)
+   else:
+      # kept in MySQL, so the audience survives a restart as well
+      await BroadcastRecipient.save_many((BroadcastRecipient(recipient_id=_recipient_id(broadcast_id, open_id), broadcast_id=broadcast_id,
+         open_id=open_id, status=PENDING, errcode=0, msg_id=0, updated_at=now) for open_id in audience), upsert=True)
+      model, where, args, field = BroadcastRecipient, 'broadcast_id=? and status=?', [broadcast_id, PENDING], 'open_id'
+      total = await model.findNumber('count(*)', where, args)
+   broadcast = Broadcast(
+      broadcast_id=broadcast_id,
+      template_id=template_id,
+      template_data=json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+      url=url or '',
+      audience_model=_model_path(model),
+      audience_where=where or '',
+      audience_args=json.dumps(args or []),
+      audience_field=field,
+      status=RUNNING,
+      checkpoint='',
+      total=total or 0,
+      sent=0,
+      failed=0,
+      owner=_owner(),
+      started_at=now,
+      started_from=0,
+      created_at=now,
+      updated_at=now)
+   await broadcast.save()
+   logger.info(f'<service> broadcast {broadcast_id} of {template_id} to {total} recipients started')
+   _start(broadcast, False)
+   return broadcast_id
+
+def _start(broadcast: Broadcast, resumed: bool):
+   broadcast_id = broadcast.broadcast_id
+   task = asyncio.ensure_future(_run(broadcast, resumed))
+   _running[broadcast_id] = task
+   task.add_done_callback(lambda t: _running.pop(broadcast_id, None))
+
+async def _run(broadcast: Broadcast, resumed: bool):
+   broadcast_id = broadcast.broadcast_id
+   model = _load_model(broadcast.audience_model)
+   field = broadcast.audience_field
+   data = json.loads(broadcast.template_data)
+   checkpoint = broadcast.checkpoint
+   after = json.loads(checkpoint) if checkpoint else None
+   sent, failed = broadcast.sent, broadcast.failed
+   semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+   heartbeat = asyncio.ensure_future(_heartbeat(broadcast_id, asyncio.current_task()))
+   try:
+      async for rows in model.iterAll(broadcast.audience_where or None, json.loads(broadcast.audience_args), BROADCAST_BATCH_SIZE,
+            keyset=True, batches=True, after=after):
+         if _stopping:
+            return
+         open_ids = list(dict.fromkeys(row[field] for row in rows))
+         if resumed:
+            # the first batch after a crash may have been sent, not checkpointed
+            open_ids = await _unsent(broadcast_id, open_ids)
+            resumed = False
+         results = await asyncio.gather(*(_send(open_id, broadcast, data, semaphore) for open_id in open_ids))
+         now = _now_ms()
+         await BroadcastRecipient.save_many((BroadcastRecipient(recipient_id=_recipient_id(broadcast_id, open_id), broadcast_id=broadcast_id,
+            open_id=open_id, status=status, errcode=errcode, msg_id=msg_id, updated_at=now) for open_id, (status, errcode, msg_id) in zip(open_ids, results)), upsert=True)
+         batch_sent = sum(1 for status, _, _ in results if status == SENT)
+         sent += batch_sent
+         failed += len(results) - batch_sent
+         checkpoint = json.dumps(rows[-1][model.__primary_key__])
+         if not await _checkpoint(broadcast_id, RUNNING, checkpoint, sent, failed):
+            logger.info(f'<service> broadcast {broadcast_id} cancelled or taken over, stopped')
+            return
+      await _checkpoint(broadcast_id, DONE, checkpoint, sent, failed)
+      logger.info(f'<service> broadcast {broadcast_id} done, {sent} sent, {failed} failed')
+   except asyncio.CancelledError:
+      raise
+   except Exception:
+      # still running in MySQL, taken over once it is stale
+      logger.exception(f'<service> broadcast {broadcast_id} failed, to be resumed from its checkpoint')
+   finally:
+      heartbeat.cancel()
+
+async def _unsent(broadcast_id: str, open_ids: List[str]) -> List[str]:
+   recorded = await BroadcastRecipient.find_many([_recipient_id(broadcast_id, open_id) for open_id in open_ids])
+   return [open_id for open_id, r in zip(open_ids, recorded) if r == None or r.status == PENDING]
+
+async def _send(open_id: str, broadcast: Broadcast, data: dict, semaphore: asyncio.Semaphore) -> tuple:
+   async with semaphore:
+      try:
+         result = await get_outbound().send_template(open_id, broadcast.template_id, data, broadcast.url or None)
+      except WeChatClientException as e:
+         status, errcode, msg_id = FAILED, e.errcode, 0
+      except Exception:
+         # e.g. the outbound queue is full, the outbound scheduler logged it
+         status, errcode, msg_id = FAILED, -1, 0
+      else:
+         status, errcode, msg_id = SENT, 0, (result or {}).get('msgid', 0)
+   if metrics.enabled:
+      metrics.broadcast_messages_total.inc(status)
+   return status, errcode, msg_id
+
+async def _checkpoint(broadcast_id: str, status: str, checkpoint: str, sent: int, failed: int) -> bool:
+   '''
+   Record progress, False if the broadcast is no longer ours to run
+   '''
+   rows = await execute('update `broadcast` set `status`=?, `checkpoint`=?, `sent`=?, `failed`=?, `updated_at`=? where `broadcast_id`=? and `owner`=? and `status`=?',
+      [status, checkpoint, sent, failed, _now_ms(), broadcast_id, _owner(), RUNNING])
+   return rows == 1
+
+async def _heartbeat(broadcast_id: str, task: asyncio.Task):
+   # a batch may take longer than STALE_AFTER when sends are throttled
+   while True:
+      await asyncio.sleep(BROADCAST_STALE_AFTER / 4)
+      try:
+         rows = await execute('update `broadcast` set `updated_at`=? where `broadcast_id`=? and `owner`=? and `status`=?',
+            [_now_ms(), broadcast_id, _owner(), RUNNING])
+      except Exception:
+         logger.exception(f'<service> failed to refresh broadcast {broadcast_id}')
+         continue
+      if rows != 1:
+         logger.info(f'<service> broadcast {broadcast_id} cancelled or taken over, stopping')
+         task.cancel()
+         return
+
+async def resume_broadcasts():
+   '''
+   Take over the running broadcasts nobody refreshed for BROADCAST.STALE_AFTER seconds
+   '''
+   stale = _now_ms() - BROADCAST_STALE_AFTER * 1000
+   for broadcast in await Broadcast.findAll('status=? and updated_at < ?', [RUNNING, stale]):
+      if broadcast.broadcast_id in _running:
+         continue
+      now = _now_ms()
+      done = broadcast.sent + broadcast.failed
+      # whoever refreshed it last wins, other workers resuming the same broadcast find it changed
+      rows = await execute('update `broadcast` set `owner`=?, `started_at`=?, `started_from`=?, `updated_at`=? where `broadcast_id`=? and `status`=? and `updated_at`=?',
+         [_owner(), now, done, now, broadcast.broadcast_id, RUNNING, broadcast.updated_at])
+      if rows != 1:
+         continue
+      broadcast.owner, broadcast.started_at, broadcast.started_from, broadcast.updated_at = _owner(), now, done, now
+      logger.info(f'<service> resuming broadcast {broadcast.broadcast_id} after {done} of {broadcast.total} recipients')
+      _start(broadcast, True)
+
+async def cancel_broadcast(broadcast_id: str) -> bool:
+   rows = await execute('update `broadcast` set `status`=?, `updated_at`=? where `broadcast_id`=? and `status`=?',
+      [CANCELLED, _now_ms(), broadcast_id, RUNNING])
+   task = _running.get(broadcast_id)
+   if task != None:
+      task.cancel()
+   return rows == 1
+
+def progress(broadcast: Broadcast) -> dict:
+   done = broadcast.sent + broadcast.failed
+   elapsed = (broadcast.updated_at - broadcast.started_at) / 1000
+   # since this worker took it over, earlier runs may have run at another pace
+   rate = (done - broadcast.started_from) / elapsed if elapsed > 0 else 0.0
+   remaining = max(broadcast.total - done, 0)
+   return {
+      'broadcast_id': broadcast.broadcast_id,
+      'template_id': broadcast.template_id,
+      'status': broadcast.status,
+      'total': broadcast.total,
+      'sent': broadcast.sent,
+      'failed': broadcast.failed,
+      'progress': done / broadcast.total if broadcast.total else 1.0,
+      'per_second': rate,
+      'eta_seconds': remaining / rate if broadcast.status == RUNNING and rate > 0 else None,
+      'created_at': broadcast.created_at,
+      'updated_at': broadcast.updated_at,
+   }
+
+async def get_broadcast(broadcast_id: str) -> Optional[dict]:
+   broadcast = await Broadcast.find(broadcast_id)
+   return progress(broadcast) if broadcast != None else None
+
+def init_broadcast_service():
+   # only the elected worker runs scheduler jobs, so one worker takes over stale broadcasts, starting now
+   scheduler.add_job(resume_broadcasts, 'interval', seconds=max(BROADCAST_STALE_AFTER // 2, 1),
+      id='broadcast_service.resume', max_instances=1, coalesce=True, next_run_time=datetime.now())
+   logger.info("<service> broadcast service initialized")
+
+async def close_broadcast_service(timeout=10):
+   '''
+   Let the running broadcasts finish their batch, then hand them over
+   '''
+   global _stopping
+   aio_scheduler = scheduler.get_scheduler()
+   if aio_scheduler != None and aio_scheduler.get_job('broadcast_service.resume') != None:
+      aio_scheduler.remove_job('broadcast_service.resume')
+   if not _running:
+      return
+   _stopping = True
+   tasks = list(_running.values())
+   broadcast_ids = list(_running.keys())
+   _, pending = await asyncio.wait(tasks, timeout=timeout)
+   for task in pending:
+      task.cancel()
+   await asyncio.gather(*tasks, return_exceptions=True)
+   # marked stale, so the next worker running the scheduler resumes them at once
+   for broadcast_id in broadcast_ids:
+      await execute('update `broadcast` set `updated_at`=0 where `broadcast_id`=? and `owner`=? and `status`=?', [broadcast_id, _owner(), RUNNING])
+   logger.info(f"<service> broadcast service closed, {len(broadcast_ids)} broadcasts handed over")
@@ -0,0 +1,307 @@
+import json, math, time, uuid, asyncio
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+import config
+from dao.job import Job
+from infra import scheduler
+from infra.mysql import execute, update_many, FIND_CHUNK_SIZE
+from utils.timer_wheel import TimingWheel
+from utils.logger import logger
+
+'''
+Delayed and recurring jobs, such as reminders to every subscriber
+
+Jobs are rows of dao.job.Job, so they survive restarts and may be added or
+cancelled from any worker. Only the worker running the scheduler fires them:
+every second, as a job of infra.scheduler, it moves the jobs due within the
+next JOBS.HORIZON seconds from MySQL to a timing wheel, picks up the jobs
+other workers changed since the last second, and fires the jobs due as
+batches of JOBS.BATCH_SIZE. Each batch is read with one find_many, and
+written back with one DELETE of the finished jobs and one UPDATE of the
+rescheduled ones per chunk of MYSQL.FIND_CHUNK_SIZE jobs, both conditional on
+the version read (see below).
+
+    @job_handler('remind')
+    async def remind(user_id, data):
+       get_outbound().send_text(user_id, data['text'])
+
+    await add_job(remind, delay=3600, user_id=user_id, data={ 'text': 'hello' })
+    await add_job(remind, user_id=user_id, data={ 'text': 'good morning' }, cron={ 'hour': 8 })
+
+A job runs at least once: if the worker dies after running a batch and
+before writing it back, the next worker runs that batch again. Jobs are
+written back only if no worker changed them while they ran, so a job
+cancelled or replaced meanwhile stays cancelled or replaced.
+'''
+JOBS = getattr(config, 'JOBS', None)
+# seconds of jobs held in the timing wheel, later ones are read when they come closer
+JOB_HORIZON = getattr(JOBS, 'HORIZON', 3600)
+JOB_BATCH_SIZE = getattr(JOBS, 'BATCH_SIZE', 500)
+JOB_CONCURRENCY = getattr(JOBS, 'CONCURRENCY', 50)
+JOB_MAX_ATTEMPTS = getattr(JOBS, 'MAX_ATTEMPTS', 3)
+JOB_RETRY_DELAY = getattr(JOBS, 'RETRY_DELAY', 30)
+
+# changes of other workers are read again for this long, their commits may land late
+POLL_OVERLAP_MS = 2000
+
+# handler name -> async function(user_id, data)
+_handlers: Dict[str, Callable] = {}
+
+def job_handler(name: str = None):
+   '''
+   Register an async function `func(user_id, data)` to run the jobs of `name`, its own name by default
+   The name is stored with the job, keep it stable across releases
+   '''
+   def deco(func):
+      key = name or func.__name__
+      _handlers[key] = func
+      func.__job_handler__ = key
+      return func
+   return deco
+
+def _handler_name(handler) -> str:
+   name = handler if isinstance(handler, str) else getattr(handler, '__job_handler__', None)
+   if name not in _handlers:
+      raise KeyError(f'no job handler registered as {name}')
+   return name
+
+def _next_cron(cron: dict, after: float) -> Optional[int]:
+   # imported on first use, as infra.scheduler does
+   from datetime import datetime
+   from apscheduler.triggers.cron import CronTrigger
+   trigger = CronTrigger(**cron)
+   fire_at = trigger.get_next_fire_time(None, datetime.fromtimestamp(math.floor(after) + 1, trigger.timezone))
+   return None if fire_at == None else int(fire_at.timestamp())
+
+def new_job(handler, run_at: float = None, delay: float = 0, user_id='', data: dict = None, interval: int = 0, cron: dict = None, job_id: str = None) -> Job:
+   now = time.time()
+   if run_at == None:
+      run_at = _next_cron(cron, now) if cron and not delay else now + delay
+   return Job(
+      job_id=job_id or uuid.uuid4().hex,
+      handler_name=_handler_name(handler),
+      user_id=user_id,
+      payload=json.dumps(data or {}, ensure_ascii=False, separators=(',', ':')),
+      run_at=math.ceil(run_at),
+      interval_seconds=int(interval),
+      cron=json.dumps(cron, separators=(',', ':')) if cron else '',
+      attempts=0,
+      updated_at=int(now * 1000))
+
+async def add_job(handler, run_at: float = None, delay: float = 0, user_id='', data: dict = None, interval: int = 0, cron: dict = None, job_id: str = None) -> str:
+   '''
+   Run `handler`, a function registered with job_handler or its name, as
+   `handler(user_id, data)` at `run_at` epoch seconds or `delay` seconds from now
+   Every `interval` seconds afterwards, or at every time matching `cron`, the
+   fields of an apscheduler CronTrigger, it runs again; a cron job given neither
+   `run_at` nor `delay` first runs at the next match
+   Adding the `job_id` of an existing job replaces it, return the job id
+   '''
+   job = new_job(handler, run_at, delay, user_id, data, interval, cron, job_id)
+   await Job.save_many([job], upsert=True)
+   if runner != None:
+      runner.schedule(job)
+   return job.job_id
+
+async def add_jobs(jobs: Iterable[dict]) -> int:
+   '''
+   Add many jobs at once, each a dict of the arguments of add_job, with multi-row INSERTs
+   '''
+   jobs = [new_job(**kw) for kw in jobs]
+   await Job.save_many(jobs, upsert=True)
+   if runner != None:
+      for job in jobs:
+         runner.schedule(job)
+   return len(jobs)
+
+async def cancel_job(job_id: str) -> bool:
+   if runner != None:
+      runner.cancel(job_id)
+   return await Job.remove_many([job_id]) > 0
+
+async def cancel_user_jobs(user_id: str, handler=None) -> int:
+   where, args = 'user_id=?', [user_id]
+   if handler != None:
+      where, args = 'user_id=? and handler_name=?', [user_id, _handler_name(handler)]
+   job_ids = [job.job_id for job in await Job.findAll(where, args)]
+   if runner != None:
+      for job_id in job_ids:
+         runner.cancel(job_id)
+   return await Job.remove_many(job_ids) if job_ids else 0
+
+async def _remove_versions(versions: List[tuple]) -> int:
+   '''
+   Delete the jobs of `versions`, (job_id, updated_at) pairs, still at that version
+   '''
+   removed = 0
+   for i in range(0, len(versions), FIND_CHUNK_SIZE):
+      chunk = versions[i:i + FIND_CHUNK_SIZE]
+      where = ' or '.join(['(`job_id`=? and `updated_at`=?)'] * len(chunk))
+      removed += await execute(f'delete from `scheduled_job` where {where}', [arg for pair in chunk for arg in pair])
+   return removed
+
+class JobRunner:
+   def __init__(self, horizon=3600, batch_size=500, concurrency=50, max_attempts=3, retry_delay=30):
+      self.horizon = horizon
+      self.batch_size = batch_size
+      self.max_attempts = max_attempts
+      self.retry_delay = retry_delay
+      self._semaphore = asyncio.Semaphore(concurrency)
+      # set up on the first tick, which only the worker running the scheduler gets
+      self._wheel = None
+      # jobs due before this are in the wheel
+      self._loaded_until = 0
+      self._polled_at = 0
+      self._counters = { 'fired': 0, 'succeeded': 0, 'failed': 0, 'retried': 0, 'dropped': 0, 'skipped': 0, 'superseded': 0 }
+      self._last_fire_seconds = 0.0
+      self._max_fire_seconds = 0.0
+
+   def schedule(self, job: Job):
+      if self._wheel != None and job.run_at < self._loaded_until:
+         self._wheel.schedule(job.job_id, job.run_at)
+
+   def cancel(self, job_id: str):
+      if self._wheel != None:
+         self._wheel.cancel(job_id)
+
+   async def tick(self):
+      now = time.time()
+      if self._wheel == None:
+         self._wheel = TimingWheel(self.horizon, now)
+         self._polled_at = int(now * 1000)
+         # overdue jobs included, they fire right away
+         await self._load(0, self._wheel.horizon)
+         logger.info(f'<service> job runner started with {len(self._wheel)} jobs due within {self.horizon}s')
+      else:
+         await self._poll(now)
+         # refilled every quarter of the horizon, so the wheel never runs dry
+         if self._wheel.horizon - self._loaded_until >= self.horizon // 4:
+            await self._load(self._loaded_until, self._wheel.horizon)
+      due = self._wheel.advance(now)
+      if due:
+         await self._fire([job_id for job_id, _ in due])
+
+   async def _load(self, start: int, until: int):
+      async for jobs in Job.iterAll('run_at >= ? and run_at < ?', [start, until], batches=True):
+         for job in jobs:
+            self._wheel.schedule(job.job_id, job.run_at)
+      self._loaded_until = until
+
+   async def _poll(self, now: float):
+      since = self._polled_at - POLL_OVERLAP_MS
+      self._polled_at = int(now * 1000)
+      for job in await Job.findAll('updated_at >= ? and run_at < ?', [since, self._loaded_until]):
+         self._wheel.schedule(job.job_id, job.run_at)
+
+   async def _fire(self, job_ids: List[str]):
+      start = perf_counter()
+      for i in range(0, len(job_ids), self.batch_size):
+         chunk = job_ids[i:i + self.batch_size]
+         try:
+            await self._fire_batch(chunk)
+         except Exception:
+            # still in MySQL as they were, tried again, and maybe run again, later
+            logger.exception(f'<service> failed to fire {len(chunk)} jobs, retrying in {self.retry_delay}s')
+            for job_id in chunk:
+               self._wheel.schedule(job_id, time.time() + self.retry_delay)
+      self._last_fire_seconds = perf_counter() - start
+      self._max_fire_seconds = max(self._max_fire_seconds, self._last_fire_seconds)
+
+   async def _fire_batch(self, job_ids: List[str]):
+      now = time.time()
+      # cancelled, or moved later, by another worker since they were scheduled
+      jobs = [job for job in await Job.find_many(job_ids) if job != None and job.run_at <= now]
+      self._counters['skipped'] += len(job_ids) - len(jobs)
+      self._counters['fired'] += len(jobs)
+      results = await asyncio.gather(*(self._run(job) for job in jobs))
+      finished, again = [], []
+      for job, ok in zip(jobs, results):
+         # the version read, written back only if it is still the one in MySQL
+         version = job.updated_at
+         if self._reschedule(job, ok, time.time()):
+            again.append((job, version))
+         else:
+            finished.append((job.job_id, version))
+      written = 0
+      if finished:
+         written += await _remove_versions(finished)
+      if again:
+         written += await update_many('scheduled_job', 'job_id', ('run_at', 'attempts', 'updated_at'),
+            [(job.run_at, job.attempts, job.updated_at, job.job_id, version) for job, version in again], version='updated_at')
+         # the ones superseded meanwhile are skipped when they come up, or picked up by _poll
+         for job, _ in again:
+            self.schedule(job)
+      self._counters['superseded'] += len(finished) + len(again) - written
+
+   async def _run(self, job: Job) -> bool:
+      handler = _handlers.get(job.handler_name)
+      if handler == None:
+         logger.error(f'<service> no job handler registered as {job.handler_name}, job {job.job_id} failed')
+         return False
+      async with self._semaphore:
+         try:
+            await handler(job.user_id, json.loads(job.payload))
+         except Exception:
+            logger.exception(f'<service> job {job.job_id} of {job.handler_name} failed')
+            self._counters['failed'] += 1
+            return False
+      self._counters['succeeded'] += 1
+      return True
+
+   def _reschedule(self, job: Job, ok: bool, now: float) -> bool:
+      '''
+      Set the next run of `job`, False if it has none
+      '''
+      # a new version even within the millisecond of the last
+      job.updated_at = max(int(now * 1000), job.updated_at + 1)
+      if not ok:
+         job.attempts += 1
+         if job.attempts < self.max_attempts:
+            self._counters['retried'] += 1
+            job.run_at = math.ceil(now + self.retry_delay * 2 ** (job.attempts - 1))
+            return True
+         self._counters['dropped'] += 1
+      job.attempts = 0
+      if job.interval_seconds > 0:
+         # runs missed while no worker was firing are skipped, not caught up
+         missed = (int(now) - job.run_at) // job.interval_seconds + 1
+         job.run_at += max(missed, 1) * job.interval_seconds
+         return True
+      if job.cron:
+         next_at = _next_cron(json.loads(job.cron), now)
+         if next_at != None:
+            job.run_at = next_at
+            return True
+      return False
+
+   def stats(self) -> dict:
+      return {
+         'running': self._wheel != None,
+         'scheduled': len(self._wheel) if self._wheel != None else 0,
+         'loaded_until': self._loaded_until,
+         'last_fire_seconds': self._last_fire_seconds,
+         'max_fire_seconds': self._max_fire_seconds,
+         **self._counters,
+      }
+
+runner = None
+
+def get_job_runner() -> JobRunner:
+   return runner
+
+def init_job_service():
+   global runner
+   runner = JobRunner(JOB_HORIZON, JOB_BATCH_SIZE, JOB_CONCURRENCY, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY)
+   # only the elected worker runs scheduler jobs, so only it fires
+   scheduler.add_job(runner.tick, 'interval', seconds=1, id='job_service.tick', max_instances=1, coalesce=True)
+   logger.info("<service> job service initialized")
+
+def close_job_service():
+   global runner
+   if runner != None:
+      aio_scheduler = scheduler.get_scheduler()
+      if aio_scheduler != None and aio_scheduler.get_job('job_service.tick') != None:
+         aio_scheduler.remove_job('job_service.tick')
+      runner = None
+      logger.info("<service> job service closed")
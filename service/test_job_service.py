@@ -0,0 +1,112 @@
+import time
+import asyncio
+
+from dao.job import Job
+from infra import mysql
+from service import job_service
+from service.job_service import JobRunner, add_job, cancel_job, job_handler
+
+runs = []
+
+@job_handler('test_record')
+async def record(user_id, data):
+   runs.append((user_id, data))
+
+@job_handler('test_fail')
+async def fail(user_id, data):
+   runs.append((user_id, data))
+   raise RuntimeError('failed')
+
+@job_handler('test_move')
+async def move(user_id, data):
+   runs.append((user_id, data))
+   # another worker reschedules the job, named by user_id here, while it runs
+   await mysql.execute('update `scheduled_job` set `run_at`=?, `updated_at`=? where `job_id`=?', [data['to'], 1, user_id])
+
+def _run(pool, scenario):
+   pool.create(Job)
+   runs.clear()
+   return asyncio.run(scenario())
+
+def _jobs(pool):
+   return { row[0]: row[1:] for row in pool.db.execute('select job_id, run_at, attempts from scheduled_job') }
+
+def test_due_jobs_fire_once(mysql_pool):
+   now = time.time()
+   async def scenario():
+      runner = JobRunner(horizon=60)
+      await add_job(record, run_at=now - 5, user_id='due', data={ 'n': 1 }, job_id='due')
+      await add_job('test_record', delay=3600, user_id='later', job_id='later')
+      await runner.tick()
+      await runner.tick()
+      return runner.stats()
+   stats = _run(mysql_pool, scenario)
+   assert runs == [('due', { 'n': 1 })]
+   # done, so deleted; the later one still waits
+   assert list(_jobs(mysql_pool)) == ['later']
+   assert (stats['fired'], stats['succeeded']) == (1, 1)
+
+def test_recurring_job_is_rescheduled(mysql_pool):
+   now = time.time()
+   async def scenario():
+      await add_job(record, run_at=now - 1, user_id='u', interval=60, job_id='every_minute')
+      runner = JobRunner(horizon=600)
+      await runner.tick()
+   _run(mysql_pool, scenario)
+   run_at, attempts = _jobs(mysql_pool)['every_minute']
+   assert now < run_at <= now + 60
+   assert attempts == 0
+
+def test_failed_job_is_retried_then_dropped(mysql_pool):
+   now = time.time()
+   async def scenario():
+      await add_job(fail, run_at=now - 1, job_id='failing')
+      runner = JobRunner(max_attempts=2, retry_delay=30)
+      await runner._fire_batch(['failing'])
+      retry = _jobs(mysql_pool)['failing']
+      # due again
+      await mysql.execute('update `scheduled_job` set `run_at`=? where `job_id`=?', [int(now) - 1, 'failing'])
+      await runner._fire_batch(['failing'])
+      return retry, runner.stats()
+   (run_at, attempts), stats = _run(mysql_pool, scenario)
+   assert attempts == 1 and run_at >= now + 30
+   assert 'failing' not in _jobs(mysql_pool)
+   assert (stats['retried'], stats['dropped']) == (1, 1)
+
+def test_cancelled_job_is_skipped(mysql_pool):
+   now = time.time()
+   async def scenario():
+      await add_job(record, run_at=now - 1, job_id='cancelled')
+      await cancel_job('cancelled')
+      runner = JobRunner()
+      await runner._fire_batch(['cancelled'])
+      return runner.stats()
+   stats = _run(mysql_pool, scenario)
+   assert runs == []
+   assert stats['skipped'] == 1
+
+def test_write_back_skips_jobs_changed_while_running(mysql_pool, monkeypatch):
+   now = time.time()
+   updates = []
+   update_many = job_service.update_many
+   async def counting(*args, **kw):
+      updates.append(len(args[3]))
+      return await update_many(*args, **kw)
+   monkeypatch.setattr(job_service, 'update_many', counting)
+   async def scenario():
+      for job_id in ('a', 'b'):
+         await add_job(record, run_at=now - 1, user_id=job_id, interval=60, job_id=job_id)
+      await add_job(move, run_at=now - 1, user_id='moved', data={ 'to': 9999999999 }, interval=60, job_id='moved')
+      await add_job(move, run_at=now - 1, user_id='moved_once', data={ 'to': 8888888888 }, job_id='moved_once')
+      runner = JobRunner()
+      await runner._fire_batch(['a', 'b', 'moved', 'moved_once'])
+      return runner.stats()
+   stats = _run(mysql_pool, scenario)
+   jobs = _jobs(mysql_pool)
+   assert now < jobs['a'][0] <= now + 60 and now < jobs['b'][0] <= now + 60
+   # neither overwritten nor deleted by the write-back
+   assert jobs['moved'][0] == 9999999999
+   assert jobs['moved_once'][0] == 8888888888
+   assert stats['superseded'] == 2
+   # the three rescheduled jobs written back together
+   assert updates == [3]
@@ -1,24 +1,64 @@
-import json, datetime
+import json, time, asyncio
+from typing import List
 
+import config
 from infra.wechat import get_wx_client
 from config import QR_CODE_EXPIRATION
+from utils.cache import TTLCache, SingleFlight
 from utils.logger import logger
 
-async def generate_qr_code(body: dict) -> str:
+# a cached ticket is handed out while it stays valid for at least this many seconds
+QR_CODE_MIN_REMAINING = getattr(config, 'QR_CODE_MIN_REMAINING', 60)
+QR_CODE_CACHE_SIZE = getattr(config, 'QR_CODE_CACHE_SIZE', 10000)
+QR_CODE_BULK_CONCURRENCY = getattr(config, 'QR_CODE_BULK_CONCURRENCY', 8)
+QR_CODE_BULK_MAX_SIZE = getattr(config, 'QR_CODE_BULK_MAX_SIZE', 500)
+
+# scene_str -> (url, created_at)
+_qr_code_cache = TTLCache(QR_CODE_CACHE_SIZE, max(QR_CODE_EXPIRATION - QR_CODE_MIN_REMAINING, 0))
+_qr_code_flight = SingleFlight()
+
+def canonicalize_scene(body: dict) -> str:
+   return json.dumps(body, sort_keys=True, separators=(',', ':'))
+
+async def generate_qr_code(body: dict) -> dict:
+   scene_str = canonicalize_scene(body)
+   cached = _qr_code_cache.get(scene_str)
+   if cached == None:
+      # identical concurrent requests share one qrcode.create call
+      cached = await _qr_code_flight.run(scene_str, lambda: _create_qr_code(scene_str))
+   url, created_at = cached
+   return {
+      'url': url,
+      "expire_seconds": int(created_at + QR_CODE_EXPIRATION - time.monotonic()),
+   }
+
+async def generate_qr_codes(bodies: List[dict]) -> List[dict]:
+   semaphore = asyncio.Semaphore(QR_CODE_BULK_CONCURRENCY)
+   async def generate(body):
+      async with semaphore:
+         try:
+            return await generate_qr_code(body)
+         except Exception as e:
+            logger.exception(f"Failed to generate qrcode of body: {json.dumps(body)}")
+            return { 'error': str(e) }
+   return await asyncio.gather(*(generate(body) for body in bodies))
+
+async def _create_qr_code(scene_str: str):
    json_body = {
       "expire_seconds": QR_CODE_EXPIRATION, 
       "action_name": "QR_STR_SCENE", 
       "action_info": {
          "scene": {
-            "scene_str": json.dumps(body)
+            "scene_str": scene_str
          }
       }
    }
+   # measured before the request, so the remaining lifetime is never overestimated
+   created_at = time.monotonic()
    ticket = await get_qr_code_ticket(json_body)
-   return { 
-      'url': await get_qr_code_url(ticket),
-      "expire_seconds": QR_CODE_EXPIRATION,
-   }
+   cached = (await get_qr_code_url(ticket), created_at)
+   _qr_code_cache.set(scene_str, cached)
+   return cached
 
 async def get_qr_code_ticket(json_body: dict) -> str:
    '''Example
@@ -34,8 +74,9 @@ async def get_qr_code_ticket(json_body: dict) -> str:
    '''
    client = get_wx_client()
    logger.info(f"Generate qrcode of body: {json.dumps(json_body)}")
-   return client.qrcode.create(json_body)["ticket"]
+   res = await client.qrcode.create(json_body)
+   return res["ticket"]
 
 async def get_qr_code_url(ticket):
    client = get_wx_client()
-   return client.qrcode.get_url(ticket)
\ No newline at end of file
+   return client.qrcode.get_url(ticket)
@@ -0,0 +1,128 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+_MISSING = object()
+
+class TTLCache:
+    '''
+    Bounded mapping whose entries expire `ttl` seconds after they are set
+    As every entry lives for the same ttl, insertion order is also expiry order,
+    so expired entries are always at the front and eviction is O(1)
+    '''
+    def __init__(self, maxsize: int, ttl: float, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+
+    def _expire(self, now):
+        data = self._data
+        while data:
+            key, (expires_at, _) = next(iter(data.items()))
+            if expires_at > now:
+                break
+            data.popitem(last=False)
+
+    def get(self, key, default=None):
+        self._expire(self._timer())
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[1]
+
+    def set(self, key, value):
+        now = self._timer()
+        self._expire(now)
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[1]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        self._expire(self._timer())
+        return len(self._data)
+
+
+class LRUCache:
+    '''
+    Bounded mapping evicting the least recently used entry, whose entries
+    also expire `ttl` seconds, or the ttl given to `set`, after they are set
+    Reads reorder entries, so expired ones are only dropped when read or evicted
+    '''
+    def __init__(self, maxsize: int, ttl: float, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        if item[0] <= self._timer():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        self._data.pop(key, None)
+        self._data[key] = (self._timer() + (self.ttl if ttl is None else ttl), value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    '''
+    Concurrent calls with the same key share one execution and its result
+    '''
+    def __init__(self):
+        self._calls = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        return await asyncio.shield(future)
+
+    def forget(self, key: Hashable):
+        '''
+        Let the next call with `key` start a new execution, callers already waiting
+        still get the result of the current one
+        '''
+        self._calls.pop(key, None)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
@@ -1,12 +1,19 @@
+import hmac
 import traceback
-from quart import abort
+from quart import abort, request
 from functools import wraps
 from wechatpy import parse_message, create_reply
 
 from wechatpy.exceptions import InvalidSignatureException, InvalidAppIdException
 
+import config
 from utils.logger import logger
 
+class InvalidRequestError(ValueError):
+    '''
+    A request api_controller answers with 400 and the message
+    '''
+
 def controller(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
@@ -27,10 +34,29 @@ def api_controller(func):
         try:
             res =  await func(*args, **kwargs)
             return { 'code': 200, 'data': res, 'msg': 'success' }
+        except InvalidRequestError as e:
+            logger.info(f'400: {e}')
+            return { 'code': 400, 'msg': str(e) }, 400
         except (InvalidSignatureException, InvalidAppIdException):
             logger.exception('403: Permission denied')
             return { 'code': 403, 'msg': 'Permission Denied' }
         except Exception as e:
             logger.exception('500: Internal Server Error')
             return { 'code': 500, 'msg': 'Internal Server Error' }
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+def admin_only(func):
+    '''
+    Routes of the admin API, answered only to requests carrying ADMIN.TOKEN as
+    `Authorization: Bearer <token>`, and not at all while ADMIN.TOKEN is unset
+    '''
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = getattr(getattr(config, 'ADMIN', None), 'TOKEN', None)
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            logger.warning(f'401: {request.path} called without the admin token')
+            return { 'code': 401, 'msg': 'Unauthorized' }, 401
+        return await func(*args, **kwargs)
+    return wrapper
@@ -1,9 +1,63 @@
-import zhconv
 import unicodedata
+from functools import lru_cache
 
+'''
+Text normalization shared by message matching and trigger registration
+
+zhconv converts by longest match over its phrase dictionary, which dominates
+the cost of matching short messages. Most strings contain no character that
+starts a multi-character phrase, and for those the conversion is exactly a
+character-level table lookup, so `str.translate` with a precomputed table is
+used and zhconv is only called for the rest. Results are memoized as well.
+'''
+CACHE_SIZE = 4096
+
+class _Converter:
+    def __init__(self, locale: str):
+        self.locale = locale
+        self._table = None
+        self._phrase_starters = None
+
+    def _load(self):
+        import zhconv
+        conv_dict = zhconv.zhconv.getdict(self.locale)
+        self._table = { ord(k): v for k, v in conv_dict.items() if len(k) == 1 }
+        self._phrase_starters = frozenset(k[0] for k in conv_dict if len(k) > 1)
+
+    def convert(self, string: str) -> str:
+        if string.isascii():
+            return string
+        if self._table is None:
+            self._load()
+        if self._phrase_starters.isdisjoint(string):
+            return string.translate(self._table)
+        import zhconv
+        return zhconv.convert(string, self.locale)
+
+_converters = { locale: _Converter(locale) for locale in ('zh-hans', 'zh-hant') }
+
+def preload():
+    '''
+    Build the conversion tables now, e.g. before forking workers that share them
+    '''
+    for converter in _converters.values():
+        if converter._table is None:
+            converter._load()
+
+@lru_cache(maxsize=CACHE_SIZE)
+def convert(string: str, locale: str) -> str:
+    '''
+    Same result as zhconv.convert(string, locale) for 'zh-hans' and 'zh-hant'
+    '''
+    return _converters[locale].convert(string)
+
+@lru_cache(maxsize=CACHE_SIZE)
 def normalize_str(string: str) -> str:
+    if string.isascii():
+        # NFKC and zhconv leave ASCII unchanged
+        return string.strip().lower()
     string = unicodedata.normalize('NFKC', string)
     string = string.strip()
     string = string.lower()
-    string = zhconv.convert(string, 'zh-hans')
-    return string
\ No newline at end of file
+    string = _converters['zh-hans'].convert(string)
+    return string
@@ -0,0 +1,57 @@
+import os
+import stat
+
+'''
+Files shared by the worker processes of this service and nobody else
+
+They live in a directory owned by the user running the service and closed
+to every other user, which is created with mode 0700 when missing. A
+directory or file another user owns, or may write, is refused with
+PermissionError rather than trusted.
+'''
+def _check(path, st, kind):
+    # no ownership on this platform
+    if not hasattr(os, 'geteuid'):
+        return
+    if st.st_uid != os.geteuid():
+        raise PermissionError(f'{kind} {path} is owned by uid {st.st_uid}, not by this service')
+    if st.st_mode & 0o077:
+        raise PermissionError(f'{kind} {path} is open to other users, mode {stat.S_IMODE(st.st_mode):o}')
+
+def private_dir(path: str) -> str:
+    '''
+    Create directory `path` with mode 0700 if missing, and check it is private
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f'{path} is not a directory')
+    _check(path, st, 'directory')
+    return path
+
+def open_private(path: str, flags=os.O_RDWR, create=True) -> int:
+    '''
+    Open file `path` in a private directory, created with mode 0600 if missing unless `create=False`
+    Return the file descriptor
+    '''
+    private_dir(os.path.dirname(os.path.abspath(path)))
+    flags |= getattr(os, 'O_NOFOLLOW', 0)
+    if create:
+        flags |= os.O_CREAT
+    fd = os.open(path, flags, 0o600)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise PermissionError(f'{path} is not a regular file')
+        _check(path, st, 'file')
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+def private_file(path: str) -> str:
+    '''
+    Create file `path` with mode 0600 if missing, and check it and its directory are private
+    '''
+    os.close(open_private(path))
+    return path
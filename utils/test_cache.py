@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from utils.cache import LRUCache, SingleFlight, TTLCache
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_ttl_cache_expires():
+    clock = _Clock()
+    cache = TTLCache(10, 5, timer=clock)
+    cache.set('a', 1)
+    clock.now = 3
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    clock.now = 5
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+    clock.now = 8
+    assert 'b' not in cache
+    assert len(cache) == 0
+
+def test_ttl_cache_set_again_renews():
+    clock = _Clock()
+    cache = TTLCache(10, 5, timer=clock)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    clock.now = 4
+    cache.set('a', 3)
+    clock.now = 6
+    assert cache.get('a') == 3
+    assert cache.get('b') is None
+
+def test_ttl_cache_is_bounded():
+    cache = TTLCache(2, 5, timer=_Clock())
+    for key in 'abc':
+        cache.set(key, key)
+    assert len(cache) == 2
+    assert 'a' not in cache
+    assert cache.pop('b') == 'b'
+    assert cache.pop('b', 'gone') == 'gone'
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2, 60, timer=_Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+def test_lru_cache_ttl():
+    clock = _Clock()
+    cache = LRUCache(10, 60, timer=clock)
+    cache.set('a', 1)
+    cache.set('b', None, ttl=5)
+    clock.now = 5
+    assert cache.get('b', 'expired') == 'expired'
+    assert cache.get('a') == 1
+    clock.now = 60
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_single_flight_shares_one_call():
+    calls = []
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run('key', load) for _ in range(10)))
+        assert len(flight) == 0
+        # done, so the next call runs again
+        results.append(await flight.run('key', load))
+        return results
+    assert asyncio.run(main()) == [1] * 10 + [2]
+
+def test_single_flight_forget():
+    calls = []
+    async def load():
+        calls.append(1)
+        call = len(calls)
+        await asyncio.sleep(0.01)
+        return call
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.run('key', load))
+        await asyncio.sleep(0)
+        flight.forget('key')
+        second = await flight.run('key', load)
+        return await first, second
+    assert asyncio.run(main()) == (1, 2)
+
+def test_single_flight_shares_errors():
+    async def load():
+        await asyncio.sleep(0.01)
+        raise ValueError('failed')
+    async def main():
+        flight = SingleFlight()
+        return await asyncio.gather(*(flight.run('key', load) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(e, ValueError) for e in asyncio.run(main()))
+
+def test_single_flight_survives_a_cancelled_caller():
+    async def load():
+        await asyncio.sleep(0.01)
+        return 'row'
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.run('key', load))
+        second = asyncio.ensure_future(flight.run('key', load))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+    assert asyncio.run(main()) == 'row'
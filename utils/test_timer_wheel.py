@@ -0,0 +1,44 @@
+from utils.timer_wheel import TimingWheel
+
+def test_advance_pops_due_seconds():
+    wheel = TimingWheel(60, 1000)
+    wheel.schedule('a', 1000.5, 'A')
+    wheel.schedule('b', 1002)
+    wheel.schedule('c', 1010)
+    assert wheel.advance(1000) == []
+    assert wheel.advance(1001) == [('a', 'A')]
+    assert wheel.advance(1005) == [('b', None)]
+    assert len(wheel) == 1 and 'c' in wheel
+
+def test_overdue_keys_go_in_the_current_second():
+    wheel = TimingWheel(60, 1000)
+    wheel.schedule('a', 10)
+    assert wheel.advance(1000) == [('a', None)]
+
+def test_horizon():
+    wheel = TimingWheel(60, 1000)
+    assert wheel.horizon == 1060
+    assert not wheel.schedule('a', 1060)
+    assert wheel.schedule('b', 1059)
+    wheel.advance(1010)
+    assert wheel.horizon == 1071
+
+def test_reschedule_and_cancel():
+    wheel = TimingWheel(60, 1000)
+    wheel.schedule('a', 1001)
+    wheel.schedule('a', 1005)
+    assert wheel.advance(1002) == []
+    assert wheel.cancel('a')
+    assert not wheel.cancel('a')
+    assert wheel.advance(1010) == []
+    assert len(wheel) == 0
+
+def test_long_pause_visits_every_slot_once():
+    wheel = TimingWheel(10, 1000)
+    for i in range(10):
+        wheel.schedule(i, 1000 + i)
+    assert sorted(key for key, _ in wheel.advance(5000)) == list(range(10))
+    # the wheel moved on, a key wraps around to its new second
+    wheel.schedule('late', 5003)
+    assert wheel.advance(5002) == []
+    assert wheel.advance(5003) == [('late', None)]
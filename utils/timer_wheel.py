@@ -0,0 +1,74 @@
+import math
+from typing import Hashable, List, Tuple
+
+class TimingWheel:
+    '''
+    Timing wheel of one-second slots covering the next `size` seconds
+
+    Each slot holds the keys due in its second, so schedule and cancel are
+    O(1) whatever the number of keys, and `advance` pops whole seconds at once.
+    Keys due later than the wheel covers are refused, the caller keeps them
+    elsewhere and schedules them once they come within `horizon`.
+    '''
+    def __init__(self, size: int, now: float):
+        self.size = size
+        self._slots = [None] * size
+        # key -> second it is due in
+        self._index = {}
+        # first second not popped yet
+        self._current = int(now)
+
+    @property
+    def horizon(self) -> int:
+        '''
+        First second the wheel does not cover
+        '''
+        return self._current + self.size
+
+    def schedule(self, key: Hashable, at: float, value=None) -> bool:
+        '''
+        Schedule `key` at `at`, rounded up to the second, or replace its schedule
+        Keys already due go in the current second, False if `at` is beyond the horizon
+        '''
+        second = max(math.ceil(at), self._current)
+        if second >= self.horizon:
+            return False
+        self.cancel(key)
+        i = second % self.size
+        slot = self._slots[i]
+        if slot is None:
+            slot = self._slots[i] = {}
+        slot[key] = value
+        self._index[key] = second
+        return True
+
+    def cancel(self, key: Hashable) -> bool:
+        second = self._index.pop(key, None)
+        if second is None:
+            return False
+        del self._slots[second % self.size][key]
+        return True
+
+    def advance(self, now: float) -> List[Tuple[Hashable, object]]:
+        '''
+        Pop the keys, with their values, of every second up to `now`
+        '''
+        due = []
+        until = int(now)
+        # after a long pause every slot is due, each visited once
+        for second in range(self._current, min(until + 1, self._current + self.size)):
+            i = second % self.size
+            slot = self._slots[i]
+            if slot:
+                self._slots[i] = None
+                for key, value in slot.items():
+                    del self._index[key]
+                    due.append((key, value))
+        self._current = max(self._current, until + 1)
+        return due
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)